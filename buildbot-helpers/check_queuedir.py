@@ -1,22 +1,100 @@
 #!/usr/bin/python
 """%prog -w <warn_new> -c <crit_new> -t <max_age> queuedir [queuedir...]
 
-nagios plugin to monitor a queuedir"""
+nagios plugin to monitor a queuedir
+
+Queues keep their item counts and the age of their oldest item in a state
+file, which is read rather than scanning the queue. Queues without a
+complete one are scanned."""
 import os
 import sys
 import traceback
 import time
 
+from mozilla_buildtools.queuedir import read_state
+
 OK, WARNING, CRITICAL, UNKNOWN = range(4)
 
 
-def check_queuedir(d, options):
+def scan_queuedir(d):
+    """Counts the items in d by listing its directories"""
+    new_files = os.listdir(os.path.join(d, 'new'))
+    state = {
+        'new': len(new_files),
+        'dead': len([f for f in os.listdir(os.path.join(d, 'dead'))
+                     if not f.endswith(".log")]),
+        'oldest': None,
+    }
+    if new_files:
+        state['oldest'] = min(
+            os.path.getmtime(os.path.join(d, 'new', f)) for f in new_files)
+    return state
+
+
+def queuedir_state(d):
+    """Returns the state of the queue in d. For sharded queues, this is the
+    total over all the shards"""
+    try:
+        nshards = int(open(os.path.join(d, 'shards.count')).read())
+    except (IOError, ValueError):
+        nshards = None
+    if not nshards:
+        return read_state(d) or scan_queuedir(d)
+
+    total = {'oldest': None}
+    for i in range(nshards):
+        shard_dir = os.path.join(d, 'shards', str(i))
+        state = read_state(shard_dir) or scan_queuedir(shard_dir)
+        for key, value in state.items():
+            if key == 'oldest':
+                if value is not None and (total[key] is None or value < total[key]):
+                    total[key] = value
+            else:
+                total[key] = total.get(key, 0) + value
+    return total
+
+
+def format_prometheus(states, now=None):
+    """Returns Prometheus text format metrics for `states`, a list of
+    (queuedir, state) pairs"""
+    if now is None:
+        now = time.time()
+    lines = [
+        "# HELP queuedir_items Number of items in each part of the queue",
+        "# TYPE queuedir_items gauge",
+    ]
+    for d, state in states:
+        for part in ('new', 'cur', 'delayed', 'dead'):
+            if part in state:
+                lines.append('queuedir_items{queuedir="%s",part="%s"} %i' % (d, part, state[part]))
+    lines.extend([
+        "# HELP queuedir_events_total Number of times items have been added, popped, etc.",
+        "# TYPE queuedir_events_total counter",
+    ])
+    for d, state in states:
+        for event in ('added', 'popped', 'removed', 'requeued', 'murdered'):
+            if event in state:
+                lines.append('queuedir_events_total{queuedir="%s",event="%s"} %i' % (d, event, state[event]))
+    lines.extend([
+        "# HELP queuedir_oldest_item_age_seconds Age of the oldest item in new",
+        "# TYPE queuedir_oldest_item_age_seconds gauge",
+    ])
+    for d, state in states:
+        age = 0
+        if state['oldest'] is not None:
+            age = max(now - state['oldest'], 0)
+        lines.append('queuedir_oldest_item_age_seconds{queuedir="%s"} %.3f' % (d, age))
+    return "\n".join(lines) + "\n"
+
+
+def check_queuedir(d, options, state=None):
     status = OK
     msgs = []
+    if state is None:
+        state = queuedir_state(d)
 
     # Check 'dead'
-    num_dead = len([f for f in os.listdir(
-        os.path.join(d, 'dead')) if not f.endswith(".log")])
+    num_dead = state['dead']
     if num_dead > 0:
         status = CRITICAL
         if num_dead == 1:
@@ -25,11 +103,8 @@ def check_queuedir(d, options):
             msgs.append("%i dead items" % num_dead)
 
     # Check 'new'
-    new_files = os.listdir(os.path.join(d, 'new'))
-    num_new = len(new_files)
+    num_new = state['new']
     if num_new > 0:
-        oldest_new = min(
-            os.path.getmtime(os.path.join(d, 'new', f)) for f in new_files)
         if num_new >= options.crit_new:
             status = CRITICAL
             msgs.append("%i new items" % num_new)
@@ -37,7 +112,8 @@ def check_queuedir(d, options):
             status = max(status, WARNING)
             msgs.append("%i new items" % num_new)
 
-        age = int(time.time() - oldest_new)
+    if state['oldest'] is not None:
+        age = int(time.time() - state['oldest'])
         if age > options.max_age:
             status = max(status, WARNING)
             msgs.append("oldest item is %is old" % age)
@@ -52,6 +128,7 @@ def main():
         warn_new=50,
         crit_new=100,
         max_age=900,
+        prometheus=False,
     )
     parser.add_option("-w", dest="warn_new", type="int",
                       help="warn when there are more than this number of items in new")
@@ -59,6 +136,9 @@ def main():
                       help="critical when there are more than this number of items in new")
     parser.add_option("-t", dest="max_age", type="int",
                       help="warn when oldest item in new is more than this many seconds old")
+    parser.add_option("-p", "--prometheus", dest="prometheus", action="store_true",
+                      help="print metrics in Prometheus text format instead of "
+                      "checking them")
 
     options, args = parser.parse_args()
 
@@ -67,6 +147,10 @@ def main():
         sys.exit(UNKNOWN)
 
     try:
+        if options.prometheus:
+            sys.stdout.write(format_prometheus([(d, queuedir_state(d)) for d in args]))
+            sys.exit(OK)
+
         status = OK
         msgs = []
         for d in args:
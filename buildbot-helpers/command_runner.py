@@ -1,18 +1,50 @@
 #!/usr/bin/env python
 """
 Runs commands from a queue!
+
+Items are either a JSON list of the command to run, or a JSON object like
+    {"command": [...], "priority": 10, "retry_time": 30, "max_retry_time": 3600,
+     "max_retries": 5, "max_time": 600}
+where everything but "command" is optional and defaults to the runner's
+options. Failed commands are retried after retry_time seconds, doubling
+each time up to max_retry_time. retry_time defaults to 0, i.e. failed
+commands are retried straight away; set it (or -t) to back off. Use
+queue_command() to add items.
+
+Items with a higher priority are run first. If the queue is sharded (see
+ShardedQueueDir), priorities only order items within each shard, so an
+urgent item can still wait behind ordinary ones in other shards.
 """
 import subprocess
 import os
+import errno
+import fcntl
+import select
 import signal
 import time
-from mozilla_buildtools.queuedir import QueueDir
+from mozilla_buildtools.queuedir import open_queuedir, QueueWatcher
 from buildbot.util import json
 import logging
 log = logging.getLogger(__name__)
 
 
+def queue_command(q, command, priority=0, delay=None, **kwargs):
+    """
+    Adds command to queue q. kwargs are any of the other fields of the item
+    described above, e.g. retry_time.
+    """
+    item = dict(kwargs)
+    item['command'] = command
+    if priority:
+        item['priority'] = priority
+    q.add(json.dumps(item), priority, delay)
+
+
 class Job(object):
+    # How long to wait for the process to exit before escalating to the next
+    # signal
+    kill_interval = 60
+
     def __init__(self, cmd, item_id, log_fp):
         self.cmd = cmd
         self.log = log_fp
@@ -31,44 +63,116 @@ class Job(object):
                                      stdout=self.log, stderr=self.log)
         self.started = time.time()
 
-    def check(self):
-        now = time.time()
-        if now - self.started > self.max_time:
-            # Kill stuff off
-            if now - self.last_signal_time > 60:
-                s = {None: signal.SIGINT, signal.SIGINT:
-                     signal.SIGTERM}.get(self.last_signal, signal.SIGKILL)
-                log.info("Killing %i with %i", self.proc.pid, s)
-                try:
-                    self.log.write("Killing with %s\n" % s)
-                    os.kill(self.proc.pid, s)
-                    self.last_signal = s
-                    self.last_signal_time = now
-                except OSError:
-                    # Ok, process must have exited already
-                    log.exception("Failed to kill")
-                    pass
+    def deadline(self):
+        """
+        Returns the time at which check() needs to be called next to kill
+        the process
+        """
+        if self.last_signal is None:
+            return self.started + self.max_time
+        return self.last_signal_time + self.kill_interval
 
-        result = self.proc.poll()
-        if result is not None:
-            self.log.write("\nResult: %s, Elapsed: %1.1f seconds\n" % (result, time.time() - self.started))
-            self.log.close()
+    def check(self, now=None):
+        """
+        Kills the process if it has run for too long, escalating from SIGINT
+        to SIGTERM to SIGKILL every kill_interval seconds
+        """
+        if now is None:
+            now = time.time()
+        if now < self.deadline():
+            return
+        s = {None: signal.SIGINT, signal.SIGINT:
+             signal.SIGTERM}.get(self.last_signal, signal.SIGKILL)
+        log.info("Killing %i with %i", self.proc.pid, s)
+        self.last_signal = s
+        self.last_signal_time = now
+        try:
+            self.log.write("Killing with %s\n" % s)
+            os.kill(self.proc.pid, s)
+        except OSError:
+            # Ok, process must have exited already
+            log.exception("Failed to kill")
+
+    def finished(self, status):
+        """
+        Records that the process exited with the given wait() status
+        Returns its exit code, which is negative if it was killed by a signal
+        """
+        if os.WIFSIGNALED(status):
+            result = -os.WTERMSIG(status)
+        else:
+            result = os.WEXITSTATUS(status)
+        # We reaped it, so make sure Popen doesn't try to
+        self.proc.returncode = result
+        self.log.write("\nResult: %s, Elapsed: %1.1f seconds\n" % (result, time.time() - self.started))
+        self.log.close()
         return result
 
 
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
 class CommandRunner(object):
+    # How often to touch the items of running jobs so they're not requeued
+    # by cleanup; this must be well under the queue's cleanup_time
+    touch_interval = 60
+
+    # How often to look for new items when we can't be told about them
+    poll_interval = 1
+
     def __init__(self, options):
         self.queuedir = options.queuedir
-        self.q = QueueDir('commands', self.queuedir)
+        self.q = open_queuedir('commands', self.queuedir)
         self.concurrency = options.concurrency
         self.retry_time = options.retry_time
         self.max_retries = options.max_retries
         self.max_time = options.max_time
+        self.max_retry_time = options.max_retry_time
+
+        # Mapping of pid to running Job
+        self.active = {}
+        self.last_touch = 0
+
+        # SIGCHLD wakes up the select() in wait() by writing to this pipe
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        _set_nonblocking(self.wakeup_r)
+        _set_nonblocking(self.wakeup_w)
+        self.watcher = None
 
-        self.active = []
+    def make_job(self, item, item_id):
+        """
+        Returns a Job for the given queue item, which is either a command or
+        a dict as described at the top of this file
+        """
+        if isinstance(item, dict):
+            command = item['command']
+        else:
+            command, item = item, {}
+        limits = {}
+        for name in ('max_time', 'retry_time', 'max_retry_time', 'max_retries'):
+            # Missing or null fields get the runner's default
+            value = item.get(name)
+            if value is None:
+                value = getattr(self, name)
+            if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+                raise ValueError("%s must be a number, not %r" % (name, value))
+            limits[name] = value
+        job = Job(command, item_id, self.q.getlog(item_id))
+        for name, value in limits.items():
+            setattr(job, name, value)
+        return job
 
-        # List of (signal_time, level, proc)
-        self.to_kill = []
+    def retry(self, job):
+        """
+        Requeues a failed job, backing off exponentially
+        """
+        delay = job.retry_time * 2 ** self.q.getcount(job.item_id)
+        if job.max_retry_time:
+            delay = min(delay, job.max_retry_time)
+        log.info("Retrying %s in %s seconds", job.item_id, delay)
+        self.q.requeue(job.item_id, delay, job.max_retries)
 
     def run(self, job):
         """
@@ -77,65 +181,125 @@ class CommandRunner(object):
         log.info("Running %s", job.cmd)
         try:
             job.start()
-            self.active.append(job)
+            self.active[job.proc.pid] = job
         except OSError:
-            job.log.write("\nFailed with OSError; requeuing in %i seconds\n" %
-                          self.retry_time)
+            job.log.write("\nFailed with OSError; requeuing\n")
             # Wait to requeue it
             # If we die, then it's still in cur, and will be moved back into
             # 'new' eventually
-            self.q.requeue(job.item_id, self.retry_time, self.max_retries)
+            self.retry(job)
+
+    def reap(self):
+        """
+        Handles jobs that have finished
+        """
+        done = []
+        while self.active:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno != errno.ECHILD:
+                    raise
+                break
+            if pid == 0:
+                break
+            job = self.active.pop(pid, None)
+            if job is None:
+                continue
+            result = job.finished(status)
+            if result == 0:
+                done.append(job.item_id)
+            else:
+                log.warn("%s failed; requeuing", job.item_id)
+                # Requeue it!
+                self.retry(job)
+        if done:
+            self.q.remove_many(done)
 
     def monitor(self):
         """
-        Monitor running jobs
+        Monitor running jobs: reaps finished ones, kills ones that have run
+        for too long, and touches all the others' items every touch_interval.
+        Also keeps our hold on the queue (e.g. shard leases) fresh while
+        we're too busy to take more items.
+        """
+        self.q.maybe_renew()
+        self.reap()
+        now = time.time()
+        for job in self.active.values():
+            job.check(now)
+        if now - self.last_touch >= self.touch_interval:
+            for job in self.active.values():
+                self.q.touch(job.item_id)
+            self.last_touch = now
+
+    def wait(self, want_items):
+        """
+        Waits until a job finishes, a job needs killing, the queue needs
+        renewing, or if want_items is set, until new items may have arrived
         """
-        for job in self.active[:]:
-            self.q.touch(job.item_id)
-            result = job.check()
+        now = time.time()
+        wakeups = [self.last_touch + self.touch_interval]
+        wakeups.extend(job.deadline() for job in self.active.values())
+        t = self.q.next_renewal()
+        if t is not None:
+            wakeups.append(t)
+        fds = [self.wakeup_r]
+        if want_items:
+            t = self.q.next_wakeup()
+            if t is not None:
+                wakeups.append(t)
+            if self.watcher.fileno() is None:
+                wakeups.append(now + self.poll_interval)
+            else:
+                fds.append(self.watcher.fileno())
+        timeout = max(min(wakeups) - now, 0)
 
-            if result is not None:
-                self.active.remove(job)
-                if result == 0:
-                    self.q.remove(job.item_id)
-                else:
-                    log.warn("%s failed; requeuing", job.item_id)
-                    # Requeue it!
-                    self.q.requeue(
-                        job.item_id, self.retry_time, self.max_retries)
+        log.debug("Sleeping for %s", timeout)
+        try:
+            readable = select.select(fds, [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = []
+
+        if self.wakeup_r in readable:
+            try:
+                while os.read(self.wakeup_r, 1024):
+                    pass
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+        if self.watcher.fileno() in readable:
+            self.watcher.clear()
 
     def loop(self):
         """
         Main processing loop. Read new items from the queue and run them!
         """
+        self.watcher = QueueWatcher(self.q)
+        signal.set_wakeup_fd(self.wakeup_w)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        # Don't interrupt other system calls; select() is woken up regardless
+        signal.siginterrupt(signal.SIGCHLD, False)
+
         while True:
             self.monitor()
-            if len(self.active) >= self.concurrency:
-                # Wait!
-                time.sleep(1)
+            items = []
+            if len(self.active) < self.concurrency:
+                items = self.q.pop_many(self.concurrency - len(self.active))
+            if not items:
+                self.wait(len(self.active) < self.concurrency)
                 continue
 
-            while len(self.active) < self.concurrency:
-                item = self.q.pop()
-                if not item:
-                    # Don't wait for very long, since we have to check up on
-                    # our children
-                    if self.active:
-                        self.q.wait(1)
-                    else:
-                        self.q.wait()
-                    break
-
-                item_id, fp = item
+            for item_id, fp in items:
                 try:
-                    command = json.load(fp)
-                    job = Job(command, item_id, self.q.getlog(item_id))
-                    job.max_time = self.max_time
+                    job = self.make_job(json.load(fp), item_id)
                     self.run(job)
-                except ValueError:
-                    # Couldn't parse it as json
+                except (ValueError, KeyError):
+                    # Couldn't parse it as json, or there's no command
                     # There's no hope!
-                    self.q.log(item_id, "Couldn't load json; murdering")
+                    self.q.log(item_id, "Couldn't load item; murdering")
                     self.q.murder(item_id)
                 finally:
                     fp.close()
@@ -152,6 +316,7 @@ def main():
         verbosity=0,
         logfile=None,
         max_time=60,
+        max_retry_time=3600,
     )
     parser.add_option("-q", "--queuedir", dest="queuedir")
     parser.add_option("-j", "--jobs", dest="concurrency", type="int",
@@ -159,7 +324,11 @@ def main():
     parser.add_option("-r", "--max_retries", dest="max_retries",
                       type="int", help="number of times to retry commands")
     parser.add_option("-t", "--retry_time", dest="retry_time",
-                      type="int", help="seconds to wait between retries")
+                      type="int", help="seconds to wait before the first retry; "
+                      "doubles after each attempt (default %default, "
+                      "i.e. retry immediately)")
+    parser.add_option("-T", "--max_retry_time", dest="max_retry_time",
+                      type="int", help="maximum seconds to wait between retries")
     parser.add_option("-v", "--verbose", dest="verbosity",
                       action="count", help="increase verbosity")
     parser.add_option(
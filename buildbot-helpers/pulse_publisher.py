@@ -8,12 +8,13 @@ plugin
 see https://hg.mozilla.org/users/clegnitto_mozilla.com/mozillapulse/ for pulse
 code
 """
+import os
 import time
 import re
 from datetime import tzinfo, timedelta, datetime
 
 from mozillapulse.messages.build import BuildMessage
-from mozilla_buildtools.queuedir import QueueDir
+from mozilla_buildtools.queuedir import open_queuedir
 from buildbot.util import json
 
 import logging
@@ -27,6 +28,12 @@ skip_exps = [
     re.compile("^build\.\S+\.\d+\.step\."),
 ]
 
+
+def compile_skip_exps(exps):
+    """Combines a list of compiled regular expressions into one that matches
+    whenever any of them would"""
+    return re.compile("|".join("(?:%s)" % exp.pattern for exp in exps))
+
 # A UTC class.
 
 
@@ -56,17 +63,15 @@ def transform_time(t):
 
 
 def transform_times(event):
-    """Replace epoch times in event with string representations of the time"""
+    """Replace epoch times in event with string representations of the time.
+    event is modified in place, and returned"""
     if isinstance(event, dict):
-        retval = {}
-        for key, value in event.items():
+        for key, value in event.iteritems():
             if key == 'times' and len(value) == 2:
-                retval[key] = [transform_time(t) for t in value]
-            else:
-                retval[key] = transform_times(value)
-    else:
-        retval = event
-    return retval
+                event[key] = [transform_time(t) for t in value]
+            elif isinstance(value, dict):
+                transform_times(value)
+    return event
 
 
 class PulsePusher(object):
@@ -88,15 +93,36 @@ class PulsePusher(object):
     `retry_time`       - time in seconds to wait between retries
 
     `max_retries`      - how many times to retry
+
+    `batch_size`       - how many items to take from the queue at once. All
+                         their messages are published together, and the
+                         items are only removed from the queue once all of
+                         them have been sent
+
+    `stats_file`       - where to write throughput metrics after each batch,
+                         as JSON. Set to None to disable
     """
     def __init__(self, queuedir, publisher, max_idle_time=300,
-                 max_connect_time=600, retry_time=60, max_retries=5):
-        self.queuedir = QueueDir('pulse', queuedir)
+                 max_connect_time=600, retry_time=60, max_retries=5,
+                 batch_size=50, stats_file=None):
+        self.queuedir = open_queuedir('pulse', queuedir)
         self.publisher = publisher
         self.max_idle_time = max_idle_time
         self.max_connect_time = max_connect_time
         self.retry_time = retry_time
         self.max_retries = max_retries
+        self.batch_size = batch_size
+        self.stats_file = stats_file
+
+        self.skip_re = compile_skip_exps(skip_exps)
+
+        # Totals since we started, and the rate of the last batch
+        self.stats = {
+            'sent': 0,
+            'skipped': 0,
+            'msgs_per_sec': 0.0,
+            'queue_lag': 0.0,
+        }
 
         # When should we next disconnect
         self._disconnect_timer = None
@@ -115,22 +141,25 @@ class PulsePusher(object):
             self._last_connection = time.time()
         log.debug("Sending %i messages", len(events))
         start = time.time()
-        skipped = 0
-        sent = 0
+        msgs = []
         for e in events:
-            routing_key = e['event']
-            if any(exp.search(routing_key) for exp in skip_exps):
-                skipped += 1
-                log.debug("Skipping event %s", routing_key)
+            if self.skip(e['event']):
                 continue
-            else:
-                log.debug("Sending event %s", routing_key)
-            msg = BuildMessage(transform_times(e))
-            self.publisher.publish(msg)
-            sent += 1
+            msgs.append(BuildMessage(transform_times(e)))
+        self.publish(msgs)
         end = time.time()
-        log.info("Sent %i messages in %.2fs (skipped %i)", sent,
-                 end - start, skipped)
+
+        sent = len(msgs)
+        skipped = len(events) - sent
+        self.stats['sent'] += sent
+        self.stats['skipped'] += skipped
+        if end > start:
+            self.stats['msgs_per_sec'] = sent / (end - start)
+        self.stats['queue_lag'] = self.queuedir.lag()
+        log.info("Sent %i messages in %.2fs (%.1f msgs/sec, skipped %i, queue lag %.1fs)",
+                 sent, end - start, self.stats['msgs_per_sec'], skipped,
+                 self.stats['queue_lag'])
+        self.write_stats()
         self._last_activity = time.time()
 
         # Update our timers
@@ -145,6 +174,39 @@ class PulsePusher(object):
         if t:
             self._disconnect_timer = t
 
+    def skip(self, routing_key):
+        "Returns True if events with this routing key shouldn't be sent"
+        retval = bool(self.skip_re.search(routing_key))
+        if retval:
+            log.debug("Skipping event %s", routing_key)
+        return retval
+
+    def publish(self, msgs):
+        """
+        Publishes msgs. Publishers that can send a batch of messages at once
+        and wait for them all to be confirmed do so with a publish_many()
+        method; otherwise they're published one at a time.
+        """
+        if not msgs:
+            return
+        publish_many = getattr(self.publisher, 'publish_many', None)
+        if publish_many:
+            publish_many(msgs)
+            return
+        for msg in msgs:
+            self.publisher.publish(msg)
+
+    def write_stats(self):
+        "Writes our stats to stats_file"
+        if not self.stats_file:
+            return
+        tmp_name = self.stats_file + '.tmp'
+        try:
+            json.dump(self.stats, open(tmp_name, 'w'))
+            os.rename(tmp_name, self.stats_file)
+        except (IOError, OSError):
+            log.exception("Couldn't write stats to %s", self.stats_file)
+
     def maybe_disconnect(self):
         "Disconnect from pulse if our timer has expired"
         now = time.time()
@@ -155,6 +217,43 @@ class PulsePusher(object):
             self._last_connection = None
             self._last_activity = None
 
+    def process_batch(self):
+        """
+        Reads a batch of new items from the queue and pushes their events to
+        pulse. The items are removed once all of their messages have been
+        sent, or requeued if anything goes wrong.
+
+        Returns True if there are probably more items waiting
+        """
+        items = self.queuedir.pop_many(self.batch_size)
+        item_ids = [item_id for item_id, fp in items]
+        events = []
+        # If we got a full batch there are probably more waiting
+        come_back_soon = len(items) >= self.batch_size
+        try:
+            for item_id, fp in items:
+                try:
+                    log.debug("Loading %s", item_id)
+                    events.extend(json.load(fp))
+                except:
+                    log.exception("Error loading %s", item_id)
+                    raise
+                finally:
+                    fp.close()
+            log.info("Loaded %i events", len(events))
+            self.send(events)
+            log.info("Removing %i items", len(item_ids))
+            # Somebody may have (re-)moved some already, that's ok!
+            self.queuedir.remove_many(item_ids)
+        except:
+            log.exception("Error processing messages")
+            # Don't try again soon, something has gone horribly wrong!
+            come_back_soon = False
+            for item_id in item_ids:
+                self.queuedir.requeue(
+                    item_id, self.retry_time, self.max_retries)
+        return come_back_soon
+
     def loop(self):
         """
         Main processing loop. Read new items from the queue, push them to
@@ -163,47 +262,7 @@ class PulsePusher(object):
         while True:
             self.maybe_disconnect()
 
-            # Grab any new events
-            item_ids = []
-            events = []
-            come_back_soon = False
-            try:
-                while True:
-                    item = self.queuedir.pop()
-                    if not item:
-                        break
-                    if len(events) > 50:
-                        come_back_soon = True
-                        break
-
-                    try:
-                        item_id, fp = item
-                        item_ids.append(item_id)
-                        log.debug("Loading %s", item)
-                        events.extend(json.load(fp))
-                    except:
-                        log.exception("Error loading %s", item_id)
-                        raise
-                    finally:
-                        fp.close()
-                log.info("Loaded %i events", len(events))
-                self.send(events)
-                for item_id in item_ids:
-                    log.info("Removing %s", item_id)
-                    try:
-                        self.queuedir.remove(item_id)
-                    except OSError:
-                        # Somebody (re-)moved it already, that's ok!
-                        pass
-            except:
-                log.exception("Error processing messages")
-                # Don't try again soon, something has gone horribly wrong!
-                come_back_soon = False
-                for item_id in item_ids:
-                    self.queuedir.requeue(
-                        item_id, self.retry_time, self.max_retries)
-
-            if come_back_soon:
+            if self.process_batch():
                 # Let's do more right now!
                 log.info("Doing more!")
                 continue
@@ -231,6 +290,8 @@ def main():
         logfile=None,
         max_retries=5,
         retry_time=60,
+        batch_size=50,
+        stats_file=None,
     )
     parser.add_option("--passwords", dest="passwords")
     parser.add_option("-q", "--queuedir", dest="queuedir")
@@ -242,6 +303,10 @@ def main():
                       help="number of times to retry")
     parser.add_option("-t", "--retry_time", dest="retry_time", type="int",
                       help="seconds to wait between retries")
+    parser.add_option("-b", "--batch_size", dest="batch_size", type="int",
+                      help="number of queue items to publish at once")
+    parser.add_option("--stats", dest="stats_file",
+                      help="file to write throughput metrics to")
 
     options, args = parser.parse_args()
 
@@ -281,7 +346,8 @@ def main():
         exchange=passwords['PULSE_EXCHANGE'])
 
     pusher = PulsePusher(options.queuedir, publisher,
-                         max_retries=options.max_retries, retry_time=options.retry_time)
+                         max_retries=options.max_retries, retry_time=options.retry_time,
+                         batch_size=options.batch_size, stats_file=options.stats_file)
     pusher.loop()
 
 if __name__ == '__main__':
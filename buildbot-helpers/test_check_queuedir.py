@@ -0,0 +1,33 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mozilla_buildtools.queuedir import QueueDir
+from check_queuedir import queuedir_state
+
+
+class TestQueuedirState(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.q = QueueDir('check', self.tmpdir)
+        self.q.add("a")
+        self.q.add("b")
+        self.state_file = os.path.join(self.tmpdir, 'state')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testStateFile(self):
+        state = queuedir_state(self.tmpdir)
+        self.assertEquals((state['new'], state['added'], state['dead']), (2, 2, 0))
+
+    def testBadStateFile(self):
+        # Created but not written yet, cut short, or garbled: the queue is
+        # scanned instead
+        data = open(self.state_file).read()
+        for bad in "", data[:len(data) // 2], "new\n" + data, data.replace("dead 0", "dead zero"):
+            open(self.state_file, 'w').write(bad)
+            state = queuedir_state(self.tmpdir)
+            self.assertEquals((state['new'], state['dead']), (2, 0))
+            self.assertTrue(state['oldest'] is not None)
@@ -0,0 +1,77 @@
+from nose import SkipTest
+try:
+    from command_runner import CommandRunner, queue_command
+except ImportError:
+    # Needs buildbot
+    raise SkipTest
+
+import json
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from mozilla_buildtools.queuedir import ShardedQueueDir, QueueWatcher
+
+
+class Options(object):
+    concurrency = 1
+    max_retries = 1
+    retry_time = 0
+    max_retry_time = 3600
+    max_time = 60
+
+    def __init__(self, queuedir):
+        self.queuedir = queuedir
+
+
+class TestCommandRunner(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.runner = None
+
+    def tearDown(self):
+        if self.runner:
+            for job in self.runner.active.values():
+                job.proc.kill()
+                job.proc.wait()
+        shutil.rmtree(self.tmpdir)
+
+    def testMakeJobDefaults(self):
+        runner = self.runner = CommandRunner(Options(self.tmpdir))
+        job = runner.make_job({"command": ["true"], "max_time": None,
+                               "retry_time": 5}, "item")
+        self.assertEquals(job.max_time, 60)
+        self.assertEquals(job.retry_time, 5)
+        self.assertEquals(job.max_retries, 1)
+        job.started = 100
+        self.assertEquals(job.deadline(), 160)
+
+    def testMakeJobBadField(self):
+        runner = self.runner = CommandRunner(Options(self.tmpdir))
+        self.assertRaises(ValueError, runner.make_job,
+                          {"command": ["true"], "max_time": "soon"}, "item")
+
+    def testBusyRunnerKeepsLeases(self):
+        producer = ShardedQueueDir('commands', self.tmpdir, shards=1)
+        queue_command(producer, ['sleep', '30'])
+
+        runner = self.runner = CommandRunner(Options(self.tmpdir))
+        runner.q.lease_time = 1
+        runner.watcher = QueueWatcher(runner.q)
+        for item_id, fp in runner.q.pop_many(1):
+            runner.run(runner.make_job(json.load(fp), item_id))
+            fp.close()
+        self.assertEquals(len(runner.active), 1)
+        self.assertEquals(runner.q.leases, set([0]))
+
+        # The runner is at full concurrency, so it doesn't pop any more
+        # items, but it has to keep its lease while the job runs
+        end = time.time() + 3 * runner.q.lease_time
+        while time.time() < end:
+            runner.monitor()
+            runner.wait(False)
+        self.assertEquals(runner.q.leases, set([0]))
+        other = ShardedQueueDir('commands', self.tmpdir)
+        other.consumer_id = 'other'
+        self.assertFalse(other._acquire(0, time.time()))
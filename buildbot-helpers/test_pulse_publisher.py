@@ -0,0 +1,79 @@
+from nose import SkipTest
+try:
+    from pulse_publisher import PulsePusher
+except ImportError:
+    # Needs mozillapulse and buildbot
+    raise SkipTest
+
+import os
+import json
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mozilla_buildtools.queuedir import QueueDir
+
+
+class FakePublisher(object):
+    """Publishes batches of messages, and records how many queue items were
+    still in cur, i.e. not yet removed, when each batch was sent"""
+    def __init__(self, q, fail=False):
+        self.q = q
+        self.fail = fail
+        self.batches = []
+
+    def publish_many(self, msgs):
+        self.batches.append((len(msgs), len(os.listdir(self.q.cur_dir))))
+        if self.fail:
+            raise IOError("connection lost")
+
+
+class SinglePublisher(object):
+    """Publishes one message at a time"""
+    def __init__(self):
+        self.published = []
+
+    def publish(self, msg):
+        self.published.append(msg)
+
+
+class TestPulsePusher(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.q = QueueDir('pulse', self.tmpdir)
+        for i in range(5):
+            self.q.add(json.dumps([
+                {'event': 'build.foo.%i.finished' % i, 'payload': {'times': [0, 1]}},
+                {'event': 'build.foo.%i.step.compile.finished' % i, 'payload': {}},
+            ]))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testBatchRemovedAfterSending(self):
+        publisher = FakePublisher(self.q)
+        pusher = PulsePusher(self.tmpdir, publisher, batch_size=3)
+        self.assertTrue(pusher.process_batch())
+        self.assertFalse(pusher.process_batch())
+        # Step events are skipped; the items were all still there while
+        # their batch was being sent
+        self.assertEquals(publisher.batches, [(3, 3), (2, 2)])
+        self.assertEquals(os.listdir(self.q.cur_dir), [])
+        self.assertEquals(os.listdir(self.q.new_dir), [])
+        self.assertEquals(pusher.stats['sent'], 5)
+        self.assertEquals(pusher.stats['skipped'], 5)
+
+    def testBatchRequeuedOnFailure(self):
+        publisher = FakePublisher(self.q, fail=True)
+        pusher = PulsePusher(self.tmpdir, publisher, batch_size=10)
+        self.assertFalse(pusher.process_batch())
+        self.assertEquals(publisher.batches, [(5, 5)])
+        self.assertEquals(os.listdir(self.q.cur_dir), [])
+        self.assertEquals(len(os.listdir(self.q.delayed_dir)), 5)
+
+    def testPublishOneAtATime(self):
+        publisher = SinglePublisher()
+        pusher = PulsePusher(self.tmpdir, publisher, batch_size=10)
+        pusher.process_batch()
+        self.assertEquals(len(publisher.published), 5)
+        self.assertEquals(os.listdir(self.q.new_dir), [])
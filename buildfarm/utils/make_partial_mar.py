@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""%prog [options] from.mar to.mar partial.mar
+
+Creates a partial update MAR that updates the contents of the complete MAR
+from.mar to those of the complete MAR to.mar.
+
+Members that are stored identically in both MARs are skipped without being
+extracted. Changed members are diffed with mbsdiff in parallel, and added as
+patches when those are smaller than the compressed file."""
+import os
+import hashlib
+import shutil
+import tempfile
+from StringIO import StringIO
+from subprocess import Popen, PIPE, STDOUT
+
+from mar import BZ2MarFile, MarFile, compress_file
+
+import logging
+log = logging.getLogger(__name__)
+
+# Members of complete MARs that describe the update itself rather than
+# being part of the application
+MANIFESTS = ('updatev2.manifest', 'updatev3.manifest')
+
+
+def stored_digest(mar, member):
+    """Returns the sha1 of `member`'s data as it is stored in `mar`, i.e.
+    without decompressing it"""
+    h = hashlib.new('sha1')
+    for block in mar._iter_blocks(member):
+        h.update(block)
+    return h.hexdigest()
+
+
+def compare_mars(from_mar, to_mar):
+    """Compares the members of MarFiles `from_mar` and `to_mar`.
+
+    Returns lists of (added, changed, removed) members, where `added` and
+    `changed` are members of to_mar, and `removed` are members of from_mar.
+    Members are compared by the digest of their stored data, so members
+    compressed the same way don't need to be extracted."""
+    old = dict((m.name, m) for m in from_mar.members if m.name not in MANIFESTS)
+    added = []
+    changed = []
+    for m in to_mar.members:
+        if m.name in MANIFESTS:
+            continue
+        if m.name not in old:
+            added.append(m)
+            continue
+        o = old.pop(m.name)
+        if o.size != m.size or o.flags != m.flags or \
+                stored_digest(from_mar, o) != stored_digest(to_mar, m):
+            changed.append(m)
+    removed = sorted(old.values(), key=lambda m: m.name)
+    return added, changed, removed
+
+
+# The MARs being diffed by this worker process; see make_partial
+_worker_mars = None
+
+
+def _init_diff_worker(from_mar, to_mar):
+    global _worker_mars
+    # Use our own file descriptors rather than sharing the parent's
+    for m in from_mar, to_mar:
+        m.fileobj = open(m.name, 'rb')
+    _worker_mars = from_mar, to_mar
+
+
+def _diff_worker(args):
+    """Diffs one changed member, and returns the name of a temporary file
+    holding the compressed patch, or None if the patch isn't any smaller than
+    the compressed file"""
+    old_member, new_member, tmpdir, mbsdiff = args
+    from_mar, to_mar = _worker_mars
+    d = tempfile.mkdtemp(dir=tmpdir)
+    try:
+        from_mar.extract(old_member, os.path.join(d, 'old'))
+        to_mar.extract(new_member, os.path.join(d, 'new'))
+        patch = os.path.join(d, 'patch')
+        proc = Popen([mbsdiff,
+                      os.path.join(d, 'old', old_member.name),
+                      os.path.join(d, 'new', new_member.name),
+                      patch], stdout=PIPE, stderr=STDOUT)
+        output = proc.communicate()[0]
+        if proc.returncode != 0:
+            raise OSError("%s failed for %s: %s" % (mbsdiff, new_member.name, output))
+
+        fd, tmpname = tempfile.mkstemp(dir=tmpdir)
+        output = os.fdopen(fd, 'wb')
+        size = compress_file(patch, output)
+        output.close()
+        if size >= new_member.size:
+            os.unlink(tmpname)
+            return None
+        return tmpname
+    finally:
+        shutil.rmtree(d)
+
+
+def make_partial(from_name, to_name, partial_name, mbsdiff='mbsdiff', jobs=1,
+                 signature_versions=[]):
+    """Creates a partial MAR `partial_name` that updates the complete MAR
+    `from_name` to `to_name`, diffing changed members with `jobs` processes.
+
+    Returns the lines of the partial's update manifest."""
+    from multiprocessing import Pool
+    from_mar = BZ2MarFile(from_name)
+    to_mar = BZ2MarFile(to_name)
+    added, changed, removed = compare_mars(from_mar, to_mar)
+    log.info("%i members added, %i changed, %i removed, %i unchanged",
+             len(added), len(changed), len(removed),
+             len(to_mar.members) - len(added) - len(changed))
+
+    old = dict((m.name, m) for m in from_mar.members)
+    tmpdir = tempfile.mkdtemp()
+    pool = Pool(max(jobs, 1), _init_diff_worker, (from_mar, to_mar))
+    partial = BZ2MarFile(partial_name, 'w', signature_versions=signature_versions)
+    manifest = ['type "partial"']
+    try:
+        # Start the big ones first so they don't hold up the end of the run
+        changed.sort(key=lambda m: m.size, reverse=True)
+        results = pool.imap(_diff_worker,
+                            [(old[m.name], m, tmpdir, mbsdiff) for m in changed])
+        for m, patch in zip(changed, results):
+            if patch:
+                MarFile.add(partial, patch, name=m.name + '.patch', flags=m.flags)
+                os.unlink(patch)
+                manifest.append('patch "%s.patch" "%s"' % (m.name, m.name))
+            else:
+                partial.copy_member(to_mar, m)
+                manifest.append('add "%s"' % m.name)
+        pool.close()
+
+        for m in added:
+            partial.copy_member(to_mar, m)
+            manifest.append('add "%s"' % m.name)
+        for m in removed:
+            manifest.append('remove "%s"' % m.name)
+
+        partial.add('updatev2.manifest', fileobj=StringIO("\n".join(manifest) + "\n"),
+                    mode=0644)
+        partial.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        shutil.rmtree(tmpdir)
+    return manifest
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+
+    parser = OptionParser(__doc__)
+    parser.set_defaults(
+        mbsdiff=os.environ.get('MBSDIFF', 'mbsdiff'),
+        jobs=1,
+        keyfile=None,
+        manifest=None,
+    )
+    parser.add_option("--mbsdiff", dest="mbsdiff",
+                      help="path to mbsdiff; defaults to $MBSDIFF")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int",
+                      help="number of members to diff at once")
+    parser.add_option("-k", "--keyfile", dest="keyfile",
+                      help="sign the partial with the given key")
+    parser.add_option("-m", "--manifest", dest="manifest",
+                      help="also write the update manifest to this file")
+
+    options, args = parser.parse_args()
+    if len(args) != 3:
+        parser.error("You must specify the from, to and partial MARs")
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    signatures = []
+    if options.keyfile:
+        signatures.append((1, options.keyfile))
+
+    manifest = make_partial(args[0], args[1], args[2], options.mbsdiff,
+                            options.jobs, signatures)
+    if options.manifest:
+        open(options.manifest, 'w').write("\n".join(manifest) + "\n")
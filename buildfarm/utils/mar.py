@@ -12,11 +12,20 @@ Utility for managing mar files"""
 
 import struct
 import os
+import mmap
 import bz2
 import hashlib
 import tempfile
+import shutil
+from binascii import hexlify, unhexlify
 from subprocess import Popen, PIPE
 
+try:
+    from Crypto.PublicKey import RSA
+except ImportError:
+    # Signatures are verified with openssl instead
+    RSA = None
+
 
 def rsa_sign(digest, keyfile):
     proc = Popen(['openssl', 'pkeyutl', '-sign', '-inkey', keyfile],
@@ -27,7 +36,43 @@ def rsa_sign(digest, keyfile):
     return sig
 
 
+# Public keys loaded by load_public_key, by filename
+_public_keys = {}
+
+
+def load_public_key(keyfile):
+    """Returns the RSA key in `keyfile`, or None if it can't be loaded
+    in-process"""
+    if RSA is None:
+        return None
+    if keyfile not in _public_keys:
+        try:
+            _public_keys[keyfile] = RSA.importKey(open(keyfile).read())
+        except (ValueError, IndexError, TypeError):
+            _public_keys[keyfile] = None
+    return _public_keys[keyfile]
+
+
+def rsa_verify_key(digest, signature, key):
+    """Returns True if `signature` is `key`'s signature of `digest`, as
+    created by rsa_sign (i.e. `digest` with PKCS#1 v1.5 padding, without a
+    DigestInfo)"""
+    size = (key.n.bit_length() + 7) // 8
+    if len(signature) != size:
+        return False
+    s = long(hexlify(signature), 16)
+    if s >= key.n:
+        return False
+    em = unhexlify("%0*x" % (size * 2, pow(s, key.e, key.n)))
+    padding = size - 3 - len(digest)
+    return padding >= 8 and em == "\x00\x01" + "\xff" * padding + "\x00" + digest
+
+
 def rsa_verify(digest, signature, keyfile):
+    key = load_public_key(keyfile)
+    if key is not None:
+        return rsa_verify_key(digest, signature, key)
+
     tmp = tempfile.NamedTemporaryFile()
     tmp.write(signature)
     tmp.flush()
@@ -36,6 +81,7 @@ def rsa_verify(digest, signature, keyfile):
     proc.stdin.write(digest)
     proc.stdin.close()
     data = proc.stdout.read()
+    proc.wait()
     return "Signature Verified Successfully" in data
 
 
@@ -47,6 +93,37 @@ def unpackint(s):
     return struct.unpack(">L", s)[0]
 
 
+# How much of a file to map at once when walking through it. Each window is
+# unmapped before mapping the next, so memory use doesn't grow with the size
+# of the file
+WINDOW_SIZE = 16 * 1024 * 1024
+
+
+def map_range(fileno, offset, size):
+    """Returns a read-only buffer of `size` bytes of the file open as
+    `fileno`, starting at `offset`. The buffer has its own memory mapping,
+    which is released once the buffer is no longer referenced."""
+    if size == 0:
+        return buffer("")
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    m = mmap.mmap(fileno, offset + size - start, access=mmap.ACCESS_READ,
+                  offset=start)
+    return buffer(m, offset - start, size)
+
+
+def iter_mapped(fileno, offset, size, blocksize=512 * 1024):
+    """Yields the `size` bytes of the file open as `fileno` starting at
+    `offset` as buffers of at most `blocksize` bytes, without reading them
+    into strings."""
+    window_size = max(WINDOW_SIZE - WINDOW_SIZE % blocksize, blocksize)
+    for window_offset in xrange(0, size, window_size):
+        window = map_range(fileno, offset + window_offset,
+                           min(window_size, size - window_offset))
+        for i in xrange(0, len(window), blocksize):
+            yield buffer(window, i, blocksize)
+        del window
+
+
 def generate_signature(fp, updatefunc):
     fp.seek(0)
     # Magic
@@ -79,6 +156,55 @@ def generate_signature(fp, updatefunc):
         updatefunc(block)
 
 
+# The MarFile being extracted by this worker process; see
+# MarFile.extractall
+_worker_mar = None
+
+
+def _init_extract_worker(mar):
+    global _worker_mar
+    # Use our own file descriptor rather than sharing the parent's
+    mar.fileobj = open(mar.name, 'rb')
+    _worker_mar = mar
+
+
+def _extract_worker(args):
+    member, path = args
+    _worker_mar.extract(member, path)
+    return member.name
+
+
+def compress_file(path, output):
+    """Writes the contents of `path` to open file `output`, compressed the
+    same way BZ2MarFile.add does. Returns the compressed size."""
+    f = open(path, 'rb')
+    comp = bz2.BZ2Compressor(9)
+    size = 0
+    while True:
+        block = f.read(512 * 1024)
+        if not block:
+            break
+        block = comp.compress(block)
+        size += len(block)
+        output.write(block)
+    block = comp.flush()
+    size += len(block)
+    output.write(block)
+    f.close()
+    return size
+
+
+def _compress_worker(args):
+    """Compresses `path` into a temporary file in `tmpdir`, and returns the
+    temporary file's name"""
+    path, tmpdir = args
+    fd, tmpname = tempfile.mkstemp(dir=tmpdir)
+    output = os.fdopen(fd, 'wb')
+    compress_file(path, output)
+    output.close()
+    return tmpname
+
+
 class MarSignature:
     """Represents a signature"""
     size = None
@@ -112,11 +238,14 @@ class MarSignature:
     def update(self, data):
         self._hsh.update(data)
 
-    def verify_signature(self):
+    def verify_signature(self, digest=None):
+        """Verifies the signature against `digest`, or the digest of the data
+        passed to update() if it's not set"""
+        if digest is None:
+            digest = self._hsh.digest()
         if self.algo_id == 1:
-            print "digest is", self._hsh.hexdigest()
             assert self.keyfile
-            return rsa_verify(self._hsh.digest(), self.signature, self.keyfile)
+            return rsa_verify(digest, self.signature, self.keyfile)
 
     def write_signature(self, fp):
         assert self.keyfile
@@ -172,6 +301,21 @@ class MarInfo:
         self.name = name
         return self
 
+    @classmethod
+    def from_buffer(cls, buf, offset):
+        """Return a MarInfo object parsed from `buf` at `offset`, and the
+        offset of the byte following it"""
+        self = cls()
+        if offset + 12 > len(buf):
+            raise ValueError("Malformed mar?")
+        self._offset, self.size, self.flags = struct.unpack_from(
+            cls._member_fmt, buf, offset)
+        name_end = buf.find("\x00", offset + 12)
+        if name_end < 0:
+            raise ValueError("Malformed mar?")
+        self.name = buf[offset + 12:name_end]
+        return self, name_end + 1
+
     def __repr__(self):
         return "<%s %o %s bytes starting at %i>" % (
             self.name, self.flags, self.size, self._offset)
@@ -187,9 +331,14 @@ class MarFile:
     `name`:     filename of MAR file
     `mode`:     either 'r' or 'w', depending on if you're reading or writing.
                 defaults to 'r'
+
+    Member data of MAR files opened for reading is accessed through memory
+    mappings rather than being read into memory first.
     """
 
     _longint_fmt = ">L"
+    # How much member data to handle at once when extracting
+    _blocksize = 512 * 1024
 
     def __init__(self, name, mode="r", signature_versions=[]):
         if mode not in "rw":
@@ -220,10 +369,9 @@ class MarFile:
             # Read the file's index
             self._read_index()
         elif mode == "w":
-            # Create placeholder signatures
-            if signature_versions:
-                # Space for num_signatures and file size
-                self.index_offset += 4 + 8
+            # Space for num_signatures and file size, which are written
+            # whether or not the file is signed
+            self.index_offset += 4 + 8
 
             # Write the magic and placeholder for the index
             self.fileobj.write("MAR1" + packint(self.index_offset))
@@ -248,24 +396,27 @@ class MarFile:
 
     def _read_index(self):
         fp = self.fileobj
+        self._filesize = os.fstat(fp.fileno()).st_size
         fp.seek(0)
         # Read the header
         header = fp.read(8)
+        if len(header) != 8:
+            raise ValueError("Bad magic")
         magic, self.index_offset = struct.unpack(">4sL", header)
         if magic != "MAR1":
             raise ValueError("Bad magic")
         fp.seek(self.index_offset)
 
         # Read the index_size, we don't use it though
-        # We just read all the info sections from here to the end of the file
+        # We just parse all the info sections from here to the end of the file
         fp.read(4)
+        index = fp.read()
 
         self.members = []
 
-        while True:
-            info = MarInfo.from_fileobj(fp)
-            if not info:
-                break
+        offset = 0
+        while offset < len(index):
+            info, offset = MarInfo.from_buffer(index, offset)
             self.members.append(info)
 
         # Sort them by where they are in the file
@@ -287,16 +438,30 @@ class MarFile:
                     print "no key specified to validate %i signature" % sig.algo_id
                 self.signatures.append(sig)
 
+    def signature_digest(self):
+        """Returns the digest that the file's signatures sign. All supported
+        signature algorithms sign the same sha1, so the file is only read
+        once however many signatures it has."""
+        h = hashlib.new('sha1')
+        generate_signature(self.fileobj, h.update)
+        return h.digest()
+
+    def failed_signatures(self):
+        """Returns the signatures that don't verify"""
+        if not self.signatures:
+            return []
+        digest = self.signature_digest()
+        return [sig for sig in self.signatures if not sig.verify_signature(digest)]
+
     def verify_signatures(self):
         if not self.signatures:
             return
 
-        fp = self.fileobj
-
-        generate_signature(fp, self._update_signatures)
+        digest = self.signature_digest()
+        print "digest is", hexlify(digest)
 
         for sig in self.signatures:
-            if not sig.verify_signature():
+            if not sig.verify_signature(digest):
                 raise IOError("Verification failed")
             else:
                 print "Verification OK (%s)" % sig.algo_id
@@ -329,7 +494,10 @@ class MarFile:
         if not fileobj:
             info.name = name or os.path.normpath(path)
             info.size = os.path.getsize(path)
-            info.flags = flags or os.stat(path).st_mode & 0777
+            if flags is not None:
+                info.flags = flags
+            else:
+                info.flags = os.stat(path).st_mode & 0777
             info._offset = self.index_offset
 
             f = open(path, 'rb')
@@ -340,7 +508,7 @@ class MarFile:
                     break
                 self.fileobj.write(block)
         else:
-            assert flags
+            assert flags is not None
             info.name = name or path
             info.size = 0
             info.flags = flags
@@ -358,37 +526,89 @@ class MarFile:
         self.rewrite_index = True
         self.members.append(info)
 
+    def copy_member(self, other, member, name=None):
+        """Adds `member` of the MarFile `other` to this MAR file as it is
+        stored there, i.e. without decompressing and recompressing it.
+
+        If `name` is set, the member is named with `name` in this MAR."""
+        if self.mode != "w":
+            raise ValueError("File not opened for writing")
+        info = MarInfo()
+        info.name = name or member.name
+        info.size = member.size
+        info.flags = member.flags
+        info._offset = self.index_offset
+        self.fileobj.seek(self.index_offset)
+        for block in other._iter_blocks(member):
+            self.fileobj.write(block)
+
+        self.index_offset += info.size
+        self.rewrite_index = True
+        self.members.append(info)
+
     def add_dir(self, path):
         """Add all of the files under `path` to the MAR file"""
         for root, dirs, files in os.walk(path):
             for f in files:
                 self.add(os.path.join(root, f))
 
+    def _expand_paths(self, paths):
+        """Returns the files that adding `paths` would add, in order"""
+        retval = []
+        for path in paths:
+            if os.path.isdir(path):
+                for root, dirs, files in os.walk(path):
+                    for f in files:
+                        retval.append(os.path.join(root, f))
+            else:
+                retval.append(path)
+        return retval
+
+    def add_files(self, paths, jobs=1):
+        """Adds each of `paths`, which may be files or directories, to this
+        MAR file in order.
+
+        `jobs` is the number of processes to prepare members with. Subclasses
+        that compress members do so in parallel; the result is the same as
+        adding the files one at a time."""
+        for path in paths:
+            self.add(path)
+
     def close(self):
         """Close the MAR file, writing out the new index if required.
 
         Furthur modifications to the file are not allowed."""
-        if self.mode == "w" and self.rewrite_index:
-            self._write_index()
-
-        # Update file size
-        self.fileobj.seek(0, 2)
-        totalsize = self.fileobj.tell()
-        self.fileobj.seek(8)
-        # print "File size is", totalsize, repr(struct.pack(">Q", totalsize))
-        self.fileobj.write(struct.pack(">Q", totalsize))
-
-        if self.mode == "w" and self.signatures:
-            self.fileobj.flush()
-            fileobj = open(self.name, 'rb')
-            generate_signature(fileobj, self._update_signatures)
-            for sig in self.signatures:
-                # print sig._offset
-                sig.write_signature(self.fileobj)
+        if self.mode == "w":
+            if self.rewrite_index:
+                self._write_index()
+
+            # Update file size
+            self.fileobj.seek(0, 2)
+            totalsize = self.fileobj.tell()
+            self.fileobj.seek(8)
+            # print "File size is", totalsize, repr(struct.pack(">Q", totalsize))
+            self.fileobj.write(struct.pack(">Q", totalsize))
+
+            if self.signatures:
+                # The digest covers the header, which isn't final until now,
+                # so the data has to be hashed after it's all been written
+                self.fileobj.flush()
+                fileobj = open(self.name, 'rb')
+                generate_signature(fileobj, self._update_signatures)
+                fileobj.close()
+                for sig in self.signatures:
+                    # print sig._offset
+                    sig.write_signature(self.fileobj)
 
         self.fileobj.close()
         self.fileobj = None
 
+    def __getstate__(self):
+        # Open files can't be pickled; extract workers open their own
+        state = self.__dict__.copy()
+        state['fileobj'] = None
+        return state
+
     def __del__(self):
         """Close the file when we're garbage collected"""
         if self.fileobj:
@@ -412,13 +632,57 @@ class MarFile:
         self.fileobj.seek(4)
         self.fileobj.write(packint(self.index_offset))
 
-    def extractall(self, path=".", members=None):
+    def _check_range(self, offset, size):
+        """Checks that `size` bytes starting at `offset` can be read"""
+        if self.mode != "r":
+            raise ValueError("File not opened for reading")
+        if offset + size > self._filesize:
+            raise ValueError("Malformed mar?")
+
+    def member_data(self, member):
+        """Returns a read-only buffer of `member`'s data as stored in the MAR
+        (i.e. still compressed for BZ2MarFile). The data isn't copied; it is
+        paged in from the file as it's accessed."""
+        self._check_range(member._offset, member.size)
+        return map_range(self.fileobj.fileno(), member._offset, member.size)
+
+    def _iter_blocks(self, member, blocksize=None):
+        """Yields `member`'s data in buffers of at most `blocksize` bytes"""
+        self._check_range(member._offset, member.size)
+        return iter_mapped(self.fileobj.fileno(), member._offset, member.size,
+                           blocksize or self._blocksize)
+
+    def extractall(self, path=".", members=None, jobs=1):
         """Extracts members into `path`. If members is None (the default), then
-        all members are extracted."""
+        all members are extracted.
+
+        If `jobs` is greater than 1, members are extracted by a pool of that
+        many processes, largest members first."""
         if members is None:
             members = self.members
-        for m in members:
-            self.extract(m, path)
+        if jobs <= 1 or len(members) <= 1:
+            for m in members:
+                self.extract(m, path)
+            return
+
+        from multiprocessing import Pool
+        # Create the directories up front so workers don't race to do it
+        for d in set(os.path.dirname(os.path.join(path, m.name)) for m in members):
+            if not os.path.exists(d):
+                os.makedirs(d)
+        # Start the big ones first so they don't hold up the end of the run
+        members = sorted(members, key=lambda m: m.size, reverse=True)
+        pool = Pool(jobs, _init_extract_worker, (self,))
+        try:
+            for name in pool.imap_unordered(_extract_worker,
+                                            [(m, path) for m in members]):
+                pass
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
 
     def extract(self, member, path="."):
         """Extract `member` into `path` which defaults to the current
@@ -428,36 +692,33 @@ class MarFile:
         if not os.path.exists(dirname):
             os.makedirs(dirname)
 
-        self.fileobj.seek(member._offset)
-        open(dstpath, "wb").write(self.fileobj.read(member.size))
+        output = open(dstpath, "wb")
+        for block in self._iter_contents(member):
+            output.write(block)
+        output.close()
         os.chmod(dstpath, member.flags)
 
+    def _iter_contents(self, member):
+        """Yields the contents of `member` in blocks"""
+        return self._iter_blocks(member)
+
+    def member_digest(self, member):
+        """Returns the sha1 of `member`'s contents, without extracting it"""
+        h = hashlib.new('sha1')
+        for block in self._iter_contents(member):
+            h.update(block)
+        return h.hexdigest()
+
 
 class BZ2MarFile(MarFile):
     """Subclass of MarFile that compresses/decompresses members using BZ2.
 
     BZ2 compression is used for most update MARs."""
-    def extract(self, member, path="."):
-        """Extract and decompress `member` into `path` which defaults to the
-        current directory."""
-        dstpath = os.path.join(path, member.name)
-        dirname = os.path.dirname(dstpath)
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
-
-        self.fileobj.seek(member._offset)
+    def _iter_contents(self, member):
+        """Yields the decompressed contents of `member` in blocks"""
         decomp = bz2.BZ2Decompressor()
-        output = open(dstpath, "wb")
-        toread = member.size
-        while True:
-            thisblock = min(128 * 1024, toread)
-            block = self.fileobj.read(thisblock)
-            if not block:
-                break
-            toread -= len(block)
-            output.write(decomp.decompress(block))
-        output.close()
-        os.chmod(dstpath, member.flags)
+        for block in self._iter_blocks(member, 128 * 1024):
+            yield decomp.decompress(block)
 
     def add(self, path, name=None, fileobj=None, mode=None):
         """Adds `path` compressed with BZ2 to this MAR file.
@@ -506,14 +767,254 @@ class BZ2MarFile(MarFile):
         self.rewrite_index = True
         self.members.append(info)
 
+    def add_files(self, paths, jobs=1):
+        """Adds each of `paths`, which may be files or directories, to this
+        MAR file in order.
+
+        If `jobs` is greater than 1, members are compressed by a pool of
+        that many processes while this process appends them to the MAR in
+        order. The result is byte for byte the same as adding the files one
+        at a time."""
+        if self.mode != "w":
+            raise ValueError("File not opened for writing")
+        files = self._expand_paths(paths)
+        if jobs <= 1 or len(files) <= 1:
+            for f in files:
+                self.add(f)
+            return
+
+        from multiprocessing import Pool
+        tmpdir = tempfile.mkdtemp()
+        pool = Pool(jobs)
+        try:
+            # imap hands results back in order, while workers carry on
+            # compressing the members after them
+            results = pool.imap(_compress_worker, [(f, tmpdir) for f in files])
+            for path, tmpname in zip(files, results):
+                MarFile.add(self, tmpname, name=os.path.normpath(path),
+                            flags=os.stat(path).st_mode & 0777)
+                os.unlink(tmpname)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            shutil.rmtree(tmpdir)
+
+
+def _verify_worker(args):
+    marname, signature_versions = args
+    try:
+        m = MarFile(marname, signature_versions=signature_versions)
+        try:
+            if not m.signatures:
+                return "not signed"
+            for sig in m.signatures:
+                if not sig.keyfile:
+                    return "no key for signature %i" % sig.algo_id
+            failed = m.failed_signatures()
+            if failed:
+                return "verification failed (%s)" % \
+                    ", ".join(str(sig.algo_id) for sig in failed)
+            return None
+        finally:
+            m.close()
+    except Exception, e:
+        return str(e)
+
+
+def verify_mars(marnames, signature_versions, jobs=1):
+    """Verifies the signatures of each of the MAR files `marnames` with the
+    keys in `signature_versions`, a list of (algo_id, keyfile), using `jobs`
+    processes.
+
+    Each MAR is read once to compute its digest, and signatures are checked
+    in-process if PyCrypto is available.
+
+    Returns a list of (marname, error) in the same order as `marnames`,
+    where error is None if all of the MAR's signatures are valid."""
+    args = [(m, signature_versions) for m in marnames]
+    if jobs <= 1 or len(marnames) <= 1:
+        results = map(_verify_worker, args)
+    else:
+        from multiprocessing import Pool
+        pool = Pool(jobs)
+        try:
+            results = pool.map(_verify_worker, args, chunksize=8)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    return zip(marnames, results)
+
+
+def file_digest(filename):
+    """Returns the sha1 of `filename`"""
+    h = hashlib.new('sha1')
+    f = open(filename, 'rb')
+    for block in iter_mapped(f.fileno(), 0, os.fstat(f.fileno()).st_size):
+        h.update(block)
+    f.close()
+    return h.hexdigest()
+
+
+class MarManifest:
+    """Summary of the contents of a MAR file, which can be kept next to it
+    as `<marfile>.manifest` so that MARs can be compared without unpacking
+    them. The following attributes are supported:
+        `digest`:   the sha1 of the MAR file the manifest describes
+        `size`:     the size of the MAR file
+        `mtime`:    the modification time of the MAR file
+        `members`:  MarInfo objects for the MAR's members, with an additional
+                    `digest` attribute holding the sha1 of their contents
+
+    The manifest is a header line followed by one line per member:
+        MARMANIFEST1 <digest> <size> <mtime>
+        <offset> <size> <flags> <digest> <name>
+    """
+    _magic = "MARMANIFEST1"
+    suffix = ".manifest"
+
+    def __init__(self, digest, size, mtime, members):
+        self.digest = digest
+        self.size = size
+        self.mtime = mtime
+        self.members = members
+
+    @classmethod
+    def generate(cls, mar):
+        """Return a MarManifest describing `mar`, a MarFile opened for
+        reading. Members are decompressed as required to hash them, but not
+        extracted."""
+        st = os.fstat(mar.fileobj.fileno())
+        members = []
+        for m in mar.members:
+            info = MarInfo()
+            info.name, info.size, info.flags, info._offset = \
+                m.name, m.size, m.flags, m._offset
+            info.digest = mar.member_digest(m)
+            members.append(info)
+        return cls(file_digest(mar.name), st.st_size, int(st.st_mtime), members)
+
+    @classmethod
+    def load(cls, filename):
+        """Return a MarManifest read from `filename`"""
+        f = open(filename, 'r')
+        header = f.readline().split()
+        if len(header) != 4 or header[0] != cls._magic:
+            raise ValueError("Bad manifest: %s" % filename)
+        digest, size, mtime = header[1], int(header[2]), int(header[3])
+        members = []
+        for line in f:
+            offset, size_, flags, member_digest, name = \
+                line.rstrip("\n").split(" ", 4)
+            info = MarInfo()
+            info._offset, info.size, info.flags = \
+                int(offset), int(size_), int(flags, 8)
+            info.digest = member_digest
+            info.name = name
+            members.append(info)
+        f.close()
+        return cls(digest, size, mtime, members)
+
+    def save(self, filename):
+        """Writes the manifest to `filename`"""
+        tmpname = "%s.%i.tmp" % (filename, os.getpid())
+        f = open(tmpname, 'w')
+        f.write("%s %s %i %i\n" % (self._magic, self.digest, self.size, self.mtime))
+        for m in self.members:
+            f.write("%i %i %o %s %s\n" % (m._offset, m.size, m.flags, m.digest, m.name))
+        f.close()
+        os.rename(tmpname, filename)
+
+    def compare(self, other):
+        """Compares this manifest to `other`, a manifest of an older MAR.
+
+        Returns lists of (added, changed, removed) members, where `added` and
+        `changed` are members of this manifest, and `removed` are members of
+        `other`."""
+        old = dict((m.name, m) for m in other.members)
+        added = []
+        changed = []
+        for m in self.members:
+            o = old.pop(m.name, None)
+            if o is None:
+                added.append(m)
+            elif o.digest != m.digest or o.flags != m.flags:
+                changed.append(m)
+        removed = sorted(old.values(), key=lambda m: m.name)
+        return added, changed, removed
+
+
+def get_manifest(marname, mar_class=None):
+    """Returns the MarManifest of the MAR file `marname`.
+
+    The manifest is read from `marname`.manifest if its digest matches the
+    current contents of `marname`. Hashing the MAR is much cheaper than
+    decompressing all of its members, and unlike the size and mtime can't be
+    fooled by a rewrite within the same second. Otherwise it is generated,
+    using `mar_class` (default BZ2MarFile) to read members, and saved there
+    for next time if possible."""
+    mar_class = mar_class or BZ2MarFile
+    manifest_name = marname + MarManifest.suffix
+    st = os.stat(marname)
+    manifest = None
+    if os.path.exists(manifest_name):
+        try:
+            manifest = MarManifest.load(manifest_name)
+        except ValueError:
+            manifest = None
+    if manifest:
+        if manifest.size != st.st_size or manifest.digest != file_digest(marname):
+            manifest = None
+        elif manifest.mtime == int(st.st_mtime):
+            return manifest
+        else:
+            # It's only been touched
+            manifest.mtime = int(st.st_mtime)
+
+    if not manifest:
+        mar = mar_class(marname)
+        manifest = MarManifest.generate(mar)
+        mar.close()
+
+    try:
+        manifest.save(manifest_name)
+    except (IOError, OSError):
+        # We can still use it; it's just not cached
+        pass
+    return manifest
+
+
+def extract_changed(old_marname, new_marname, path=".", mar_class=None, jobs=1):
+    """Extracts the members of `new_marname` whose contents or permissions
+    differ from those in `old_marname`, or that aren't in it, into `path`.
+
+    Returns lists of (added, changed, removed) members as
+    MarManifest.compare does."""
+    mar_class = mar_class or BZ2MarFile
+    new = get_manifest(new_marname, mar_class)
+    added, changed, removed = new.compare(get_manifest(old_marname, mar_class))
+    if added or changed:
+        mar = mar_class(new_marname)
+        mar.extractall(path, added + changed, jobs=jobs)
+        mar.close()
+    return added, changed, removed
+
 if __name__ == "__main__":
+    import sys
     from optparse import OptionParser
 
     parser = OptionParser(__doc__)
     parser.set_defaults(
         action=None,
         bz2=False,
+        changed_from=None,
         chdir=None,
+        jobs=1,
         keyfile=None,
         verify=False,
     )
@@ -523,8 +1024,17 @@ if __name__ == "__main__":
                       dest="action", help="print out MAR contents")
     parser.add_option("-c", "--create", action="store_const", const="create",
                       dest="action", help="create MAR")
+    parser.add_option("-m", "--manifest", action="store_const", const="manifest",
+                      dest="action", help="print out MAR contents with their digests, "
+                      "creating marfile.manifest if required")
+    parser.add_option("-V", "--verify-all", action="store_const", const="verify",
+                      dest="action", help="verify the signatures of all of the given MARs")
+    parser.add_option("--changed-from", dest="changed_from",
+                      help="when extracting, only extract members that differ from those in this MAR")
     parser.add_option("-j", "--bzip2", action="store_true", dest="bz2",
                       help="compress/decompress members with BZ2")
+    parser.add_option("-J", "--jobs", dest="jobs", type="int",
+                      help="number of processes to extract or compress with")
     parser.add_option("-k", "--keyfile", dest="keyfile",
                       help="sign/verify with given key")
     parser.add_option("-v", "--verify", dest="verify", action="store_true",
@@ -535,13 +1045,15 @@ if __name__ == "__main__":
     options, args = parser.parse_args()
 
     if not options.action:
-        parser.error("Must specify something to do (one of -x, -t, -c)")
+        parser.error("Must specify something to do (one of -x, -t, -c, -m, -V)")
 
     if not args:
         parser.error("You must specify at least a marfile to work with")
 
     marfile, files = args[0], args[1:]
     marfile = os.path.abspath(marfile)
+    if options.changed_from:
+        options.changed_from = os.path.abspath(options.changed_from)
 
     if options.bz2:
         mar_class = BZ2MarFile
@@ -557,8 +1069,15 @@ if __name__ == "__main__":
         os.chdir(options.chdir)
 
     if options.action == "extract":
-        m = mar_class(marfile)
-        m.extractall()
+        if options.changed_from:
+            added, changed, removed = extract_changed(
+                options.changed_from, marfile, mar_class=mar_class,
+                jobs=options.jobs)
+            for m in removed:
+                print "removed: %s" % m.name
+        else:
+            m = mar_class(marfile)
+            m.extractall(jobs=options.jobs)
 
     elif options.action == "list":
         m = mar_class(marfile, signature_versions=signatures)
@@ -568,10 +1087,29 @@ if __name__ == "__main__":
         for m in m.members:
             print "%-7i %04o    %s" % (m.size, m.flags, m.name)
 
+    elif options.action == "verify":
+        if not signatures:
+            parser.error("Must specify a key to verify with")
+        failures = 0
+        for name, error in verify_mars([os.path.abspath(a) for a in args],
+                                       signatures, options.jobs):
+            if error:
+                failures += 1
+                print "%s: %s" % (name, error)
+            else:
+                print "%s: OK" % name
+        if failures:
+            sys.exit(1)
+
+    elif options.action == "manifest":
+        manifest = get_manifest(marfile, mar_class)
+        print "%-7s %-7s %-40s %-7s" % ("SIZE", "MODE", "SHA1", "NAME")
+        for m in manifest.members:
+            print "%-7i %04o    %s %s" % (m.size, m.flags, m.digest, m.name)
+
     elif options.action == "create":
         if not files:
             parser.error("Must specify at least one file to add to marfile")
         m = mar_class(marfile, "w", signature_versions=signatures)
-        for f in files:
-            m.add(f)
+        m.add_files(files, jobs=options.jobs)
         m.close()
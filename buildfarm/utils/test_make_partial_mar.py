@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mar import BZ2MarFile
+from make_partial_mar import make_partial
+
+
+def write_file(path, data):
+    d = os.path.dirname(path)
+    if d and not os.path.exists(d):
+        os.makedirs(d)
+    f = open(path, 'wb')
+    f.write(data)
+    f.close()
+
+
+class TestMakePartial(TestCase):
+    def setUp(self):
+        self.olddir = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        # Stands in for mbsdiff; its patches are tiny unless the new file
+        # is named "big"
+        write_file('mbsdiff', """#!/bin/sh
+case "$2" in
+*big) head -c 100000 /dev/urandom > "$3" ;;
+*) echo patch > "$3" ;;
+esac
+""")
+        os.chmod('mbsdiff', 0755)
+
+    def tearDown(self):
+        os.chdir(self.olddir)
+        shutil.rmtree(self.tmpdir)
+
+    def makeMar(self, name, files):
+        os.mkdir(name)
+        for f, data in files.items():
+            write_file(os.path.join(name, f), data)
+        os.chdir(name)
+        m = BZ2MarFile(os.path.join('..', name + '.mar'), 'w')
+        m.add_files(sorted(files))
+        m.close()
+        os.chdir('..')
+        return name + '.mar'
+
+    def testMakePartial(self):
+        from_mar = self.makeMar('from', {
+            'same': 'same' * 1000,
+            'changed': 'old' * 1000,
+            'big': 'old big',
+            'removed': 'removed',
+            'updatev2.manifest': 'old manifest',
+        })
+        to_mar = self.makeMar('to', {
+            'same': 'same' * 1000,
+            'changed': 'new' * 1000,
+            'big': 'new big',
+            'added': 'added',
+            'updatev2.manifest': 'new manifest',
+        })
+        for jobs in 1, 2:
+            manifest = make_partial(from_mar, to_mar, 'partial.mar', mbsdiff='./mbsdiff', jobs=jobs)
+            self.assertEquals(sorted(manifest), sorted([
+                'type "partial"',
+                'patch "changed.patch" "changed"',
+                'add "big"',
+                'add "added"',
+                'remove "removed"',
+            ]))
+
+            m = BZ2MarFile('partial.mar')
+            members = dict((i.name, i) for i in m.members)
+            self.assertEquals(sorted(members), ['added', 'big', 'changed.patch', 'updatev2.manifest'])
+            self.assertEquals("".join(m._iter_contents(members['changed.patch'])), 'patch\n')
+            self.assertEquals("".join(m._iter_contents(members['big'])), 'new big')
+            self.assertEquals("".join(m._iter_contents(members['updatev2.manifest'])),
+                              "\n".join(manifest) + "\n")
+            m.close()
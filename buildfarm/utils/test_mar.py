@@ -0,0 +1,392 @@
+import hashlib
+import logging
+import mmap
+import os
+import shutil
+import stat
+import struct
+import tempfile
+import time
+from subprocess import check_call
+from unittest import TestCase
+
+from nose import SkipTest
+
+import mar
+from mar import MarFile, BZ2MarFile, MarManifest, get_manifest, extract_changed, \
+    verify_mars, rsa_sign, rsa_verify, rsa_verify_key, load_public_key, map_range, iter_mapped
+
+log = logging.getLogger(__name__)
+
+
+def write_file(path, data):
+    d = os.path.dirname(path)
+    if d and not os.path.exists(d):
+        os.makedirs(d)
+    f = open(path, 'wb')
+    f.write(data)
+    f.close()
+
+
+def read_file(path):
+    f = open(path, 'rb')
+    data = f.read()
+    f.close()
+    return data
+
+
+# Directory holding the keys made by make_keys, shared by all of the tests
+_keydir = None
+
+
+def make_keys():
+    """Returns the filenames of a 2048 bit RSA private key and its public
+    key, generated with openssl the first time this is called"""
+    global _keydir
+    if _keydir is None:
+        _keydir = tempfile.mkdtemp()
+        key, pub = os.path.join(_keydir, 'key.pem'), os.path.join(_keydir, 'pub.pem')
+        devnull = open(os.devnull, 'w')
+        try:
+            check_call(['openssl', 'genrsa', '-out', key, '2048'], stderr=devnull)
+            check_call(['openssl', 'rsa', '-in', key, '-pubout', '-out', pub], stderr=devnull)
+        except OSError:
+            # No openssl
+            shutil.rmtree(_keydir)
+            _keydir = False
+        devnull.close()
+    if not _keydir:
+        raise SkipTest
+    return os.path.join(_keydir, 'key.pem'), os.path.join(_keydir, 'pub.pem')
+
+
+def peak_rss():
+    """Returns this process's peak resident set size in kB since the last
+    call to reset_peak_rss"""
+    for line in open('/proc/self/status'):
+        if line.startswith('VmHWM:'):
+            return int(line.split()[1])
+
+
+def reset_peak_rss():
+    """Resets the peak resident set size, if the kernel allows it"""
+    try:
+        f = open('/proc/self/clear_refs', 'w')
+        f.write('5')
+        f.close()
+    except IOError:
+        raise SkipTest
+
+
+def tearDownModule():
+    if _keydir:
+        shutil.rmtree(_keydir)
+
+
+class MarTestCase(TestCase):
+    """Runs each test in a temporary directory holding a few files to add
+    to MARs, since members are named by their paths"""
+    files = {
+        'a.txt': 'hello world\n' * 100,
+        'empty': '',
+        'dir/b.bin': ''.join(chr(i % 251) for i in xrange(300000)),
+        'dir/sub/c.txt': 'c' * 70000,
+    }
+
+    def setUp(self):
+        self.olddir = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        os.mkdir('src')
+        for name, data in self.files.items():
+            write_file(os.path.join('src', name), data)
+        os.chmod(os.path.join('src', 'dir/sub/c.txt'), 0755)
+
+    def tearDown(self):
+        os.chdir(self.olddir)
+        shutil.rmtree(self.tmpdir)
+
+    def makeMar(self, name, mar_class=MarFile, paths=['src'], **kwargs):
+        m = mar_class(name, 'w')
+        m.add_files(paths, **kwargs)
+        m.close()
+        return name
+
+    def assertExtracted(self, path):
+        for name, data in self.files.items():
+            self.assertEquals(read_file(os.path.join(path, 'src', name)), data)
+
+
+class TestMarFile(MarTestCase):
+    def testRoundTrip(self):
+        for mar_class in MarFile, BZ2MarFile:
+            self.makeMar('test.mar', mar_class)
+            m = mar_class('test.mar')
+            self.assertEquals(sorted(i.name for i in m.members),
+                              sorted(os.path.join('src', n) for n in self.files))
+            m.extractall('out')
+            m.close()
+            self.assertExtracted('out')
+            self.assertEquals(os.stat('out/src/dir/sub/c.txt').st_mode & 0777, 0755)
+            shutil.rmtree('out')
+
+    def testUnsignedHeader(self):
+        # Unsigned MARs still have the file size and a signature count of 0
+        # in their header, ahead of the first member
+        self.makeMar('test.mar', paths=['src/a.txt'])
+        data = read_file('test.mar')
+        magic, index_offset, size, num_sigs = struct.unpack(">4sLQL", data[:20])
+        self.assertEquals(magic, "MAR1")
+        self.assertEquals(size, len(data))
+        self.assertEquals(num_sigs, 0)
+        self.assertEquals(index_offset, 20 + len(self.files['a.txt']))
+        self.assertEquals(data[20:index_offset], self.files['a.txt'])
+
+        m = MarFile('test.mar')
+        self.assertEquals(m.members[0]._offset, 20)
+        self.assertEquals(m.signatures, [])
+        self.assertEquals(str(m.member_data(m.members[0])), self.files['a.txt'])
+        m.close()
+
+    def testZeroFlags(self):
+        # A mode 000 file keeps its flags rather than getting those of `path`
+        m = MarFile('test.mar', 'w')
+        m.add('src/a.txt', flags=0)
+        m.add('src/empty', name='fromfile', fileobj=open('src/a.txt', 'rb'), flags=0)
+        m.close()
+        m = MarFile('test.mar')
+        self.assertEquals([i.flags for i in m.members], [0, 0])
+        m.close()
+
+
+class TestMapped(MarTestCase):
+    def setUp(self):
+        MarTestCase.setUp(self)
+        self.old_window_size = mar.WINDOW_SIZE
+
+    def tearDown(self):
+        mar.WINDOW_SIZE = self.old_window_size
+        MarTestCase.tearDown(self)
+
+    def testMapRange(self):
+        data = self.files['dir/b.bin']
+        f = open('src/dir/b.bin', 'rb')
+        for offset, size in (0, 0), (0, len(data)), (1, 100), (mmap.ALLOCATIONGRANULARITY - 1, 2), (70001, 5000):
+            self.assertEquals(str(map_range(f.fileno(), offset, size)), data[offset:offset + size])
+        f.close()
+
+    def testIterMapped(self):
+        # Use windows small enough that members span several of them
+        mar.WINDOW_SIZE = 4 * mmap.ALLOCATIONGRANULARITY
+        data = self.files['dir/b.bin']
+        f = open('src/dir/b.bin', 'rb')
+        for offset in 0, 1, mmap.ALLOCATIONGRANULARITY + 3, 70001:
+            for blocksize in 1000, mar.WINDOW_SIZE, mar.WINDOW_SIZE * 3:
+                size = len(data) - offset
+                blocks = [str(b) for b in iter_mapped(f.fileno(), offset, size, blocksize)]
+                self.assertTrue(max(len(b) for b in blocks) <= blocksize)
+                self.assertEquals("".join(blocks), data[offset:])
+        f.close()
+
+    def testExtractSmallWindows(self):
+        mar.WINDOW_SIZE = mmap.ALLOCATIONGRANULARITY
+        for mar_class in MarFile, BZ2MarFile:
+            self.makeMar('test.mar', mar_class)
+            m = mar_class('test.mar')
+            m.extractall('out')
+            m.close()
+            self.assertExtracted('out')
+            shutil.rmtree('out')
+
+    def testExtractRss(self):
+        # Peak memory use while extracting shouldn't grow with the size of
+        # the members
+        mar.WINDOW_SIZE = 4 * 1024 * 1024
+        size = 48 * 1024 * 1024
+        block = os.urandom(1024 * 1024)
+        f = open('big', 'wb')
+        for i in xrange(size / len(block)):
+            f.write(block)
+        f.close()
+        self.makeMar('test.mar', paths=['big'])
+        m = MarFile('test.mar')
+        reset_peak_rss()
+        start = peak_rss()
+        m.extractall('out')
+        peak = peak_rss()
+        m.close()
+        self.assertEquals(os.path.getsize('out/big'), size)
+        self.assertTrue(peak - start < 16 * 1024, "RSS grew by %ikB" % (peak - start))
+
+
+class TestParallel(MarTestCase):
+    def testAddFiles(self):
+        self.makeMar('serial.mar', BZ2MarFile)
+        self.makeMar('parallel.mar', BZ2MarFile, jobs=3)
+        self.assertEquals(read_file('serial.mar'), read_file('parallel.mar'))
+
+    def testExtractAll(self):
+        self.makeMar('test.mar', BZ2MarFile)
+        m = BZ2MarFile('test.mar')
+        m.extractall('serial')
+        m.extractall('parallel', jobs=3)
+        m.close()
+        self.assertExtracted('parallel')
+        for name in self.files:
+            for out in 'serial', 'parallel':
+                path = os.path.join(out, 'src', name)
+                self.assertEquals(stat.S_IMODE(os.stat(path).st_mode),
+                                  os.stat(os.path.join('src', name)).st_mode & 0777)
+            self.assertEquals(read_file(os.path.join('serial', 'src', name)),
+                              read_file(os.path.join('parallel', 'src', name)))
+
+
+class TestManifest(MarTestCase):
+    def testCached(self):
+        self.makeMar('test.mar', BZ2MarFile)
+        manifest = get_manifest('test.mar')
+        self.assertTrue(os.path.exists('test.mar.manifest'))
+        self.assertEquals(dict((m.name, m.digest) for m in manifest.members),
+                          dict((m.name, m.digest) for m in MarManifest.load('test.mar.manifest').members))
+
+    def testSameSizeRewrite(self):
+        # Rewrite a member with different contents of the same size, and
+        # put the MAR's size and mtime back the way they were
+        self.makeMar('test.mar')
+        st = os.stat('test.mar')
+        get_manifest('test.mar', MarFile)
+        write_file('src/a.txt', 'HELLO WORLD\n' * 100)
+        self.makeMar('test.mar')
+        os.utime('test.mar', (st.st_atime, st.st_mtime))
+        self.assertEquals(os.stat('test.mar').st_size, st.st_size)
+
+        manifest = get_manifest('test.mar', MarFile)
+        m = MarFile('test.mar')
+        self.assertEquals(dict((i.name, i.digest) for i in manifest.members),
+                          dict((i.name, m.member_digest(i)) for i in m.members))
+        m.close()
+
+    def testExtractChanged(self):
+        self.makeMar('old.mar', BZ2MarFile)
+        get_manifest('old.mar')
+        write_file('src/a.txt', 'changed')
+        os.chmod('src/empty', 0600)
+        os.unlink('src/dir/b.bin')
+        write_file('src/new.txt', 'new')
+        self.makeMar('new.mar', BZ2MarFile)
+        get_manifest('new.mar')
+
+        added, changed, removed = extract_changed('old.mar', 'new.mar', 'out')
+        self.assertEquals([m.name for m in added], ['src/new.txt'])
+        self.assertEquals(sorted(m.name for m in changed), ['src/a.txt', 'src/empty'])
+        self.assertEquals([m.name for m in removed], ['src/dir/b.bin'])
+        self.assertEquals(read_file('out/src/a.txt'), 'changed')
+        self.assertFalse(os.path.exists('out/src/dir/sub/c.txt'))
+
+
+class TestSignatures(MarTestCase):
+    def setUp(self):
+        MarTestCase.setUp(self)
+        self.key, self.pub = make_keys()
+
+    def makeSignedMar(self, name):
+        m = MarFile(name, 'w', signature_versions=[(1, self.key)])
+        m.add_files(['src'])
+        m.close()
+        return name
+
+    def testRsaVerifyKey(self):
+        key = load_public_key(self.pub)
+        if key is None:
+            raise SkipTest
+        digest = hashlib.sha1('hello').digest()
+        # Signed by openssl, verified in-process
+        signature = rsa_sign(digest, self.key)
+        self.assertTrue(rsa_verify_key(digest, signature, key))
+        self.assertFalse(rsa_verify_key(hashlib.sha1('goodbye').digest(), signature, key))
+        bad = chr(ord(signature[100]) ^ 1)
+        self.assertFalse(rsa_verify_key(digest, signature[:100] + bad + signature[101:], key))
+        self.assertFalse(rsa_verify_key(digest, signature[1:], key))
+
+    def testRsaVerifyOpenssl(self):
+        # Without PyCrypto, signatures are checked by openssl
+        digest = hashlib.sha1('hello').digest()
+        signature = rsa_sign(digest, self.key)
+        old_RSA, mar.RSA = mar.RSA, None
+        old_keys, mar._public_keys = mar._public_keys, {}
+        try:
+            self.assertTrue(rsa_verify(digest, signature, self.pub))
+            self.assertFalse(rsa_verify(hashlib.sha1('goodbye').digest(), signature, self.pub))
+        finally:
+            mar.RSA, mar._public_keys = old_RSA, old_keys
+
+    def testVerifySignatures(self):
+        self.makeSignedMar('test.mar')
+        m = MarFile('test.mar', signature_versions=[(1, self.pub)])
+        self.assertEquals(len(m.signatures), 1)
+        self.assertEquals(m.failed_signatures(), [])
+        m.close()
+
+    def testSigningBenchmark(self):
+        # Signing can't be done while members are added, since the digest
+        # covers the header that close() writes. Measure what the second
+        # pass over a ~100MB MAR costs: it should read the file once.
+        block = os.urandom(1024 * 1024)
+        f = open('big', 'wb')
+        for i in xrange(100):
+            f.write(block)
+        f.close()
+
+        hashed = [0]
+        generate_signature = mar.generate_signature
+
+        def counting_generate_signature(fp, updatefunc):
+            def update(data):
+                hashed[0] += len(data)
+                updatefunc(data)
+            return generate_signature(fp, update)
+
+        mar.generate_signature = counting_generate_signature
+        try:
+            start = time.time()
+            m = MarFile('test.mar', 'w', signature_versions=[(1, self.key)])
+            m.add_files(['big'])
+            written = time.time()
+            m.close()
+            closed = time.time()
+        finally:
+            mar.generate_signature = generate_signature
+
+        size = os.path.getsize('test.mar')
+        log.info("Wrote %iMB in %.2fs; signing read %iMB in %.2fs",
+                 size / 1024 ** 2, written - start, hashed[0] / 1024 ** 2, closed - written)
+        # Everything but the signature itself is hashed, once
+        self.assertEquals(hashed[0], size - 256)
+        m = MarFile('test.mar', signature_versions=[(1, self.pub)])
+        self.assertEquals(m.failed_signatures(), [])
+        m.close()
+
+    def testVerifyMars(self):
+        names = [self.makeSignedMar('signed%i.mar' % i) for i in range(4)]
+        self.makeMar('unsigned.mar')
+        # Corrupt the first byte of a member's data
+        self.makeSignedMar('bad.mar')
+        m = MarFile('bad.mar')
+        offset = m.members[0]._offset
+        m.close()
+        f = open('bad.mar', 'r+b')
+        f.seek(offset)
+        c = f.read(1)
+        f.seek(-1, 1)
+        f.write(chr(ord(c) ^ 1))
+        f.close()
+        names += ['unsigned.mar', 'bad.mar', 'missing.mar']
+
+        for jobs in 1, 3:
+            results = verify_mars(names, [(1, self.pub)], jobs=jobs)
+            self.assertEquals([n for n, error in results], names)
+            errors = [error for n, error in results]
+            self.assertEquals(errors[:4], [None] * 4)
+            self.assertEquals(errors[4], "not signed")
+            self.assertEquals(errors[5], "verification failed (1)")
+            self.assertTrue(errors[6])
@@ -2,8 +2,13 @@
 Implement an on-disk queue for stuff
 """
 import os
+import errno
+import random
+import socket
 import tempfile
 import time
+import heapq
+import zlib
 import logging
 log = logging.getLogger(__name__)
 
@@ -17,6 +22,86 @@ try:
 except ImportError:
     pyinotify = None
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# The counters in a queue's state file. The first four are how many items
+# are in each directory; the rest are totals since the queue was created.
+STATE_COUNTERS = ('new', 'cur', 'delayed', 'dead',
+                  'added', 'popped', 'removed', 'requeued', 'murdered')
+
+# Passed to QueueDir._update_state to leave the oldest item time alone
+_KEEP = object()
+
+
+def _oldest_mtime(d, items):
+    """
+    Returns the earliest modification time of items in directory d, or None
+    if none of them exist
+    """
+    oldest = None
+    for item in items:
+        try:
+            mtime = os.path.getmtime(os.path.join(d, item))
+        except OSError:
+            continue
+        if oldest is None or mtime < oldest:
+            oldest = mtime
+    return oldest
+
+
+def _parse_state(data, strict=False):
+    """
+    Parses the contents of a state file. Bad lines are ignored, and missing
+    counters are 0, unless strict is set, in which case None is returned if
+    the state is incomplete, e.g. because the file hasn't been written yet
+    """
+    state = dict((k, 0) for k in STATE_COUNTERS)
+    state['oldest'] = None
+    seen = set()
+    for line in data.splitlines():
+        try:
+            key, value = line.split()
+            if key == 'oldest':
+                state[key] = float(value)
+            else:
+                state[key] = int(value)
+            seen.add(key)
+        except ValueError:
+            if strict:
+                return None
+            log.warn("Ignoring bad line in state: %r", line)
+    if strict and not seen.issuperset(STATE_COUNTERS):
+        return None
+    return state
+
+
+def read_state(queue_dir):
+    """
+    Returns a dict of the counters in queue_dir's state file, along with
+    'oldest', the modification time of the oldest item in new, or None if
+    new is empty.
+    Returns None if there is no state file, or it's empty or can't be
+    parsed, e.g. because it hasn't been written yet; the queue has to be
+    scanned instead.
+
+    The state file has one "<name> <value>" pair per line, so it's cheap to
+    read from monitoring scripts. It's rewritten in place while locked, so
+    readers need to take a shared lock.
+    """
+    try:
+        f = open(os.path.join(queue_dir, 'state'))
+    except IOError:
+        return None
+    try:
+        if fcntl:
+            fcntl.lockf(f, fcntl.LOCK_SH)
+        return _parse_state(f.read(), strict=True)
+    finally:
+        f.close()
+
 
 class QueueDir(object):
     # How long before things are considered to be "old"
@@ -26,6 +111,12 @@ class QueueDir(object):
     # Should the producer do cleanup?
     producer_cleanup = True
 
+    # How often to look for items that have arrived in new while we still
+    # have older ones indexed, so that more urgent items don't have to wait
+    # for the index to be drained. Also how often to look for items that
+    # other processes have delayed
+    rescan_interval = 1
+
     # Mapping of names to QueueDir instances
     _objects = {}
 
@@ -37,14 +128,34 @@ class QueueDir(object):
         self.started = int(time.time())
         self.count = 0
         self.last_cleanup = 0
-        # List of time, item_id for items to move from cur back into new
+        # Heap of time, name for items in delayed to move back into new
         self.to_requeue = []
+        # Modification time of delayed when to_requeue was loaded, or after
+        # our own changes to it, and when it was loaded and last checked
+        self._delayed_mtime = None
+        self._delayed_loaded = 0
+        self._delayed_checked = 0
+        # Heap of -priority, mtime, item_id for items in new, most urgent
+        # first. See pop_many()
+        self._index = []
+        # Heap of mtime, item_id for the same items, oldest first, whatever
+        # their priority. Entries for items that are no longer indexed are
+        # dropped when they reach the top
+        self._by_mtime = []
+        # Items in new that are in the index
+        self._indexed = set()
+        self._last_scan = 0
+        # How long the last item popped in sorted order had been in new
+        self._lag = 0
 
         self.tmp_dir = os.path.join(self.queue_dir, 'tmp')
         self.new_dir = os.path.join(self.queue_dir, 'new')
         self.cur_dir = os.path.join(self.queue_dir, 'cur')
         self.log_dir = os.path.join(self.queue_dir, 'logs')
         self.dead_dir = os.path.join(self.queue_dir, 'dead')
+        self.delayed_dir = os.path.join(self.queue_dir, 'delayed')
+        self.state_file = os.path.join(self.queue_dir, 'state')
+        self._state_fd = None
 
         self.setup()
 
@@ -53,7 +164,7 @@ class QueueDir(object):
         return cls._objects[name]
 
     def setup(self):
-        for d in (self.tmp_dir, self.new_dir, self.cur_dir, self.log_dir, self.dead_dir):
+        for d in (self.tmp_dir, self.new_dir, self.cur_dir, self.log_dir, self.dead_dir, self.delayed_dir):
             # Create our directories a bit at a time so we can make sure the
             # modes are created properly
             parts = d.split("/")
@@ -71,6 +182,8 @@ class QueueDir(object):
         Removes old items from tmp
         Removes old logs from log_dir
         Moves old items from cur into new
+        Reloads the schedule of delayed items, in case other processes have
+        delayed items and gone away
 
         'old' is defined by the cleanup_time property
         """
@@ -96,21 +209,150 @@ class QueueDir(object):
             except OSError:
                 pass
 
+        self._load_delayed()
+        self._sync_state()
+
+    ###
+    # Monitoring state
+    ###
+    def read_state(self):
+        return read_state(self.queue_dir)
+
+    def _lock_state(self):
+        """
+        Locks our state file, and returns its current contents
+        Returns None if we can't lock files here
+        """
+        if fcntl is None:
+            return None
+        if self._state_fd is None:
+            self._state_fd = os.open(self.state_file, os.O_RDWR | os.O_CREAT, 0644)
+        fcntl.lockf(self._state_fd, fcntl.LOCK_EX)
+        os.lseek(self._state_fd, 0, 0)
+        return _parse_state(os.read(self._state_fd, 4096))
+
+    def _write_state(self, state):
+        """
+        Writes out state, and unlocks our state file
+        """
+        lines = ["%s %i\n" % (key, max(state[key], 0)) for key in STATE_COUNTERS]
+        if state['oldest'] is not None:
+            # At full precision, so that it can be compared with mtimes
+            lines.append("oldest %r\n" % state['oldest'])
+        data = "".join(lines)
+        try:
+            os.lseek(self._state_fd, 0, 0)
+            os.write(self._state_fd, data)
+            os.ftruncate(self._state_fd, len(data))
+        finally:
+            fcntl.lockf(self._state_fd, fcntl.LOCK_UN)
+
+    def _update_state(self, oldest=_KEEP, arrived=None, **deltas):
+        """
+        Adds deltas to the counters in our state file, e.g.
+        _update_state(new=-1, cur=1, popped=1)
+
+        oldest is the new modification time of the oldest item in new, if
+        we know it, e.g. after popping items. arrived is the modification
+        time of items we've just moved into new, which become the oldest if
+        they're older than what's there. The time is cleared when new becomes
+        empty.
+        """
+        state = self._lock_state()
+        if state is None:
+            return
+        for key, delta in deltas.items():
+            state[key] += delta
+        if oldest is not _KEEP:
+            state['oldest'] = oldest
+        if arrived is not None and (state['oldest'] is None or arrived < state['oldest']):
+            state['oldest'] = arrived
+        if state['new'] <= 0:
+            state['oldest'] = None
+        self._write_state(state)
+
+    def _sync_state(self):
+        """
+        Recounts the items in each directory and finds the oldest item in
+        new, to correct the state file for anything that happened behind our
+        back, e.g. dead items being cleared out, or processes dying before
+        updating the state
+        """
+        state = self._lock_state()
+        if state is None:
+            return
+        items = os.listdir(self.new_dir)
+        state['new'] = len(items)
+        state['oldest'] = _oldest_mtime(self.new_dir, items)
+        state['cur'] = len(os.listdir(self.cur_dir))
+        state['delayed'] = len(os.listdir(self.delayed_dir))
+        state['dead'] = len([f for f in os.listdir(self.dead_dir)
+                             if not f.endswith(".log")])
+        self._write_state(state)
+
+    def _load_delayed(self):
+        """
+        Rebuilds the schedule of delayed items from delayed
+        Items are named <due time in ms>-<item_id>
+        """
+        self._delayed_loaded = self._delayed_checked = time.time()
+        self._delayed_mtime = os.path.getmtime(self.delayed_dir)
+        to_requeue = []
+        for f in os.listdir(self.delayed_dir):
+            try:
+                due = int(f.split("-", 1)[0]) / 1000.0
+            except ValueError:
+                log.warn("Ignoring unknown delayed item %s", f)
+                continue
+            to_requeue.append((due, f))
+        heapq.heapify(to_requeue)
+        self.to_requeue = to_requeue
+
+    def _changed_delayed(self):
+        """
+        Notes delayed's new modification time after we've changed it
+        ourselves. Our changes are already in to_requeue, so they don't need
+        delayed to be reloaded
+        """
+        try:
+            self._delayed_mtime = os.path.getmtime(self.delayed_dir)
+        except OSError:
+            pass
+
     ###
     # For producers
     ###
-    def add(self, data):
+    def add(self, data, priority=0, delay=None):
         """
         Adds a new item to the queue.
+
+        Items with a higher priority are popped before those with a lower
+        one. The priority is kept in the item's name, as "p<priority>_" in
+        front of the usual name, so it survives being requeued.
+
+        If delay is set, the item isn't available to consumers for that many
+        seconds.
         """
+        prefix = "%i-%i-%i" % (self.started, self.count, self.pid)
+        if priority:
+            prefix = "p%i_%s" % (priority, prefix)
         # write data to tmp
-        fd, tmp_name = tempfile.mkstemp(prefix="%i-%i-%i" % (self.started,
-                                                             self.count, self.pid), dir=self.tmp_dir)
+        fd, tmp_name = tempfile.mkstemp(prefix=prefix, dir=self.tmp_dir)
         os.write(fd, data)
+        mtime = os.fstat(fd).st_mtime
         os.close(fd)
 
-        dst_name = os.path.join(self.new_dir, os.path.basename(tmp_name))
-        os.rename(tmp_name, dst_name)
+        item_id = os.path.basename(tmp_name)
+        if delay:
+            due = time.time() + delay
+            name = "%i-%s" % (due * 1000, item_id)
+            os.rename(tmp_name, os.path.join(self.delayed_dir, name))
+            heapq.heappush(self.to_requeue, (due, name))
+            self._changed_delayed()
+            self._update_state(delayed=1, added=1)
+        else:
+            os.rename(tmp_name, os.path.join(self.new_dir, item_id))
+            self._update_state(arrived=mtime, new=1, added=1)
         self.count += 1
 
         if self.producer_cleanup:
@@ -126,21 +368,151 @@ class QueueDir(object):
         Returns None if queue is empty
         If sorted is True, then the earliest item is returned
         """
+        items = self.pop_many(1, sorted)
+        if items:
+            return items[0]
+        return None
+
+    def pop_many(self, n, sorted=True):
+        """
+        Moves up to n items from new into cur
+        Returns a list of (item_id, file handle), which is empty if the queue
+        is empty
+        If sorted is True, then the earliest items are returned
+        """
         self._check_to_requeue()
         self.cleanup()
-        items = os.listdir(self.new_dir)
-        if sorted:
-            items.sort(
-                key=lambda f: os.path.getmtime(os.path.join(self.new_dir, f)))
-        for item in items:
+        retval = []
+        if not sorted:
+            listed = time.time()
+            items = os.listdir(self.new_dir)
+            popped_mtime = None
+            for i, item in enumerate(items):
+                if len(retval) >= n:
+                    break
+                try:
+                    mtime = os.path.getmtime(os.path.join(self.new_dir, item))
+                except OSError:
+                    continue
+                claimed = self._claim(item)
+                if claimed:
+                    retval.append(claimed)
+                    popped_mtime = min(mtime, popped_mtime or mtime)
+            if retval:
+                oldest = _KEEP
+                state = self.read_state()
+                if not state or state['oldest'] is None or popped_mtime <= state['oldest']:
+                    # We may have taken the oldest item, so find the new one
+                    # among the items we didn't get to. Anything that
+                    # arrived since we listed new is newer than that.
+                    oldest = _oldest_mtime(self.new_dir, items[i:])
+                    if oldest is None:
+                        oldest = listed
+                self._update_state(oldest, new=-len(retval), cur=len(retval),
+                                   popped=len(retval))
+            return retval
+
+        # Items are popped from an index of new, highest priority and then
+        # oldest first. Rather than listing new on every call, the index is
+        # only brought up to date once it's empty, or every rescan_interval
+        # so that urgent items can jump ahead of the rest of the index.
+        # Only items that weren't already in the index are stat'ed.
+        scanned = False
+        if self._index and time.time() - self._last_scan > self.rescan_interval:
+            self._scan_new()
+            scanned = True
+        while len(retval) < n:
+            if not self._index:
+                if scanned:
+                    break
+                self._scan_new()
+                scanned = True
+                continue
+            priority, mtime, item = heapq.heappop(self._index)
+            self._indexed.discard(item)
+            claimed = self._claim(item)
+            if claimed:
+                retval.append(claimed)
+                self._lag = time.time() - mtime
+        if retval:
+            oldest = self._oldest_indexed()
+            if oldest is None and not scanned:
+                self._scan_new()
+                oldest = self._oldest_indexed()
+            if oldest is None:
+                # We've taken everything that was in new when we scanned it
+                # just now, so whatever is there arrived since
+                oldest = self._last_scan
+            self._update_state(oldest, new=-len(retval), cur=len(retval),
+                               popped=len(retval))
+        return retval
+
+    def _oldest_indexed(self):
+        """
+        Returns the modification time of the oldest item in the index,
+        whatever its priority, or None if the index is empty
+        """
+        by_mtime = self._by_mtime
+        while by_mtime and by_mtime[0][1] not in self._indexed:
+            heapq.heappop(by_mtime)
+        if by_mtime:
+            return by_mtime[0][0]
+        return None
+
+    def _scan_new(self):
+        """
+        Adds items in new that aren't in the index yet to the index
+        """
+        self._last_scan = time.time()
+        items = set(os.listdir(self.new_dir))
+        for item in items - self._indexed:
             try:
-                dst_name = os.path.join(self.cur_dir, item)
-                os.rename(os.path.join(self.new_dir, item), dst_name)
-                os.utime(dst_name, None)
-                return item, open(dst_name, 'rb')
+                mtime = os.path.getmtime(os.path.join(self.new_dir, item))
             except OSError:
-                pass
-        return None
+                # Somebody else got to it first
+                continue
+            heapq.heappush(self._index, (-self.getpriority(item), mtime, item))
+            heapq.heappush(self._by_mtime, (mtime, item))
+        # Items that have gone are left in the index; claiming them fails
+        self._indexed = items
+
+    def _moved_to_new(self, item):
+        """
+        Adds an item we've just moved into new to the index, so it doesn't
+        have to wait for the next scan
+        Returns the item's modification time
+        """
+        try:
+            mtime = os.path.getmtime(os.path.join(self.new_dir, item))
+        except OSError:
+            # Somebody else has taken it already; it was just touched
+            mtime = time.time()
+        if item not in self._indexed:
+            self._indexed.add(item)
+            heapq.heappush(self._index, (-self.getpriority(item), mtime, item))
+            heapq.heappush(self._by_mtime, (mtime, item))
+        return mtime
+
+    def _claim(self, item):
+        """
+        Moves item from new into cur
+        Returns item_id, file handle
+        Returns None if somebody else got to it first
+        """
+        try:
+            dst_name = os.path.join(self.cur_dir, item)
+            os.rename(os.path.join(self.new_dir, item), dst_name)
+            os.utime(dst_name, None)
+            return item, open(dst_name, 'rb')
+        except OSError:
+            return None
+
+    def lag(self):
+        """
+        Returns how many seconds the last item popped in sorted order had
+        been waiting in new, i.e. how far behind the queue consumers are
+        """
+        return self._lag
 
     def peek(self):
         """
@@ -160,6 +532,17 @@ class QueueDir(object):
             # Somebody else moved this; that's probably ok
             pass
 
+    def getpriority(self, item_id):
+        """
+        Returns the priority this item was added with
+        """
+        if item_id.startswith("p"):
+            try:
+                return int(item_id[1:item_id.index("_")])
+            except ValueError:
+                pass
+        return 0
+
     def getcount(self, item_id):
         """
         Returns how many times this item has been run
@@ -189,17 +572,59 @@ class QueueDir(object):
         Removes item_id from cur
         """
         os.unlink(os.path.join(self.cur_dir, item_id))
+        self._update_state(cur=-1, removed=1)
+
+    def remove_many(self, item_ids):
+        """
+        Removes all of item_ids from cur, e.g. once a batch of items returned
+        by pop_many has been processed
+        Items that somebody else has (re)moved already are ignored
+        Returns how many items were removed
+        """
+        removed = 0
+        for item_id in item_ids:
+            try:
+                os.unlink(os.path.join(self.cur_dir, item_id))
+                removed += 1
+            except OSError:
+                pass
+        if removed:
+            self._update_state(cur=-removed, removed=removed)
+        return removed
 
     def _check_to_requeue(self):
-        if not self.to_requeue:
-            return
         now = time.time()
-        for t, item_id in self.to_requeue[:]:
-            if now > t:
-                self.requeue(item_id)
-                self.to_requeue.remove((t, item_id))
-            else:
-                self.touch(item_id)
+        # Pick up items that other processes have delayed. Reloading delayed
+        # lists all of it, so it's done at most every rescan_interval.
+        # mtimes may only have one second granularity, so if delayed was
+        # loaded within a second of its mtime, later changes in the same
+        # second can't be seen that way; reload it again to be sure.
+        if now - self._delayed_checked > self.rescan_interval:
+            self._delayed_checked = now
+            try:
+                mtime = os.path.getmtime(self.delayed_dir)
+                if mtime != self._delayed_mtime or self._delayed_loaded - mtime < 1:
+                    self._load_delayed()
+            except OSError:
+                pass
+        moved = 0
+        arrived = None
+        while self.to_requeue and self.to_requeue[0][0] <= now:
+            t, name = heapq.heappop(self.to_requeue)
+            item_id = name.split("-", 1)[1]
+            dst_name = os.path.join(self.new_dir, item_id)
+            try:
+                os.rename(os.path.join(self.delayed_dir, name), dst_name)
+                os.utime(dst_name, None)
+                mtime = self._moved_to_new(item_id)
+                moved += 1
+                arrived = min(mtime, arrived or mtime)
+            except OSError:
+                # Somebody else got to it first
+                pass
+        if moved:
+            self._changed_delayed()
+            self._update_state(arrived=arrived, delayed=-moved, new=moved)
 
     def requeue(self, item_id, delay=None, max_retries=None):
         """
@@ -207,11 +632,8 @@ class QueueDir(object):
         end.
 
         If delay is set, it is a number of seconds to wait before moving the
-        item back into new. It will remain in cur until the appropriate time
-        has expired.
-        The state for this is kept in the QueueDir instance, so if the instance
-        goes away, the item won't be requeued on schedule. It will eventually
-        be moved out of cur when the cleanup time expires however.
+        item back into new. Until then it is kept in delayed, with the time
+        it's due encoded in its name, so the schedule survives restarts.
         You must be call pop() at some point in the future for requeued items
         to be processed.
         """
@@ -229,14 +651,25 @@ class QueueDir(object):
             return
 
         if delay:
-            self.to_requeue.append((time.time() + delay, item_id))
-            self.to_requeue.sort()
+            due = time.time() + delay
+            name = "%i-%s.%i" % (due * 1000, core_item_id, count)
+            try:
+                os.rename(os.path.join(self.cur_dir, item_id),
+                          os.path.join(self.delayed_dir, name))
+            except OSError:
+                # Somebody else got to it first
+                return
+            heapq.heappush(self.to_requeue, (due, name))
+            self._changed_delayed()
+            self._update_state(cur=-1, delayed=1, requeued=1)
             return
 
         dst_name = os.path.join(self.new_dir, "%s.%i" % (core_item_id, count))
         try:
             os.rename(os.path.join(self.cur_dir, item_id), dst_name)
             os.utime(dst_name, None)
+            mtime = self._moved_to_new(os.path.basename(dst_name))
+            self._update_state(arrived=mtime, cur=-1, new=1, requeued=1)
         except OSError:
             # Somebody else got to it first
             pass
@@ -247,10 +680,40 @@ class QueueDir(object):
         """
         dst_name = os.path.join(self.dead_dir, item_id)
         os.rename(os.path.join(self.cur_dir, item_id), dst_name)
+        self._update_state(cur=-1, dead=1, murdered=1)
         if os.path.exists(self.getlogname(item_id)):
             dst_name = os.path.join(self.dead_dir, "%s.log" % item_id)
             os.rename(self.getlogname(item_id), dst_name)
 
+    def watched_dirs(self):
+        """
+        Returns the directories new items arrive in
+        """
+        return [self.new_dir]
+
+    def next_wakeup(self):
+        """
+        Returns the time at which pop_many needs to be called again to
+        requeue delayed items, or None
+        """
+        if self.to_requeue:
+            return self.to_requeue[0][0]
+        return None
+
+    def next_renewal(self):
+        """
+        Returns the time at which maybe_renew needs to be called again to
+        keep hold of the queue while we're busy with the items we have, or
+        None if it never does. Plain QueueDirs have nothing to renew.
+        """
+        return None
+
+    def maybe_renew(self):
+        """
+        Renews our hold on the queue if it's due. See next_renewal()
+        """
+        pass
+
     if pyinotify:
         def wait(self, timeout=None):
             """
@@ -310,3 +773,460 @@ class QueueDir(object):
                 time.sleep(1)
                 if timeout and time.time() - start > timeout:
                     return
+
+
+def _makedirs(d):
+    try:
+        os.makedirs(d, 0755)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class ShardedQueueDir(object):
+    """
+    A queue made up of several QueueDirs ("shards"), so that several
+    consumers, possibly on different hosts sharing the queue over NFS, can
+    work through it without all contending for the same items.
+
+    Producers add each item to a shard picked by hashing its data. Each
+    consumer holds leases on its share of the shards, and only pops items
+    from those. Leases are files in leases/ that are renewed by touching
+    them, and are considered stale after lease_time seconds. Consumers also
+    announce themselves in consumers/, so that shards are rebalanced as
+    consumers come and go.
+
+    Leases reduce contention; they don't guarantee exclusivity. Items are
+    still claimed by renaming them into cur, so the worst a disputed lease
+    can do is have two consumers racing on one shard until the next renewal.
+
+    Item priorities (see QueueDir.add) only order items within a shard.
+
+    Item ids are "<shard>:<item_id in that shard>".
+    """
+    # How long before leases and consumers are considered to be gone
+    lease_time = 60
+
+    def __init__(self, name, queue_dir, shards=None):
+        self.name = name
+        self.queue_dir = queue_dir
+        self.consumer_id = "%s-%i" % (socket.gethostname(), os.getpid())
+
+        self.lease_dir = os.path.join(queue_dir, 'leases')
+        self.consumer_dir = os.path.join(queue_dir, 'consumers')
+        for d in (queue_dir, self.lease_dir, self.consumer_dir):
+            _makedirs(d)
+
+        nshards = self.shard_count(queue_dir)
+        if nshards is None:
+            if not shards:
+                raise ValueError("%s isn't a sharded queue" % queue_dir)
+            self._write_shard_count(shards)
+            nshards = self.shard_count(queue_dir)
+        if shards and shards != nshards:
+            raise ValueError("%s has %i shards, not %i" % (queue_dir, nshards, shards))
+
+        self.shards = [QueueDir("%s-%i" % (name, i),
+                                os.path.join(queue_dir, 'shards', str(i)))
+                       for i in range(nshards)]
+        # Shards we hold leases on
+        self.leases = set()
+        self.last_renewal = 0
+        self._next_shard = 0
+
+    @staticmethod
+    def shard_count(queue_dir):
+        """
+        Returns how many shards the queue in queue_dir has, or None if it
+        isn't a sharded queue
+        """
+        try:
+            return int(open(os.path.join(queue_dir, 'shards.count')).read())
+        except (IOError, ValueError):
+            return None
+
+    def _write_shard_count(self, shards):
+        # link() fails if somebody else created the queue first, in which
+        # case we go with their count
+        fn = os.path.join(self.queue_dir, 'shards.count')
+        tmp_name = "%s.%s.tmp" % (fn, self.consumer_id)
+        open(tmp_name, 'w').write("%i\n" % shards)
+        try:
+            try:
+                os.link(tmp_name, fn)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        finally:
+            os.unlink(tmp_name)
+
+    ###
+    # For producers
+    ###
+    def add(self, data, priority=0, delay=None):
+        """
+        Adds a new item to the queue. See QueueDir.add()
+
+        Items are ordered by priority only within their shard. Consumers
+        work through their shards in turn, so an urgent item doesn't jump
+        ahead of items in other shards.
+        """
+        shard = (zlib.crc32(data) & 0xffffffff) % len(self.shards)
+        self.shards[shard].add(data, priority, delay)
+
+    ###
+    # Leases
+    ###
+    def _lease_name(self, shard):
+        return os.path.join(self.lease_dir, str(shard))
+
+    def _lease_owner(self, shard):
+        try:
+            return open(self._lease_name(shard)).read().strip()
+        except IOError:
+            return None
+
+    def _acquire(self, shard, now):
+        """
+        Takes the lease on shard if it's free or stale
+        Returns True if we got it
+        """
+        fn = self._lease_name(shard)
+        try:
+            if os.path.getmtime(fn) > now - self.lease_time:
+                return False
+            log.info("Breaking stale lease on shard %i held by %s",
+                     shard, self._lease_owner(shard))
+            os.unlink(fn)
+        except OSError:
+            # Nobody holds it, or somebody else broke it first
+            pass
+
+        tmp_name = "%s.%s.tmp" % (fn, self.consumer_id)
+        open(tmp_name, 'w').write(self.consumer_id)
+        try:
+            os.link(tmp_name, fn)
+        except OSError:
+            # Somebody else got to it first
+            return False
+        finally:
+            os.unlink(tmp_name)
+        log.debug("Acquired lease on shard %i", shard)
+        return True
+
+    def _release(self, shard):
+        if self._lease_owner(shard) == self.consumer_id:
+            log.debug("Releasing lease on shard %i", shard)
+            try:
+                os.unlink(self._lease_name(shard))
+            except OSError:
+                pass
+
+    def consumers(self, now=None):
+        """
+        Returns the list of consumers that have renewed their leases recently
+        Consumers that have been gone for a while are removed
+        """
+        if now is None:
+            now = time.time()
+        retval = []
+        for c in os.listdir(self.consumer_dir):
+            fn = os.path.join(self.consumer_dir, c)
+            try:
+                mtime = os.path.getmtime(fn)
+                if mtime > now - self.lease_time:
+                    retval.append(c)
+                elif mtime < now - 10 * self.lease_time:
+                    os.unlink(fn)
+            except OSError:
+                pass
+        return retval
+
+    def _share(self, now):
+        """
+        Returns how many shards we should hold. Each consumer gets
+        nshards // nconsumers, and the remainder go one each to the first
+        consumers by id, so the shares add up to exactly nshards and no
+        consumer is left without any while another has more than its share
+        """
+        consumers = sorted(self.consumers(now))
+        if self.consumer_id not in consumers:
+            consumers.append(self.consumer_id)
+        share, extra = divmod(len(self.shards), len(consumers))
+        if consumers.index(self.consumer_id) < extra:
+            share += 1
+        return share
+
+    def renew(self):
+        """
+        Renews our leases, and rebalances the shards between consumers: we
+        take free or stale leases until we have our share of the shards, and
+        give up any we hold beyond that
+        """
+        now = time.time()
+        fn = os.path.join(self.consumer_dir, self.consumer_id)
+        open(fn, 'a').close()
+        os.utime(fn, None)
+
+        for shard in list(self.leases):
+            if self._lease_owner(shard) != self.consumer_id:
+                log.info("Lost lease on shard %i", shard)
+                self.leases.discard(shard)
+                continue
+            try:
+                os.utime(self._lease_name(shard), None)
+            except OSError:
+                # It was broken since we checked
+                log.info("Lost lease on shard %i", shard)
+                self.leases.discard(shard)
+
+        nshards = len(self.shards)
+        share = self._share(now)
+
+        while len(self.leases) > share:
+            self._release(self.leases.pop())
+
+        # Start somewhere random so consumers starting together don't all
+        # fight over the same shards
+        start = random.randrange(nshards)
+        for i in range(nshards):
+            if len(self.leases) >= share:
+                break
+            shard = (start + i) % nshards
+            if shard not in self.leases and self._acquire(shard, now):
+                self.leases.add(shard)
+        self.last_renewal = now
+
+    def next_renewal(self):
+        """
+        Returns the time at which maybe_renew needs to be called again to
+        keep our leases and heartbeat fresh. Consumers that are too busy to
+        pop more items must still call it, or other consumers will take
+        over our shards while we're working on their items.
+        """
+        return self.last_renewal + self.lease_time / 3.0
+
+    def maybe_renew(self):
+        """
+        Renews our leases if it's due. See next_renewal()
+        """
+        if time.time() >= self.next_renewal():
+            self.renew()
+
+    def release(self):
+        """
+        Gives up all our leases so other consumers can take them over
+        immediately, e.g. when shutting down
+        """
+        for shard in self.leases:
+            self._release(shard)
+        self.leases = set()
+        try:
+            os.unlink(os.path.join(self.consumer_dir, self.consumer_id))
+        except OSError:
+            pass
+
+    ###
+    # For consumers
+    ###
+    def pop(self, sorted=True):
+        """
+        Moves an item from one of our shards' new into cur
+        Returns item_id, file handle
+        Returns None if our shards are empty
+        """
+        items = self.pop_many(1, sorted)
+        if items:
+            return items[0]
+        return None
+
+    def pop_many(self, n, sorted=True):
+        """
+        Moves up to n items from our shards' new into cur
+        Returns a list of (item_id, file handle)
+        If sorted is True, each shard's items are returned highest priority
+        first, then oldest first; priorities aren't compared across shards
+        """
+        self.maybe_renew()
+        retval = []
+        held = list(self.leases)
+        held.sort()
+        # Start from a different shard each time so that a busy shard
+        # doesn't starve the others
+        for i in range(len(held)):
+            if len(retval) >= n:
+                break
+            shard = held[(self._next_shard + i) % len(held)]
+            for item_id, fp in self.shards[shard].pop_many(n - len(retval), sorted):
+                retval.append(("%i:%s" % (shard, item_id), fp))
+        self._next_shard += 1
+        return retval
+
+    def peek(self):
+        """
+        Returns True if there are new items in our shards
+        """
+        self.maybe_renew()
+        for shard in self.leases:
+            if self.shards[shard].peek():
+                return True
+        return False
+
+    def lag(self):
+        """
+        Returns how far behind we are on the shards we hold. See
+        QueueDir.lag()
+        """
+        return max([self.shards[shard].lag() for shard in self.leases] or [0])
+
+    def _split(self, item_id):
+        shard, item_id = item_id.split(":", 1)
+        return self.shards[int(shard)], item_id
+
+    def touch(self, item_id):
+        """
+        Indicates that we're still working on this item, and renews our
+        leases if it's due
+        """
+        self.maybe_renew()
+        q, item_id = self._split(item_id)
+        q.touch(item_id)
+
+    def getpriority(self, item_id):
+        q, item_id = self._split(item_id)
+        return q.getpriority(item_id)
+
+    def getcount(self, item_id):
+        q, item_id = self._split(item_id)
+        return q.getcount(item_id)
+
+    def getlogname(self, item_id):
+        q, item_id = self._split(item_id)
+        return q.getlogname(item_id)
+
+    def getlog(self, item_id):
+        q, item_id = self._split(item_id)
+        return q.getlog(item_id)
+
+    def log(self, item_id, msg):
+        q, item_id = self._split(item_id)
+        q.log(item_id, msg)
+
+    def remove(self, item_id):
+        q, item_id = self._split(item_id)
+        q.remove(item_id)
+
+    def remove_many(self, item_ids):
+        by_shard = {}
+        for item_id in item_ids:
+            q, item_id = self._split(item_id)
+            by_shard.setdefault(q, []).append(item_id)
+        return sum(q.remove_many(ids) for q, ids in by_shard.items())
+
+    def requeue(self, item_id, delay=None, max_retries=None):
+        q, item_id = self._split(item_id)
+        q.requeue(item_id, delay, max_retries)
+
+    def murder(self, item_id):
+        q, item_id = self._split(item_id)
+        q.murder(item_id)
+
+    def watched_dirs(self):
+        """
+        Returns the directories new items arrive in. This includes shards
+        we don't hold leases on, since we may take them over later.
+        """
+        return [q.new_dir for q in self.shards]
+
+    def next_wakeup(self):
+        """
+        Returns the time at which pop_many needs to be called again to renew
+        our leases or requeue delayed items
+        """
+        wakeup = self.next_renewal()
+        for shard in self.leases:
+            t = self.shards[shard].next_wakeup()
+            if t is not None:
+                wakeup = min(wakeup, t)
+        return wakeup
+
+    def wait(self, timeout=None):
+        """
+        Waits for new items to arrive in our shards.
+        timeout is in seconds, and is the maximum amount of time to wait. we
+        might return before that, e.g. to renew our leases.
+        """
+        self.maybe_renew()
+        now = time.time()
+        wakeup = self.next_wakeup()
+        if wakeup <= now:
+            return
+        if timeout:
+            timeout = min(timeout, wakeup - now)
+        else:
+            timeout = wakeup - now
+
+        log.debug("Sleeping for %s", timeout)
+
+        if pyinotify and self.leases:
+            wm = pyinotify.WatchManager()
+            try:
+                for shard in self.leases:
+                    wm.add_watch(self.shards[shard].new_dir, pyinotify.IN_MOVED_TO)
+                notifier = pyinotify.Notifier(wm, _MovedHandler())
+                notifier.check_events(timeout * 1000)
+                notifier.process_events()
+            finally:
+                wm.close()
+            return
+
+        start = time.time()
+        while True:
+            if self.peek():
+                return
+            time.sleep(min(1, timeout))
+            if time.time() - start > timeout:
+                return
+
+
+class QueueWatcher(object):
+    """
+    Watches a queue for new items, for consumers that run their own event
+    loop rather than calling the queue's wait()
+
+    fileno() returns a file descriptor that becomes readable when new items
+    may have arrived, or None if pyinotify isn't available, in which case
+    the queue has to be polled. Call clear() once it has become readable.
+    """
+    def __init__(self, q):
+        self.wm = None
+        self.notifier = None
+        if pyinotify:
+            self.wm = pyinotify.WatchManager()
+            self.wm.add_watch(q.watched_dirs(), pyinotify.IN_MOVED_TO)
+            self.notifier = pyinotify.Notifier(self.wm, _MovedHandler())
+
+    def fileno(self):
+        if self.notifier:
+            return self.wm.get_fd()
+        return None
+
+    def clear(self):
+        if self.notifier and self.notifier.check_events(0):
+            self.notifier.read_events()
+            self.notifier.process_events()
+
+    def close(self):
+        if self.notifier:
+            self.notifier.stop()
+            self.notifier = None
+
+
+def open_queuedir(name, queue_dir):
+    """
+    Returns a ShardedQueueDir if queue_dir has been set up as one, otherwise
+    a QueueDir
+    """
+    if ShardedQueueDir.shard_count(queue_dir):
+        return ShardedQueueDir(name, queue_dir)
+    return QueueDir(name, queue_dir)
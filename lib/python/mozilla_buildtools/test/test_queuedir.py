@@ -0,0 +1,409 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from mozilla_buildtools.queuedir import QueueDir, ShardedQueueDir, open_queuedir
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class TestQueueDir(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.q = QueueDir('test', self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _add(self, data, mtime, priority=0):
+        self.q.add(data, priority)
+        # Give items distinct mtimes so we know which order to expect
+        for item in os.listdir(self.q.new_dir):
+            fn = os.path.join(self.q.new_dir, item)
+            if open(fn).read() == data:
+                os.utime(fn, (mtime, mtime))
+
+    def _drain(self):
+        retval = []
+        while True:
+            item = self.q.pop()
+            if not item:
+                return retval
+            item_id, fp = item
+            retval.append(fp.read())
+            fp.close()
+            self.q.remove(item_id)
+
+    def testPopOrder(self):
+        now = time.time()
+        self._add("b", now - 10)
+        self._add("a", now - 20)
+        self._add("c", now - 5)
+        self.assertEquals(self._drain(), ["a", "b", "c"])
+
+    def testPopEmpty(self):
+        self.assertEquals(self.q.pop(), None)
+
+    def testNewItemsAfterOlderOnes(self):
+        now = time.time()
+        self._add("a", now - 20)
+        self._add("b", now - 10)
+        item_id, fp = self.q.pop()
+        self.assertEquals(fp.read(), "a")
+        self._add("c", now)
+        self.assertEquals(self._drain(), ["b", "c"])
+
+    def testRequeueGoesToBack(self):
+        now = time.time()
+        self._add("a", now - 20)
+        self._add("b", now - 10)
+        item_id, fp = self.q.pop()
+        self.q.requeue(item_id)
+        self.assertEquals(self._drain(), ["b", "a"])
+
+    def testTakenByOtherConsumer(self):
+        now = time.time()
+        self._add("a", now - 20)
+        self._add("b", now - 10)
+        self._add("c", now - 5)
+        self.q.pop()
+        # Another consumer takes "b" after we've indexed it
+        other = QueueDir('other', self.tmpdir)
+        item_id, fp = other.pop()
+        self.assertEquals(fp.read(), "b")
+        self.assertEquals(self._drain(), ["c"])
+
+    def testPopUnsorted(self):
+        self.q.add("a")
+        item_id, fp = self.q.pop(sorted=False)
+        self.assertEquals(fp.read(), "a")
+        self.assertEquals(self.q.pop(sorted=False), None)
+
+    def testPopMany(self):
+        now = time.time()
+        for i, data in enumerate("abcde"):
+            self._add(data, now - 10 + i)
+        items = self.q.pop_many(3)
+        self.assertEquals([fp.read() for item_id, fp in items], ["a", "b", "c"])
+        self.assertEquals(len(os.listdir(self.q.cur_dir)), 3)
+        items.extend(self.q.pop_many(3))
+        self.assertEquals(len(items), 5)
+        self.assertEquals(self.q.pop_many(3), [])
+
+    def testRemoveMany(self):
+        for data in "abc":
+            self.q.add(data)
+        item_ids = [item_id for item_id, fp in self.q.pop_many(3)]
+        # Somebody else removed one already
+        self.q.remove(item_ids[0])
+        self.assertEquals(self.q.remove_many(item_ids), 2)
+        self.assertEquals(os.listdir(self.q.cur_dir), [])
+
+    def testRequeueDelayed(self):
+        self.q.add("a")
+        item_id, fp = self.q.pop()
+        self.q.requeue(item_id, delay=0.2)
+        self.assertEquals(os.listdir(self.q.cur_dir), [])
+        self.assertEquals(len(os.listdir(self.q.delayed_dir)), 1)
+        self.assertEquals(self.q.pop(), None)
+        time.sleep(0.3)
+        item_id, fp = self.q.pop()
+        self.assertEquals(fp.read(), "a")
+        self.assertEquals(self.q.getcount(item_id), 1)
+
+    def testDelayedSurvivesRestart(self):
+        self.q.add("a")
+        item_id, fp = self.q.pop()
+        self.q.requeue(item_id, delay=0.2)
+        q = QueueDir('test2', self.tmpdir)
+        self.assertEquals(q.pop(), None)
+        time.sleep(0.3)
+        item_id, fp = q.pop()
+        self.assertEquals(fp.read(), "a")
+
+    def testDelayedOrder(self):
+        for data in "abc":
+            self.q.add(data)
+        for item_id, fp in self.q.pop_many(3):
+            delay = {"a": 0.3, "b": 0.1, "c": 0.2}[fp.read()]
+            self.q.requeue(item_id, delay=delay)
+        time.sleep(0.15)
+        self.assertEquals(self._drain(), ["b"])
+        time.sleep(0.1)
+        self.assertEquals(self._drain(), ["c"])
+        time.sleep(0.1)
+        self.assertEquals(self._drain(), ["a"])
+
+    def testRequeueStormDoesntReloadDelayed(self):
+        # Our own delayed items are already scheduled, so requeueing lots of
+        # them shouldn't make us list delayed over and over
+        self.q.rescan_interval = 60
+        for i in range(200):
+            self.q.add(str(i))
+        loads = []
+        load_delayed = self.q._load_delayed
+
+        def counting_load_delayed():
+            loads.append(1)
+            load_delayed()
+        self.q._load_delayed = counting_load_delayed
+        while True:
+            item = self.q.pop()
+            if not item:
+                break
+            item[1].close()
+            self.q.requeue(item[0], delay=60)
+        self.assertEquals(len(os.listdir(self.q.delayed_dir)), 200)
+        self.assertEquals(len(self.q.to_requeue), 200)
+        self.assertEquals(loads, [])
+
+    def testPriority(self):
+        now = time.time()
+        self._add("a", now - 20)
+        self.q.add("urgent", priority=10)
+        self.q.add("b")
+        item_id, fp = self.q.pop()
+        self.assertEquals(fp.read(), "urgent")
+        self.assertEquals(self.q.getpriority(item_id), 10)
+        # The priority survives being requeued
+        self.q.requeue(item_id)
+        self.assertEquals(self._drain(), ["urgent", "a", "b"])
+
+    def testUrgentJumpsIndex(self):
+        for data in "abc":
+            self.q.add(data)
+        item_id, fp = self.q.pop()
+        self.assertEquals(fp.read(), "a")
+        self.q.add("urgent", priority=1)
+        # Not noticed until the next rescan
+        item_id, fp = self.q.pop()
+        self.assertEquals(fp.read(), "b")
+        self.q._last_scan -= self.q.rescan_interval
+        self.assertEquals(self._drain(), ["urgent", "c"])
+
+    def testAddDelayed(self):
+        # Other processes' delayed items are noticed every rescan_interval
+        self.q.rescan_interval = 0.1
+        other = QueueDir('other', self.tmpdir)
+        other.add("later", delay=0.2)
+        other.add("now")
+        self.assertEquals(self._drain(), ["now"])
+        time.sleep(0.3)
+        self.assertEquals(self._drain(), ["later"])
+
+    def testLag(self):
+        self.assertEquals(self.q.lag(), 0)
+        self._add("a", time.time() - 30)
+        self.q.pop()
+        self.assertTrue(29 < self.q.lag() < 40)
+
+    def testState(self):
+        now = time.time()
+        self._add("a", now - 20)
+        self._add("b", now - 10)
+        self.q.add("c", delay=60)
+        state = self.q.read_state()
+        self.assertEquals((state['new'], state['delayed'], state['added']), (2, 1, 3))
+        # The items were backdated behind the queue's back, so it has the
+        # times they were written until it resyncs
+        self.assertTrue(state['oldest'] > now - 1)
+        self._resync()
+        self.assertEquals(int(self.q.read_state()['oldest']), int(now - 20))
+
+        item_id, fp = self.q.pop()
+        # The oldest item is now "b"
+        state = self.q.read_state()
+        self.assertEquals((state['new'], state['cur'], state['popped']), (1, 1, 1))
+        self.assertEquals(int(state['oldest']), int(now - 10))
+
+        self.q.requeue(item_id, max_retries=0)
+        self.q.remove(self.q.pop()[0])
+        state = self.q.read_state()
+        self.assertEquals((state['new'], state['cur'], state['dead']), (0, 0, 1))
+        self.assertEquals((state['murdered'], state['removed']), (1, 1))
+        self.assertEquals(state['oldest'], None)
+
+    def _resync(self):
+        self.q.last_cleanup = 0
+        self.q.cleanup()
+
+    def testStateOldestAcrossPriorities(self):
+        # The oldest item is a low priority one, which is popped last
+        now = time.time()
+        self._add("old", now - 30)
+        self._add("urgent1", now - 10, priority=5)
+        self._add("urgent2", now - 5, priority=5)
+        self._resync()
+        self.assertEquals(int(self.q.read_state()['oldest']), int(now - 30))
+
+        for expected in "urgent1", "urgent2":
+            item_id, fp = self.q.pop()
+            self.assertEquals(fp.read(), expected)
+            fp.close()
+            self.assertEquals(int(self.q.read_state()['oldest']), int(now - 30))
+
+        # Requeued items are newer than what's left
+        self.q.requeue(item_id)
+        self.assertEquals(int(self.q.read_state()['oldest']), int(now - 30))
+        self.assertEquals(self.q.pop()[1].read(), "urgent2")
+        state = self.q.read_state()
+        self.assertEquals(int(state['oldest']), int(now - 30))
+        self.assertEquals(self.q.pop()[1].read(), "old")
+        self.assertEquals(self.q.read_state()['oldest'], None)
+
+    def testStateUnsorted(self):
+        self.q.add("a")
+        self.q.add("b")
+        # Unsorted pops take items in the order new is listed in. Make the
+        # first one the oldest, with mtimes that would be rounded down if
+        # they were stored at millisecond precision
+        first, second = os.listdir(self.q.new_dir)
+        now = int(time.time())
+        for item, mtime in (first, now - 19.8444), (second, now - 9.8444):
+            os.utime(os.path.join(self.q.new_dir, item), (mtime, mtime))
+        self._resync()
+        self.assertEquals(self.q.read_state()['oldest'], now - 19.8444)
+
+        item_id, fp = self.q.pop(sorted=False)
+        fp.close()
+        self.assertEquals(item_id, first)
+        self.assertEquals(self.q.read_state()['oldest'], now - 9.8444)
+        self.q.pop(sorted=False)
+        self.assertEquals(self.q.read_state()['oldest'], None)
+
+    def testStateResync(self):
+        self.q.add("a")
+        self.q.murder(self.q.pop()[0])
+        self.assertEquals(self.q.read_state()['dead'], 1)
+        # Somebody cleans out dead by hand
+        for f in os.listdir(self.q.dead_dir):
+            os.unlink(os.path.join(self.q.dead_dir, f))
+        self.q.last_cleanup = 0
+        self.q.cleanup()
+        self.assertEquals(self.q.read_state()['dead'], 0)
+
+    def testDrainBenchmark(self):
+        n = 50000
+        for i in xrange(n):
+            self.q.add(str(i))
+        start = time.time()
+        self.assertEquals(len(self._drain()), n)
+        log.info("Drained %i items in %.2fs", n, time.time() - start)
+
+
+class TestShardedQueueDir(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.producer = ShardedQueueDir('test', self.tmpdir, shards=4)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _consumer(self, consumer_id):
+        q = ShardedQueueDir('test', self.tmpdir)
+        q.consumer_id = consumer_id
+        return q
+
+    def _drain(self, q):
+        retval = []
+        for item_id, fp in q.pop_many(100):
+            retval.append(fp.read())
+            fp.close()
+            q.remove(item_id)
+        return retval
+
+    def testOpen(self):
+        self.assertTrue(isinstance(open_queuedir('test', self.tmpdir), ShardedQueueDir))
+        self.assertRaises(ValueError, ShardedQueueDir, 'test', self.tmpdir, 8)
+        other = os.path.join(self.tmpdir, 'plain')
+        self.assertTrue(isinstance(open_queuedir('plain', other), QueueDir))
+
+    def testSingleConsumerGetsEverything(self):
+        data = [str(i) for i in range(20)]
+        for d in data:
+            self.producer.add(d)
+        used = [q for q in self.producer.shards if os.listdir(q.new_dir)]
+        self.assertTrue(len(used) > 1)
+
+        q = self._consumer('c1')
+        self.assertEquals(sorted(self._drain(q)), sorted(data))
+        self.assertEquals(q.leases, set(range(4)))
+
+    def testRebalance(self):
+        c1 = self._consumer('c1')
+        c1.renew()
+        self.assertEquals(len(c1.leases), 4)
+
+        # A second consumer shows up, but c1 still holds everything
+        c2 = self._consumer('c2')
+        c2.renew()
+        self.assertEquals(len(c2.leases), 0)
+
+        # c1 gives up half at its next renewal, and c2 picks them up
+        c1.renew()
+        c2.renew()
+        self.assertEquals(len(c1.leases), 2)
+        self.assertEquals(len(c2.leases), 2)
+        self.assertEquals(c1.leases & c2.leases, set())
+
+        for i in range(20):
+            self.producer.add(str(i))
+        got = self._drain(c1) + self._drain(c2)
+        self.assertEquals(sorted(got), sorted(str(i) for i in range(20)))
+
+    def testMoreConsumersThanShares(self):
+        # 4 shards between 3 consumers: nobody should be left out
+        consumers = [self._consumer('c%i' % i) for i in range(3)]
+        for q in consumers:
+            q.renew()
+        for q in consumers:
+            q.renew()
+        self.assertEquals(sorted(len(q.leases) for q in consumers), [1, 1, 2])
+        self.assertEquals(set.union(*[q.leases for q in consumers]), set(range(4)))
+
+    def testLeaseBrokenDuringRenewal(self):
+        c1 = self._consumer('c1')
+        c1.renew()
+        # The lease is broken between checking its owner and touching it
+        os.unlink(c1._lease_name(0))
+        c1._lease_owner = lambda shard: c1.consumer_id
+        c1.renew()
+        del c1._lease_owner
+        for shard in c1.leases:
+            self.assertEquals(c1._lease_owner(shard), 'c1')
+
+    def testStaleLease(self):
+        c1 = self._consumer('c1')
+        c1.renew()
+        # c1 dies; its leases and heartbeat go stale
+        old = time.time() - 2 * c1.lease_time
+        stale = [os.path.join(c1.lease_dir, f) for f in os.listdir(c1.lease_dir)]
+        stale.append(os.path.join(c1.consumer_dir, 'c1'))
+        for fn in stale:
+            os.utime(fn, (old, old))
+
+        c2 = self._consumer('c2')
+        c2.renew()
+        self.assertEquals(len(c2.leases), 4)
+
+        # c1 notices it lost them
+        c1.renew()
+        self.assertEquals(c1.leases, set())
+
+    def testItemIds(self):
+        self.producer.add("a")
+        q = self._consumer('c1')
+        item_id, fp = q.pop()
+        self.assertEquals(fp.read(), "a")
+        fp.close()
+        q.requeue(item_id)
+        item_id, fp = q.pop()
+        fp.close()
+        self.assertEquals(q.getcount(item_id), 1)
+        q.log(item_id, "hello")
+        self.assertTrue(os.path.exists(q.getlogname(item_id)))
+        self.assertEquals(q.remove_many([item_id]), 1)
+        self.assertEquals(q.pop(), None)
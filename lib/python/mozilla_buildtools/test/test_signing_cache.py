@@ -0,0 +1,118 @@
+import os
+import stat
+import time
+import shutil
+import tempfile
+from unittest import TestCase
+
+import mock
+
+from signing.cache import SigningCache
+
+
+class TestSigningCache(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tmpdir, "cache")
+        self.cache = SigningCache(self.cachedir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def makefile(self, name, data):
+        fn = os.path.join(self.tmpdir, name)
+        open(fn, "wb").write(data)
+        return fn
+
+    def testMiss(self):
+        dest = os.path.join(self.tmpdir, "dest")
+        self.assertFalse(self.cache.get("gpg", "abc", dest))
+        self.assertFalse(os.path.exists(dest))
+        self.assertFalse(self.cache.has("gpg", "abc"))
+        self.assertEquals((self.cache.hits, self.cache.misses), (0, 1))
+
+    def testPutGet(self):
+        src = self.makefile("signed", "signed")
+        self.cache.put("gpg", "abc", src)
+        # Putting it again is fine
+        self.cache.put("gpg", "abc", src)
+        self.assertTrue(self.cache.has("gpg", "abc"))
+        self.assertEquals(os.listdir(os.path.join(self.cachedir, "gpg")), ["abc"])
+
+        dest = self.makefile("dest", "unsigned")
+        self.assertTrue(self.cache.get("gpg", "abc", dest))
+        self.assertEquals(open(dest, "rb").read(), "signed")
+        self.assertFalse(os.path.exists(dest + ".tmp"))
+        self.assertEquals((self.cache.hits, self.cache.misses), (1, 0))
+        self.assertEquals(self.cache.report(), "1 hits; 0 misses; 100% hit rate")
+
+    def testHardlinks(self):
+        src = self.makefile("signed", "signed")
+        self.cache.put("gpg", "abc", src)
+        dest = os.path.join(self.tmpdir, "dest")
+        self.cache.get("gpg", "abc", dest)
+        self.assertEquals(os.stat(dest).st_ino,
+                          os.stat(self.cache.path("gpg", "abc")).st_ino)
+
+    def testCopyWithoutLinks(self):
+        src = self.makefile("signed", "signed")
+        self.cache.put("gpg", "abc", src)
+        dest = os.path.join(self.tmpdir, "dest")
+        with mock.patch("os.link") as link:
+            link.side_effect = OSError(18, "Invalid cross-device link")
+            self.assertTrue(self.cache.get("gpg", "abc", dest))
+        self.assertNotEquals(os.stat(dest).st_ino,
+                             os.stat(self.cache.path("gpg", "abc")).st_ino)
+        self.assertEquals(open(dest, "rb").read(), "signed")
+        self.assertTrue(os.stat(dest).st_mode & stat.S_IWUSR)
+
+    def testReadOnly(self):
+        src = self.makefile("signed", "signed")
+        self.cache.put("gpg", "abc", src)
+        cached_fn = self.cache.path("gpg", "abc")
+        # The entry is a read-only copy; the caller's file is left alone
+        self.assertNotEquals(os.stat(src).st_ino, os.stat(cached_fn).st_ino)
+        self.assertEquals(stat.S_IMODE(os.stat(cached_fn).st_mode), 0444)
+        self.assertTrue(os.stat(src).st_mode & stat.S_IWUSR)
+
+        # Links to it are read-only, and can be replaced
+        dest = os.path.join(self.tmpdir, "dest")
+        self.cache.get("gpg", "abc", dest)
+        self.assertEquals(stat.S_IMODE(os.stat(dest).st_mode), 0444)
+        self.assertTrue(self.cache.get("gpg", "abc", dest))
+
+    def testGetCopy(self):
+        self.cache.put("gpg", "abc", self.makefile("signed", "signed"))
+        dest = os.path.join(self.tmpdir, "dest")
+        self.assertTrue(self.cache.get("gpg", "abc", dest, copy=True))
+        self.assertNotEquals(os.stat(dest).st_ino,
+                             os.stat(self.cache.path("gpg", "abc")).st_ino)
+        open(dest, "ab").write(" and modified")
+        self.assertEquals(open(self.cache.path("gpg", "abc"), "rb").read(), "signed")
+
+    def testEvict(self):
+        self.cache.max_size = 25
+        now = time.time()
+        for i in range(5):
+            self.cache.put("gpg", "hash%i" % i, self.makefile("f%i" % i, "x" * 10))
+            os.utime(self.cache.path("gpg", "hash%i" % i), (now - 100 + i, now - 100 + i))
+        # Using hash0 makes it the most recently used
+        self.cache.get("gpg", "hash0", os.path.join(self.tmpdir, "dest"))
+        self.assertEquals(self.cache.evict(), 3)
+        self.assertEquals(sorted(os.listdir(os.path.join(self.cachedir, "gpg"))),
+                          ["hash0", "hash4"])
+
+    def testEvictStaleTmp(self):
+        self.cache.put("gpg", "abc", self.makefile("signed", "signed"))
+        tmpfile = self.cache.path("gpg", "def") + ".otherhost.123.456.tmp"
+        open(tmpfile, "wb").write("partial")
+        self.assertEquals(len(self.cache.entries()), 1)
+        self.assertTrue(os.path.exists(tmpfile))
+        os.utime(tmpfile, (0, 0))
+        self.cache.entries()
+        self.assertFalse(os.path.exists(tmpfile))
+
+    def testNoMaxSize(self):
+        self.cache.put("gpg", "abc", self.makefile("signed", "signed"))
+        self.assertEquals(self.cache.evict(), 0)
+        self.assertTrue(self.cache.has("gpg", "abc"))
@@ -1 +1,185 @@
+import os
+import shutil
+import hashlib
+import time
+import tempfile
+import threading
+import urllib2
+from StringIO import StringIO
+from unittest import TestCase
+
+import mock
+
 import signing.client
+from signing.client import remote_signfile
+
+
+class FakeResponse(object):
+    def __init__(self, data, code=200, headers=None):
+        self.fp = StringIO(data)
+        self.code = code
+        self.headers = headers or {}
+
+    def info(self):
+        return self.headers
+
+    def read(self, size=-1):
+        return self.fp.read(size)
+
+
+class Options(object):
+    cachedir = None
+    nsscmd = None
+    noncefile = None
+
+
+class TestRemoteSignfile(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "file.exe")
+        open(self.filename, "wb").write("unsigned")
+        self.options = Options()
+        self.options.noncefile = os.path.join(self.tmpdir, "nonce")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testResumeDownload(self):
+        signed = "signed" * 1000
+        digest = hashlib.sha1(signed).hexdigest()
+        offsets = []
+
+        def getfile(baseurl, filehash, format_, offset=0):
+            offsets.append(offset)
+            if not offset:
+                # Connection drops half way through
+                return FakeResponse(signed[:2000], 200, {
+                    'X-SHA1-Digest': digest,
+                    'Content-Length': str(len(signed))})
+            return FakeResponse(signed[offset:], 206, {
+                'X-SHA1-Digest': digest,
+                'Content-Length': str(len(signed) - offset)})
+
+        with mock.patch.object(signing.client, 'getfile', getfile):
+            self.assertTrue(remote_signfile(
+                self.options, ["https://localhost:9110"], self.filename,
+                "signcode", "token"))
+        self.assertEquals(offsets, [0, 2000])
+        self.assertEquals(open(self.filename, "rb").read(), signed)
+
+    def testWaitForPending(self):
+        signed = "signed" * 1000
+        digest = hashlib.sha1(signed).hexdigest()
+        responses = [
+            urllib2.HTTPError("url", 404, "Not Found", {'X-Pending': 'True'},
+                              StringIO("")),
+            FakeResponse(signed, 200, {'X-SHA1-Digest': digest}),
+        ]
+
+        def getfile(baseurl, filehash, format_, offset=0):
+            r = responses.pop(0)
+            if isinstance(r, Exception):
+                raise r
+            return r
+
+        with mock.patch.multiple(signing.client,
+                                 getfile=getfile,
+                                 waitfile=mock.DEFAULT,
+                                 time=mock.DEFAULT) as m:
+            m['waitfile'].return_value = True
+            self.assertTrue(remote_signfile(
+                self.options, ["https://localhost:9110"], self.filename,
+                "signcode", "token"))
+            self.assertEquals(m['waitfile'].call_count, 1)
+            self.assertFalse(m['time'].sleep.called)
+        self.assertEquals(open(self.filename, "rb").read(), signed)
+
+
+class TestRemoteSignfiles(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.options = Options()
+        self.options.noncefile = os.path.join(self.tmpdir, "nonce")
+        self.files = []
+        for name in ("signed.exe", "missing.exe"):
+            fn = os.path.join(self.tmpdir, name)
+            open(fn, "wb").write(name)
+            self.files.append((fn, None))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testOnlyUploadMissing(self):
+        status = {
+            hashlib.sha1("signed.exe").hexdigest(): 'signed',
+            hashlib.sha1("missing.exe").hexdigest(): 'upload',
+        }
+        with mock.patch.multiple(signing.client,
+                                 check_batch=mock.DEFAULT,
+                                 uploadfile=mock.DEFAULT,
+                                 remote_signfile=mock.DEFAULT) as m:
+            m['check_batch'].return_value = status
+            m['remote_signfile'].return_value = True
+            self.assertTrue(signing.client.remote_signfiles(
+                self.options, ["https://localhost:9110"], self.files,
+                "signcode", "token", batch=True))
+            m['uploadfile'].assert_called_once_with(
+                "https://localhost:9110", self.files[1][0], "signcode",
+                "token", nonce="")
+            self.assertEquals(m['remote_signfile'].call_count, 2)
+
+    def testInvalid(self):
+        status = {
+            hashlib.sha1("signed.exe").hexdigest(): 'signed',
+            hashlib.sha1("missing.exe").hexdigest(): 'invalid',
+        }
+        with mock.patch.multiple(signing.client,
+                                 check_batch=mock.DEFAULT,
+                                 remote_signfile=mock.DEFAULT) as m:
+            m['check_batch'].return_value = status
+            m['remote_signfile'].return_value = True
+            self.assertFalse(signing.client.remote_signfiles(
+                self.options, ["https://localhost:9110"], self.files,
+                "signcode", "token", batch=True))
+            self.assertEquals(m['remote_signfile'].call_count, 1)
+
+    def testSpreadOverHosts(self):
+        urls = ["https://host1:9110", "https://host2:9110"]
+        with mock.patch.object(signing.client, 'remote_signfile') as remote_signfile:
+            remote_signfile.return_value = True
+            self.assertTrue(signing.client.remote_signfiles(
+                self.options, urls, self.files, "signcode", "token", jobs=2))
+            used = sorted(c[0][1] for c in remote_signfile.call_args_list)
+            self.assertEquals(used, [urls, urls[::-1]])
+
+
+class TestHostLimits(TestCase):
+    def testLimit(self):
+        limits = signing.client.HostLimits(2)
+        active = []
+        peak = []
+        lock = threading.Lock()
+
+        def connect(url):
+            with limits.connection(url):
+                with lock:
+                    active.append(url)
+                    peak.append(active.count(url))
+                time.sleep(0.01)
+                with lock:
+                    active.remove(url)
+
+        threads = [threading.Thread(target=connect, args=("https://host%i" % (i % 2),))
+                   for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals(len(peak), 10)
+        self.assertTrue(max(peak) <= 2)
+
+    def testNoLimit(self):
+        limits = signing.client.HostLimits()
+        with limits.connection("https://host1"):
+            with limits.connection("https://host1"):
+                pass
@@ -0,0 +1,80 @@
+from StringIO import StringIO
+from unittest import TestCase
+
+from signing.multipart import parse_multipart, MultipartError
+
+BOUNDARY = 'xYzZY'
+
+
+def encode(fields):
+    lines = []
+    for name, value in fields:
+        lines.append('--' + BOUNDARY)
+        if isinstance(value, tuple):
+            lines.append('Content-Disposition: form-data; name="%s"; filename="%s"' % (name, value[0]))
+            lines.append('Content-Type: application/octet-stream')
+            value = value[1]
+        else:
+            lines.append('Content-Disposition: form-data; name="%s"' % name)
+        lines.append('')
+        lines.append(value)
+    lines.append('--' + BOUNDARY + '--')
+    lines.append('')
+    return '\r\n'.join(lines)
+
+
+class Collector(object):
+    def __init__(self, name, filename):
+        self.name = name
+        self.filename = filename
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def data(self):
+        return ''.join(self.chunks)
+
+
+class TestParseMultipart(TestCase):
+    content_type = 'multipart/form-data; boundary=%s' % BOUNDARY
+
+    def parse(self, body, blocksize=1024 ** 2, open_file=Collector):
+        return parse_multipart(StringIO(body), self.content_type, len(body),
+                               open_file, blocksize)
+
+    def testFields(self):
+        body = encode([('token', 'abc'), ('sha1', '1234'), ('empty', '')])
+        self.assertEquals(self.parse(body), {'token': 'abc', 'sha1': '1234', 'empty': ''})
+
+    def testFile(self):
+        data = ''.join(chr(i % 256) for i in range(10000)) + '\r\n--xYz'
+        body = encode([('token', 'abc'), ('filedata', ('foo.exe', data)), ('sha1', '1234')])
+        # Small blocks make the delimiter straddle reads
+        for blocksize in (1, 7, 100, 1024 ** 2):
+            values = self.parse(body, blocksize)
+            self.assertEquals(values['token'], 'abc')
+            self.assertEquals(values['sha1'], '1234')
+            self.assertEquals(values['filedata'].filename, 'foo.exe')
+            self.assertEquals(values['filedata'].data(), data)
+
+    def testWriteError(self):
+        class Full(Collector):
+            def write(self, data):
+                raise IOError("disk full")
+
+        body = encode([('filedata', ('foo.exe', 'x' * 1000))])
+        self.assertRaises(IOError, self.parse, body, 10, Full)
+
+    def testTruncated(self):
+        body = encode([('token', 'abc'), ('filedata', ('foo.exe', 'x' * 1000))])
+        self.assertRaises(MultipartError, parse_multipart, StringIO(body[:500]),
+                          self.content_type, len(body), Collector)
+
+    def testBadContentType(self):
+        self.assertRaises(MultipartError, parse_multipart, StringIO(''),
+                          'application/x-www-form-urlencoded', 0, Collector)
+
+    def testFieldTooLarge(self):
+        body = encode([('token', 'x' * (1024 ** 2))])
+        self.assertRaises(MultipartError, self.parse, body)
@@ -6,18 +6,27 @@ if sys.version_info < (2, 6, 0):
     raise SkipTest
 
 
+import os
 import time
+import json
 import hashlib
 import shutil
 import tempfile
 from unittest import TestCase
 from StringIO import StringIO
 from ConfigParser import RawConfigParser
+from multiprocessing.pool import ThreadPool
+from wsgiref.util import FileWrapper
 import mock
 import webob
+import gevent
+from gevent.event import Event
 
 import signing.server as ss
 
+import logging
+log = logging.getLogger(__name__)
+
 
 class TestTokens(TestCase):
     def testTokenData(self):
@@ -31,6 +40,258 @@ class TestTokens(TestCase):
         self.assertEquals(unpacked, dict(
             slave_ip="1.2.3.4", valid_from=now, valid_to=now + 300))
 
+
+class TestRunSignscript(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.outputfile = os.path.join(self.tmpdir, "output")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_script(self, script, **kwargs):
+        return ss.run_signscript(["sh", "-c", script, "sh"], "input",
+                                 self.outputfile, "filename", "gpg", **kwargs)
+
+    def testSuccess(self):
+        start = time.time()
+        self.assertEquals(self.run_script("echo $1 $4"), 0)
+        # We hear about the child exiting right away
+        self.assertTrue(time.time() - start < 0.2)
+        self.assertEquals(open(self.outputfile + ".out").read(), "gpg filename\n")
+
+    def testPassphrase(self):
+        self.assertEquals(self.run_script("read p; test $p = secret",
+                                          passphrase="secret\n"), 0)
+
+    def testRetry(self):
+        self.assertEquals(self.run_script("exit 1", max_tries=3, retry_delay=0), 1)
+
+    def testRetrySucceeds(self):
+        marker = os.path.join(self.tmpdir, "marker")
+        script = "test -e %s && exit 0; touch %s; exit 1" % (marker, marker)
+        self.assertEquals(self.run_script(script, max_tries=2, retry_delay=0), 0)
+
+    def testTimeout(self):
+        start = time.time()
+        self.assertEquals(self.run_script("sleep 30", max_tries=1, max_time=0.2), 1)
+        self.assertTrue(time.time() - start < 5)
+
+    def testKillEscalation(self):
+        # The script ignores SIGINT and SIGTERM, so it has to be SIGKILLed
+        start = time.time()
+        self.assertEquals(self.run_script("trap '' INT TERM; sleep 30 & wait; sleep 30",
+                                          max_tries=1, max_time=0.2), 1)
+        self.assertTrue(time.time() - start < 10)
+
+
+class TestHashingService(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pool = ThreadPool(2)
+        self.hasher = ss.HashingService(self.pool)
+
+    def tearDown(self):
+        self.hasher.stop()
+        self.pool.close()
+        self.pool.join()
+        shutil.rmtree(self.tmpdir)
+
+    def testSha1sum(self):
+        fn = os.path.join(self.tmpdir, "file")
+        open(fn, "wb").write("hello world")
+        self.assertEquals(self.hasher.sha1sum(fn),
+                          hashlib.sha1("hello world").hexdigest())
+
+    def testMissing(self):
+        self.assertRaises(IOError, self.hasher.sha1sum,
+                          os.path.join(self.tmpdir, "missing"))
+
+    def testConcurrent(self):
+        files = []
+        for i in range(10):
+            fn = os.path.join(self.tmpdir, "file%i" % i)
+            open(fn, "wb").write("file%i" % i)
+            files.append(fn)
+        jobs = [gevent.spawn(self.hasher.sha1sum, f) for f in files]
+        gevent.joinall(jobs, timeout=5)
+        self.assertEquals([j.value for j in jobs],
+                          [hashlib.sha1("file%i" % i).hexdigest() for i in range(10)])
+
+
+class TestDigestIndex(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbfile = os.path.join(self.tmpdir, "digests.sqlite")
+        self.index = ss.DigestIndex(self.dbfile)
+        self.fn = os.path.join(self.tmpdir, "file")
+        open(self.fn, "wb").write("hello world")
+        self.digest = hashlib.sha1("hello world").hexdigest()
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tmpdir)
+
+    def testLookupRecorded(self):
+        self.index.record("abc", "gpg", self.fn, self.digest, "file.txt")
+        with mock.patch("signing.server.sha1sum") as sha1sum:
+            self.assertEquals(self.index.lookup("abc", "gpg", self.fn),
+                              self.digest)
+            self.assertFalse(sha1sum.called)
+
+    def testLookupUnrecorded(self):
+        self.assertEquals(self.index.lookup("abc", "gpg", self.fn),
+                          self.digest)
+        # Now it's recorded
+        with mock.patch("signing.server.sha1sum") as sha1sum:
+            self.index.lookup("abc", "gpg", self.fn)
+            self.assertFalse(sha1sum.called)
+
+    def testLookupChanged(self):
+        self.index.record("abc", "gpg", self.fn, self.digest)
+        open(self.fn, "wb").write("goodbye world")
+        self.assertEquals(self.index.lookup("abc", "gpg", self.fn),
+                          hashlib.sha1("goodbye world").hexdigest())
+
+    def testLookupMissing(self):
+        self.assertRaises(IOError, self.index.lookup, "abc", "gpg",
+                          os.path.join(self.tmpdir, "missing"))
+
+    def testTouch(self):
+        self.index.record("abc", "gpg", self.fn, self.digest)
+        os.utime(self.fn, (0, 0))
+        self.index.touch("abc", "gpg", self.fn)
+        self.assertNotEquals(os.path.getmtime(self.fn), 0)
+        with mock.patch("signing.server.sha1sum") as sha1sum:
+            self.index.lookup("abc", "gpg", self.fn)
+            self.assertFalse(sha1sum.called)
+
+    def testTouchBatched(self):
+        os.utime(self.fn, (0, 0))
+        self.index.record("abc", "gpg", self.fn, self.digest)
+
+        def stored_mtime():
+            other = ss.DigestIndex(self.dbfile)
+            mtime = other.db.execute("SELECT mtime FROM digests").fetchone()[0]
+            other.close()
+            return mtime
+
+        # Touching doesn't commit anything until the index is flushed
+        self.index.touch("abc", "gpg", self.fn)
+        self.assertEquals(stored_mtime(), 0)
+        with mock.patch("signing.server.sha1sum") as sha1sum:
+            self.index.lookup("abc", "gpg", self.fn)
+            self.assertFalse(sha1sum.called)
+        self.index.flush()
+        self.assertEquals(stored_mtime(), os.path.getmtime(self.fn))
+
+    def testForget(self):
+        self.index.record("abc", "gpg", self.fn, "bogus")
+        self.index.forget("abc", "gpg")
+        self.assertEquals(self.index.lookup("abc", "gpg", self.fn),
+                          self.digest)
+
+    def testPersistent(self):
+        self.index.record("abc", "gpg", self.fn, self.digest)
+        self.index.close()
+        self.index = ss.DigestIndex(self.dbfile)
+        with mock.patch("signing.server.sha1sum") as sha1sum:
+            self.assertEquals(self.index.lookup("abc", "gpg", self.fn),
+                              self.digest)
+            self.assertFalse(sha1sum.called)
+
+
+class TestParseRange(TestCase):
+    def testNoRange(self):
+        self.assertEquals(ss.parse_range(None, 100), None)
+        self.assertEquals(ss.parse_range("", 100), None)
+
+    def testUnknownRange(self):
+        self.assertEquals(ss.parse_range("bytes=0-1,5-6", 100), None)
+        self.assertEquals(ss.parse_range("lines=0-1", 100), None)
+        self.assertEquals(ss.parse_range("bytes=-", 100), None)
+
+    def testRanges(self):
+        self.assertEquals(ss.parse_range("bytes=10-", 100), (10, 99))
+        self.assertEquals(ss.parse_range("bytes=10-19", 100), (10, 19))
+        self.assertEquals(ss.parse_range("bytes=10-1000", 100), (10, 99))
+        self.assertEquals(ss.parse_range("bytes=-10", 100), (90, 99))
+        self.assertEquals(ss.parse_range("bytes=-1000", 100), (0, 99))
+
+    def testUnsatisfiable(self):
+        self.assertRaises(ValueError, ss.parse_range, "bytes=100-", 100)
+        self.assertRaises(ValueError, ss.parse_range, "bytes=20-10", 100)
+
+
+class TestSigner(TestCase):
+    def setUp(self):
+        self.signed = []
+        self.running = []
+        self.max_running = {}
+
+    def makeSigner(self, concurrency, format_concurrency=None):
+        signer = ss.Signer(mock.Mock(), "signscript.py", "unsigned", "signed",
+                           concurrency, {}, format_concurrency)
+
+        def sign(item):
+            filehash, filename, format_, e = item
+            self.running.append(format_)
+            self.max_running[format_] = max(self.max_running.get(format_, 0),
+                                            self.running.count(format_))
+            try:
+                gevent.sleep(0.01)
+                self.signed.append(filename)
+            finally:
+                self.running.remove(format_)
+                e.set()
+        signer._sign = sign
+        return signer
+
+    def testSignFiles(self):
+        signer = self.makeSigner(2)
+        events = [signer.signfile("hash%i" % i, "file%i" % i, "gpg")
+                  for i in range(5)]
+        for e in events:
+            self.assertTrue(e.wait(timeout=5))
+        self.assertEquals(sorted(self.signed), ["file%i" % i for i in range(5)])
+        self.assertEquals(self.max_running, {"gpg": 2})
+        # Workers stick around for more work
+        self.assertTrue(all(not w.dead for w in signer.workers))
+        signer.stop()
+
+    def testFormatConcurrency(self):
+        signer = self.makeSigner(3, {"dmg": 1})
+        events = [signer.signfile("hash%i" % i, "dmg%i" % i, "dmg")
+                  for i in range(3)]
+        events.append(signer.signfile("hash", "gpg", "gpg"))
+        self.assertEquals(signer.queue_depth(), 4)
+        self.assertEquals(signer.queue_depth("dmg"), 3)
+        for e in events:
+            self.assertTrue(e.wait(timeout=5))
+        self.assertEquals(self.max_running["dmg"], 1)
+        # gpg didn't have to wait for all the dmgs
+        self.assertTrue(self.signed.index("gpg") < self.signed.index("dmg2"))
+        signer.stop()
+
+    def testStats(self):
+        signer = self.makeSigner(1)
+        signer.signfile("hash", "file", "gpg").wait(timeout=5)
+        stats = signer.stats()
+        self.assertEquals(stats["gpg"]["queued"], 0)
+        self.assertEquals(stats["gpg"]["active"], 0)
+        self.assertEquals(stats["gpg"]["signed"], 1)
+        signer.stop()
+
+    def testStop(self):
+        signer = self.makeSigner(2)
+        e = signer.signfile("hash", "file", "gpg")
+        signer.stop()
+        gevent.joinall(signer.workers, timeout=5)
+        # The queue was drained before exiting
+        self.assertTrue(e.is_set())
+        self.assertTrue(all(w.dead for w in signer.workers))
+        self.assertRaises(AssertionError, signer.signfile, "hash", "file", "gpg")
+
 config_data = """
 [server]
 port = 8080
@@ -208,3 +469,206 @@ class TestSigningServer(TestCase):
         # try futzing with the token data
         token = token.replace(slave, '127.0.0.99')
         sign(token, nonce3, 'evenmorestuff.txt', 'stuff!!\n' * 100, slave='127.0.0.99', expect_fail=True)
+
+    def _upload(self, data, token='token'):
+        req = webob.Request.blank("/sign/gpg", POST={
+            'filedata': ('stuff.txt', data),
+            'token': token,
+            'nonce': '',
+            'filename': 'stuff.txt',
+            'sha1': hashlib.sha1(data).hexdigest()})
+        req.environ['REMOTE_ADDR'] = '127.0.0.0'
+        req.method = 'POST'
+        return req.get_response(self.server)
+
+    def testUploadTooLarge(self):
+        self.server.max_filesize['gpg'] = 100
+        # The file is too big to even try reading
+        resp = self._upload('x' * (128 * 1024))
+        self.assertEquals(resp.status_code, 400)
+        self.assertEquals(resp.status, '400 File too large')
+        # The file is small enough that we stop part way through
+        resp = self._upload('x' * 1000)
+        self.assertEquals(resp.status, '400 File too large')
+        self.assertEquals(os.listdir(self.server.unsigned_dir), [])
+
+    def testUploadBadToken(self):
+        token = self.server.get_token('1.2.3.4', 300)
+        resp = self._upload('stuff\n' * 100, token)
+        self.assertEquals(resp.status, '400 Invalid token')
+        # The upload is cleaned up
+        self.assertEquals(os.listdir(self.server.unsigned_dir), [])
+
+    def _make_signed(self, data, format_='gpg'):
+        filehash = hashlib.sha1('unsigned' + data).hexdigest()
+        signed_dir = os.path.join(self.tmpdir, 'signed-files', format_)
+        if not os.path.exists(signed_dir):
+            os.makedirs(signed_dir)
+        fn = self.server.get_path(filehash, format_)
+        open(fn, 'wb').write(data)
+        self.server.digests.record(filehash, format_, fn,
+                                   hashlib.sha1(data).hexdigest())
+        return filehash
+
+    def testGetSignedFromIndex(self):
+        data = 'signed stuff\n' * 100
+        filehash = self._make_signed(data)
+
+        req = webob.Request.blank("/sign/gpg/%s" % filehash)
+        req.environ['REMOTE_ADDR'] = '127.0.0.1'
+        with mock.patch("signing.server.sha1sum") as sha1sum:
+            resp = req.get_response(self.server)
+            self.assertFalse(sha1sum.called)
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(resp.headers['X-SHA1-Digest'],
+                          hashlib.sha1(data).hexdigest())
+        self.assertEquals(resp.body, data)
+
+    def testGetRange(self):
+        data = 'signed stuff\n' * 100
+        filehash = self._make_signed(data)
+
+        req = webob.Request.blank("/sign/gpg/%s" % filehash)
+        req.environ['REMOTE_ADDR'] = '127.0.0.1'
+        req.headers['Range'] = 'bytes=100-'
+        resp = req.get_response(self.server)
+        self.assertEquals(resp.status_code, 206)
+        self.assertEquals(resp.headers['Content-Range'],
+                          'bytes 100-%i/%i' % (len(data) - 1, len(data)))
+        # The digest is always of the whole file
+        self.assertEquals(resp.headers['X-SHA1-Digest'],
+                          hashlib.sha1(data).hexdigest())
+        self.assertEquals(resp.body, data[100:])
+
+    def testGetFileWrapper(self):
+        data = 'signed stuff\n' * 100
+        filehash = self._make_signed(data)
+
+        for range_header, expected in (None, data), ('bytes=100-199', data[100:200]):
+            req = webob.Request.blank("/sign/gpg/%s" % filehash)
+            req.environ['REMOTE_ADDR'] = '127.0.0.1'
+            req.environ['wsgi.file_wrapper'] = FileWrapper
+            if range_header:
+                req.headers['Range'] = range_header
+            resp = req.get_response(self.server)
+            self.assertTrue(isinstance(resp.app_iter, FileWrapper))
+            self.assertEquals(resp.body, expected)
+
+    def testGetBenchmark(self):
+        # Ranged downloads shouldn't be any slower than whole ones
+        data = os.urandom(1024 ** 2) * 64
+        filehash = self._make_signed(data)
+        # Stop cleanup from deleting the signed file while we're timing
+        open(os.path.join(self.tmpdir, 'unsigned-files', filehash), 'wb').write('unsigned')
+
+        def get(range_header=None):
+            req = webob.Request.blank("/sign/gpg/%s" % filehash)
+            req.environ['REMOTE_ADDR'] = '127.0.0.1'
+            if range_header:
+                req.headers['Range'] = range_header
+            start = time.time()
+            resp = req.get_response(self.server)
+            size = sum(len(block) for block in resp.app_iter)
+            return size, time.time() - start
+
+        size, whole = get()
+        self.assertEquals(size, len(data))
+        size, ranged = get('bytes=1-')
+        self.assertEquals(size, len(data) - 1)
+        log.info("Whole: %.2fs; ranged: %.2fs", whole, ranged)
+        self.assertTrue(ranged < whole * 1.5 + 0.1)
+
+    def testGetBadRange(self):
+        data = 'signed stuff\n' * 100
+        filehash = self._make_signed(data)
+
+        req = webob.Request.blank("/sign/gpg/%s" % filehash)
+        req.environ['REMOTE_ADDR'] = '127.0.0.1'
+        req.headers['Range'] = 'bytes=%i-' % len(data)
+        resp = req.get_response(self.server)
+        self.assertEquals(resp.status_code, 416)
+        self.assertEquals(resp.headers['Content-Range'],
+                          'bytes */%i' % len(data))
+
+    def testSignBatch(self):
+        token = self.server.get_token('127.0.0.1', 300)
+        signed = self._make_signed('signed stuff\n' * 100)
+        unsigned_data = 'unsigned stuff\n' * 100
+        unsigned = hashlib.sha1(unsigned_data).hexdigest()
+        open(os.path.join(self.tmpdir, 'unsigned-files', unsigned), 'wb').write(unsigned_data)
+        missing = hashlib.sha1('missing').hexdigest()
+
+        manifest = [
+            {'sha1': signed, 'filename': 'signed.exe'},
+            {'sha1': unsigned, 'filename': 'unsigned.exe'},
+            {'sha1': missing, 'filename': 'missing.exe'},
+            {'sha1': '../../etc/passwd', 'filename': 'passwd'},
+        ]
+        req = webob.Request.blank("/sign_batch/gpg", POST={
+            'token': token,
+            'manifest': json.dumps(manifest)})
+        req.environ['REMOTE_ADDR'] = '127.0.0.1'
+        req.method = 'POST'
+        with mock.patch.object(self.server.signer, 'signfile') as signfile:
+            resp = req.get_response(self.server)
+            signfile.assert_called_once_with(unsigned, 'unsigned.exe', 'gpg')
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(json.loads(resp.body), {
+            signed: 'signed',
+            unsigned: 'pending',
+            missing: 'upload',
+            '../../etc/passwd': 'invalid',
+        })
+        self.assertEquals(self.server.get_filename(unsigned), 'unsigned.exe')
+
+    def testSignBatchBadToken(self):
+        req = webob.Request.blank("/sign_batch/gpg", POST={
+            'token': 'bad!token',
+            'manifest': '[]'})
+        req.environ['REMOTE_ADDR'] = '127.0.0.1'
+        req.method = 'POST'
+        resp = req.get_response(self.server)
+        self.assertEquals(resp.status_code, 400)
+
+    def _wait(self, filehash):
+        req = webob.Request.blank("/wait/gpg/%s" % filehash)
+        req.environ['REMOTE_ADDR'] = '127.0.0.1'
+        return req.get_response(self.server)
+
+    def testWaitUnknown(self):
+        resp = self._wait(hashlib.sha1('unknown').hexdigest())
+        self.assertEquals(resp.status_code, 404)
+
+    def testWaitSigned(self):
+        filehash = self._make_signed('signed stuff\n' * 100)
+        resp = self._wait(filehash)
+        self.assertEquals(resp.status_code, 200)
+
+    def testWaitPending(self):
+        data = 'signed stuff\n' * 100
+        filehash = hashlib.sha1('unsigned' + data).hexdigest()
+        e = Event()
+        self.server.pending[filehash, 'gpg'] = e
+
+        def finish():
+            self._make_signed(data)
+            e.set()
+        gevent.spawn_later(0.1, finish)
+        resp = self._wait(filehash)
+        self.assertEquals(resp.status_code, 200)
+
+    def testWaitTimeout(self):
+        filehash = hashlib.sha1('unsigned').hexdigest()
+        self.server.pending[filehash, 'gpg'] = Event()
+        self.server.wait_timeout = 0.1
+        resp = self._wait(filehash)
+        self.assertEquals(resp.status_code, 202)
+        self.assertEquals(resp.headers['X-Pending'], 'True')
+
+    def testWaitFailed(self):
+        filehash = hashlib.sha1('unsigned').hexdigest()
+        e = Event()
+        e.set()
+        self.server.pending[filehash, 'gpg'] = e
+        resp = self._wait(filehash)
+        self.assertEquals(resp.status_code, 404)
@@ -0,0 +1,199 @@
+"""Content addressed cache of signed files, shared between signtool runs"""
+import os
+import errno
+import stat
+import socket
+import threading
+import time
+
+from util.file import copyfile
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def link_or_copy(src, dst):
+    """Hardlinks src to dst if possible, otherwise copies it
+
+    Returns True if dst is a link to src"""
+    if hasattr(os, 'link'):
+        try:
+            os.link(src, dst)
+            return True
+        except OSError, e:
+            # Different filesystems, or the filesystem doesn't support links
+            log.debug("Couldn't link %s to %s (%s); copying", src, dst, e)
+    copyfile(src, dst)
+    return False
+
+
+def make_writable(fn):
+    os.chmod(fn, stat.S_IMODE(os.stat(fn).st_mode) | stat.S_IWUSR)
+
+
+def force_unlink(fn):
+    """Removes fn, even if it's read-only, which windows doesn't allow"""
+    try:
+        os.unlink(fn)
+    except OSError:
+        make_writable(fn)
+        os.unlink(fn)
+
+
+class SigningCache(object):
+    """
+    Cache of signed files, keyed by format and the sha1 of the unsigned file
+
+    `cachedir` is the root of the cache. Files are stored as
+        <cachedir>/<format>/<hash>
+    `max_size` is the maximum size of the cache in bytes. If set, the least
+        recently used entries are removed by evict() until the cache is
+        smaller than this.
+
+    Entries are written to a temporary file that is unique to this host and
+    process, and then renamed into place, so several slaves can share the
+    cache over NFS without seeing partial files. Hits are hardlinked into
+    place where possible rather than copied, and touch the entry so that
+    eviction removes the least recently used entries first.
+
+    Since hits share the entry's inode, entries are read-only. Callers that
+    want to modify what they get from the cache must ask for a copy.
+    """
+    # Temporary files older than this are assumed to have been left behind
+    # by a crashed process
+    max_tmp_age = 3600
+
+    def __init__(self, cachedir, max_size=None):
+        self.cachedir = cachedir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def path(self, fmt, filehash):
+        return os.path.join(self.cachedir, fmt, filehash)
+
+    def _tmpname(self, fmt, filehash):
+        return "%s.%s.%i.%i.tmp" % (self.path(fmt, filehash), socket.gethostname(),
+                                    os.getpid(), threading.current_thread().ident)
+
+    def has(self, fmt, filehash):
+        return os.path.exists(self.path(fmt, filehash))
+
+    def get(self, fmt, filehash, dest, copy=False):
+        """Places the cached signed copy of `filehash` at `dest`.
+
+        dest is a read-only link to the cache entry where possible. If copy
+        is True, or links aren't supported, it's a writable copy instead.
+
+        Returns True if it was in the cache, False otherwise."""
+        cached_fn = self.path(fmt, filehash)
+        tmpfile = dest + '.tmp'
+        if os.path.exists(tmpfile):
+            force_unlink(tmpfile)
+        try:
+            if copy:
+                copyfile(cached_fn, tmpfile)
+                linked = False
+            else:
+                linked = link_or_copy(cached_fn, tmpfile)
+        except (IOError, OSError), e:
+            if e.errno != errno.ENOENT:
+                raise
+            with self._lock:
+                self.misses += 1
+            return False
+        if not linked:
+            make_writable(tmpfile)
+        if os.path.exists(dest):
+            force_unlink(dest)
+        os.rename(tmpfile, dest)
+        try:
+            # Mark it as recently used
+            os.utime(cached_fn, None)
+        except OSError:
+            # Somebody evicted it already
+            pass
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def put(self, fmt, filehash, filename):
+        """Stores `filename` as the signed copy of `filehash`"""
+        cached_fn = self.path(fmt, filehash)
+        if os.path.exists(cached_fn):
+            return
+        try:
+            os.makedirs(os.path.dirname(cached_fn))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        tmpname = self._tmpname(fmt, filehash)
+        try:
+            # Copy rather than link, so that making the entry read-only
+            # doesn't affect the caller's file
+            copyfile(filename, tmpname)
+            os.chmod(tmpname, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.rename(tmpname, cached_fn)
+        except OSError:
+            # Somebody else put it in the cache first (renaming over existing
+            # files fails on windows)
+            log.debug("Couldn't add %s to the cache as %s", filename, cached_fn,
+                      exc_info=True)
+        if os.path.exists(tmpname):
+            force_unlink(tmpname)
+
+    def entries(self):
+        """Returns a list of (last used time, size, path) for everything in the
+        cache. Stale temporary files are removed."""
+        now = time.time()
+        retval = []
+        if not os.path.isdir(self.cachedir):
+            return retval
+        for fmt in os.listdir(self.cachedir):
+            fmt_dir = os.path.join(self.cachedir, fmt)
+            if not os.path.isdir(fmt_dir):
+                continue
+            for f in os.listdir(fmt_dir):
+                fn = os.path.join(fmt_dir, f)
+                try:
+                    st = os.stat(fn)
+                    if f.endswith('.tmp'):
+                        if st.st_mtime < now - self.max_tmp_age:
+                            log.debug("Removing stale %s", fn)
+                            force_unlink(fn)
+                        continue
+                except OSError:
+                    # Somebody else removed it
+                    continue
+                retval.append((st.st_mtime, st.st_size, fn))
+        return retval
+
+    def evict(self):
+        """Removes the least recently used entries until the cache is smaller
+        than max_size. Returns how many entries were removed."""
+        if not self.max_size:
+            return 0
+        entries = self.entries()
+        size = sum(e[1] for e in entries)
+        removed = 0
+        for mtime, entry_size, fn in sorted(entries):
+            if size <= self.max_size:
+                break
+            log.debug("Evicting %s", fn)
+            try:
+                force_unlink(fn)
+            except OSError:
+                # Somebody else evicted it
+                pass
+            size -= entry_size
+            removed += 1
+        return removed
+
+    def report(self):
+        total = self.hits + self.misses
+        if total:
+            rate = 100.0 * self.hits / total
+        else:
+            rate = 0.0
+        return "%i hits; %i misses; %.0f%% hit rate" % (self.hits, self.misses, rate)
@@ -1,30 +1,106 @@
 import base64
 import urllib2
 import os
-import hashlib
 import time
 import socket
 import httplib
 import urllib
+import json
+import errno
+import threading
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 # TODO: Use util.command
 from subprocess import check_call
 
 from poster.encode import multipart_encode
 
-from util.file import sha1sum, copyfile
+from util.file import sha1sum
+from signing.cache import SigningCache
 
 import logging
 log = logging.getLogger(__name__)
 
+# Protects the nonce file when signing files concurrently
+_nonce_lock = threading.Lock()
 
-def getfile(baseurl, filehash, format_):
+
+class HostLimits(object):
+    """Limits how many connections are made to each signing server at once
+    when signing files concurrently.
+
+    `max_connections` is the maximum number of connections per server; None
+    means no limit."""
+    def __init__(self, max_connections=None):
+        self.max_connections = max_connections
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    @contextmanager
+    def connection(self, url):
+        if not self.max_connections:
+            yield
+            return
+        with self._lock:
+            if url not in self._semaphores:
+                self._semaphores[url] = threading.BoundedSemaphore(self.max_connections)
+            sem = self._semaphores[url]
+        with sem:
+            yield
+
+
+def read_nonce(noncefile):
+    with _nonce_lock:
+        try:
+            return open(noncefile, 'rb').read()
+        except IOError:
+            return ""
+
+
+def write_nonce(noncefile, nonce):
+    with _nonce_lock:
+        open(noncefile, 'wb').write(nonce)
+
+
+def getfile(baseurl, filehash, format_, offset=0):
+    """GET the signed copy of `filehash` in `format_` from `baseurl`.
+
+    If `offset` is set, only request data from that byte onwards. Servers
+    that support ranges respond with 206 Partial Content."""
     url = "%s/sign/%s/%s" % (baseurl, format_, filehash)
     log.debug("%s: GET %s", filehash, url)
     r = urllib2.Request(url)
+    if offset:
+        log.debug("%s: requesting bytes from %i", filehash, offset)
+        r.add_header('Range', 'bytes=%i-' % offset)
     return urllib2.urlopen(r)
 
 
+def waitfile(baseurl, filehash, format_):
+    """Waits for the server at `baseurl` to finish signing `filehash` with
+    `format_`. The server holds the request open until signing is done, or
+    until its own timeout expires.
+
+    Returns True if it's worth trying to fetch the file straight away, or
+    False if the server doesn't support waiting and the caller should back
+    off before trying again."""
+    url = "%s/wait/%s/%s" % (baseurl, format_, filehash)
+    log.debug("%s: GET %s", filehash, url)
+    try:
+        urllib2.urlopen(urllib2.Request(url)).read()
+    except urllib2.HTTPError, e:
+        if e.code == 400:
+            log.debug("%s: server doesn't support waiting", filehash)
+            return False
+        # Signing failed or the server doesn't know about the file; fetching
+        # it will cause it to be uploaded again
+    except (urllib2.URLError, socket.error, httplib.BadStatusLine):
+        log.debug("%s: error waiting for file", filehash, exc_info=True)
+        return False
+    return True
+
+
 def get_token(baseurl, username, password, slave_ip, duration):
     auth = base64.encodestring('%s:%s' % (username, password)).rstrip('\n')
     url = '%s/token' % baseurl
@@ -40,43 +116,133 @@ def get_token(baseurl, username, password, slave_ip, duration):
     return urllib2.urlopen(r).read()
 
 
-def remote_signfile(options, urls, filename, fmt, token, dest=None):
+def check_batch(baseurl, manifest, format_, token):
+    """Asks the server at `baseurl` about a batch of files to be signed with
+    `format_`.
+
+    `manifest` is a list of {"sha1": ..., "filename": ...} dicts. Returns a
+    dict mapping each sha1 to its status on the server: one of 'signed',
+    'pending', 'upload' or 'invalid'."""
+    url = "%s/sign_batch/%s" % (baseurl, format_)
+    log.debug("POST %s (%i files)", url, len(manifest))
+    data = urllib.urlencode({
+        'token': token,
+        'manifest': json.dumps(manifest),
+    })
+    r = urllib2.Request(url, data, {'Content-Length': str(len(data))})
+    return json.load(urllib2.urlopen(r))
+
+
+def remote_signfiles(options, urls, files, fmt, token, jobs=1, batch=False,
+                     max_host_connections=None, cache=None):
+    """Signs a list of files with `fmt`, `jobs` files at a time.
+
+    `files` is a list of (filename, dest) tuples, where dest may be None to
+    replace the original file.
+
+    If `batch` is set, the first server is asked about all the files at once,
+    so that only the files it doesn't already have are uploaded. Otherwise
+    the files are spread over all the servers in `urls`.
+
+    `max_host_connections` limits how many connections are made to any one
+    server at a time.
+
+    `cache` is a SigningCache to share between the files; by default one is
+    created for options.cachedir if it's set.
+
+    Returns True if all the files were signed successfully."""
+    if cache is None and options.cachedir:
+        cache = SigningCache(options.cachedir)
+    hashes = {}
+    manifest = []
+    status = {}
+    if batch:
+        for filename, dest in files:
+            filehash = sha1sum(filename)
+            hashes[filename] = filehash
+            if cache and cache.has(fmt, filehash):
+                continue
+            manifest.append({'sha1': filehash, 'filename': os.path.basename(filename)})
+
+    if manifest:
+        try:
+            status = check_batch(urls[0], manifest, fmt, token)
+        except (urllib2.URLError, socket.error, httplib.BadStatusLine, ValueError):
+            log.warn("batch request to %s failed; signing files one at a time", urls[0],
+                     exc_info=True)
+
+    limits = HostLimits(max_host_connections)
+
+    def sign(args):
+        i, (filename, dest) = args
+        # Each file gets its own copy of the urls, since remote_signfile
+        # rotates them on errors. Unless we've asked the first server about
+        # the files already, start each file on a different server so the
+        # work is spread over all of them.
+        if batch:
+            file_urls = list(urls)
+        else:
+            n = i % len(urls)
+            file_urls = urls[n:] + urls[:n]
+        url = file_urls[0]
+        filehash = hashes.get(filename)
+        s = status.get(filehash)
+        if s == 'invalid':
+            log.error("%s: %s can't be signed by %s", filehash, filename, url)
+            return False
+        if s == 'upload':
+            log.info("%s: uploading for signing", filehash)
+            try:
+                with limits.connection(url):
+                    uploadfile(url, filename, fmt, token,
+                               nonce=read_nonce(options.noncefile))
+            except (urllib2.URLError, socket.error, httplib.BadStatusLine):
+                # remote_signfile will try again
+                log.info("%s: error uploading file for signing", filehash,
+                         exc_info=True)
+        return remote_signfile(options, file_urls, filename, fmt, token, dest,
+                               limits=limits, cache=cache)
+
+    pool = ThreadPool(jobs)
+    try:
+        results = pool.map(sign, enumerate(files))
+    finally:
+        pool.close()
+        pool.join()
+    for (filename, dest), result in zip(files, results):
+        if not result:
+            log.error("Failed to sign %s with %s", filename, fmt)
+    return all(results)
+
+
+def remote_signfile(options, urls, filename, fmt, token, dest=None, limits=None,
+                    cache=None):
     filehash = sha1sum(filename)
     if dest is None:
         dest = filename
+    if limits is None:
+        limits = HostLimits()
+    if cache is None and options.cachedir:
+        cache = SigningCache(options.cachedir)
 
     if fmt == 'gpg':
         dest += '.asc'
 
     parent_dir = os.path.dirname(os.path.abspath(dest))
-    if not os.path.exists(parent_dir):
+    try:
         os.makedirs(parent_dir)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
 
     # Check the cache
-    cached_fn = None
-    if options.cachedir:
+    if cache:
         log.debug("%s: checking cache", filehash)
-        cached_fn = os.path.join(options.cachedir, fmt, filehash)
-        if os.path.exists(cached_fn):
-            log.info("%s: exists in the cache; copying to %s", filehash, dest)
-            cached_fp = open(cached_fn, 'rb')
-            tmpfile = dest + '.tmp'
-            fp = open(tmpfile, 'wb')
-            hsh = hashlib.new('sha1')
-            while True:
-                data = cached_fp.read(1024 ** 2)
-                if not data:
-                    break
-                hsh.update(data)
-                fp.write(data)
-            fp.close()
-            newhash = hsh.hexdigest()
-            if os.path.exists(dest):
-                os.unlink(dest)
-            os.rename(tmpfile, dest)
-            log.info("%s: OK", filehash)
+        if cache.get(fmt, filehash, dest):
+            log.info("%s: found in the cache; placed at %s", filehash, dest)
             # See if we should re-sign NSS
-            if options.nsscmd and filehash != newhash and os.path.exists(os.path.splitext(filename)[0] + ".chk"):
+            if options.nsscmd and os.path.exists(os.path.splitext(filename)[0] + ".chk") and \
+                    sha1sum(dest) != filehash:
                 cmd = '%s "%s"' % (options.nsscmd, dest)
                 log.info("Regenerating .chk file")
                 log.debug("Running %s", cmd)
@@ -87,6 +253,8 @@ def remote_signfile(options, urls, filename, fmt, token, dest=None):
     pendings = 0
     max_errors = 20
     max_pending_tries = 300
+    # (url, digest) of a partially downloaded tmpfile we can resume
+    partial = None
     while True:
         if pendings >= max_pending_tries:
             log.error("%s: giving up after %i tries", filehash, pendings)
@@ -98,17 +266,37 @@ def remote_signfile(options, urls, filename, fmt, token, dest=None):
         try:
             url = urls[0]
             log.info("%s: processing %s on %s", filehash, filename, url)
-            req = getfile(url, filehash, fmt)
-            headers = req.info()
-            responsehash = headers['X-SHA1-Digest']
             tmpfile = dest + '.tmp'
-            fp = open(tmpfile, 'wb')
-            while True:
-                data = req.read(1024 ** 2)
-                if not data:
-                    break
-                fp.write(data)
-            fp.close()
+            offset = 0
+            if partial and partial[0] == url and os.path.exists(tmpfile):
+                offset = os.path.getsize(tmpfile)
+            with limits.connection(url):
+                req = getfile(url, filehash, fmt, offset)
+                headers = req.info()
+                responsehash = headers['X-SHA1-Digest']
+                if offset and req.code == 206 and partial[1] == responsehash:
+                    log.info("%s: resuming download at %i bytes", filehash, offset)
+                    fp = open(tmpfile, 'ab')
+                else:
+                    offset = 0
+                    fp = open(tmpfile, 'wb')
+                partial = (url, responsehash)
+                try:
+                    while True:
+                        data = req.read(1024 ** 2)
+                        if not data:
+                            break
+                        fp.write(data)
+                finally:
+                    # Make sure what we have so far is on disk, so we can resume
+                    # from here if the connection dropped
+                    fp.close()
+            expected_size = headers.get('Content-Length')
+            if expected_size and os.path.getsize(tmpfile) - offset < int(expected_size):
+                log.warn("%s: download was interrupted; resuming", filehash)
+                errors += 1
+                continue
+            partial = None
             newhash = sha1sum(tmpfile)
             if newhash != responsehash:
                 log.warn(
@@ -128,19 +316,21 @@ def remote_signfile(options, urls, filename, fmt, token, dest=None):
                 check_call(cmd, shell=True)
 
             # Possibly write to our cache
-            if cached_fn:
-                cached_dir = os.path.dirname(cached_fn)
-                if not os.path.exists(cached_dir):
-                    log.debug("Creating %s", cached_dir)
-                    os.makedirs(cached_dir)
-                log.info("Copying %s to cache %s", dest, cached_fn)
-                copyfile(dest, cached_fn)
+            if cache:
+                log.info("Adding %s to the cache", dest)
+                cache.put(fmt, filehash, dest)
             break
         except urllib2.HTTPError, e:
+            if e.code == 416 and partial:
+                log.debug("%s: can't resume download; starting again", filehash)
+                partial = None
+                errors += 1
+                continue
             try:
                 if 'X-Pending' in e.headers:
-                    log.debug("%s: pending; try again in a bit", filehash)
-                    time.sleep(1)
+                    log.debug("%s: pending; waiting for it to finish", filehash)
+                    if not waitfile(url, filehash, fmt):
+                        time.sleep(1)
                     pendings += 1
                     continue
             except:
@@ -151,32 +341,37 @@ def remote_signfile(options, urls, filename, fmt, token, dest=None):
             # That didn't work...so let's upload it
             log.info("%s: uploading for signing", filehash)
             req = None
+            uploaded = False
             try:
-                try:
-                    nonce = open(options.noncefile, 'rb').read()
-                except IOError:
-                    nonce = ""
-                req = uploadfile(url, filename, fmt, token, nonce=nonce)
+                nonce = read_nonce(options.noncefile)
+                with limits.connection(url):
+                    req = uploadfile(url, filename, fmt, token, nonce=nonce)
                 nonce = req.info()['X-Nonce']
-                open(options.noncefile, 'wb').write(nonce)
+                write_nonce(options.noncefile, nonce)
+                uploaded = True
             except urllib2.HTTPError, e:
                 # python2.5 doesn't think 202 is ok...but really it is!
                 if 'X-Nonce' in e.headers:
                     log.debug("updating nonce")
                     nonce = e.headers['X-Nonce']
-                    open(options.noncefile, 'wb').write(nonce)
+                    write_nonce(options.noncefile, nonce)
                 if e.code != 202:
                     log.info("%s: error uploading file for signing: %s %s",
                              filehash, e.code, e.msg)
                     urls.pop(0)
                     urls.append(url)
+                else:
+                    uploaded = True
             except (urllib2.URLError, socket.error, httplib.BadStatusLine):
                 # Try again in a little while
                 log.info("%s: connection error; trying again soon", filehash)
                 # Move the current url to the back
                 urls.pop(0)
                 urls.append(url)
-            time.sleep(1)
+            # Wait for the server to finish signing our upload, rather than
+            # polling for it
+            if not (uploaded and waitfile(url, filehash, fmt)):
+                time.sleep(1)
             continue
         except (urllib2.URLError, socket.error):
             # Try again in a little while
@@ -0,0 +1,110 @@
+"""Streaming parser for multipart/form-data request bodies"""
+import re
+
+
+class MultipartError(ValueError):
+    pass
+
+# Largest plain (non-file) field or block of part headers we'll accept
+MAX_FIELD_SIZE = 64 * 1024
+
+
+def _header_param(header, param):
+    m = re.search(r';\s*%s="([^"]*)"' % param, header)
+    if m:
+        return m.group(1)
+    return None
+
+
+def parse_multipart(fp, content_type, content_length, open_file, blocksize=1024 ** 2):
+    """Parses a multipart/form-data body of `content_length` bytes read from
+    `fp`, without holding file contents in memory.
+
+    For each file field, open_file(name, filename) is called and the file's
+    data is written to the object it returns, a block at a time. Exceptions
+    raised by its write() method abort parsing.
+
+    Returns a dict of field name => value, where file fields map to the
+    object returned by open_file.
+
+    Raises MultipartError if the body is malformed."""
+    m = re.match(r'multipart/form-data;.*boundary="?([^";]+)"?', content_type)
+    if not m:
+        raise MultipartError("Not a multipart/form-data body: %s" % content_type)
+    delim = '\r\n--' + m.group(1)
+
+    remaining = [content_length]
+
+    def fill(buf):
+        n = min(blocksize, remaining[0])
+        data = fp.read(n) if n > 0 else ''
+        if not data:
+            raise MultipartError("Unexpected end of data")
+        remaining[0] -= len(data)
+        return buf + data
+
+    # The first boundary isn't preceded by a newline
+    buf = '\r\n'
+    while True:
+        i = buf.find(delim)
+        if i >= 0:
+            buf = buf[i + len(delim):]
+            break
+        buf = fill(buf[-len(delim):])
+
+    values = {}
+    while True:
+        while len(buf) < 2:
+            buf = fill(buf)
+        if buf.startswith('--'):
+            # That was the last part
+            return values
+        if not buf.startswith('\r\n'):
+            raise MultipartError("Malformed boundary")
+        buf = buf[2:]
+
+        while '\r\n\r\n' not in buf:
+            if len(buf) > MAX_FIELD_SIZE:
+                raise MultipartError("Part headers too long")
+            buf = fill(buf)
+        header_block, buf = buf.split('\r\n\r\n', 1)
+        headers = {}
+        for line in header_block.split('\r\n'):
+            if ':' in line:
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+        disposition = headers.get('content-disposition', '')
+        name = _header_param(disposition, 'name')
+        filename = _header_param(disposition, 'filename')
+        if name is None:
+            raise MultipartError("Part has no name")
+
+        if filename is None:
+            chunks = []
+            write = chunks.append
+        else:
+            out = open_file(name, filename)
+            write = out.write
+        size = 0
+        # Write out everything except what might be the start of the
+        # delimiter, until we find the whole delimiter
+        keep = len(delim) - 1
+        while True:
+            i = buf.find(delim)
+            if i >= 0:
+                write(buf[:i])
+                size += i
+                buf = buf[i + len(delim):]
+                break
+            if len(buf) > keep:
+                write(buf[:-keep])
+                size += len(buf) - keep
+                buf = buf[-keep:]
+            if filename is None and size > MAX_FIELD_SIZE:
+                raise MultipartError("Field %s too large" % name)
+            buf = fill(buf)
+
+        if filename is None:
+            values[name] = ''.join(chunks)
+        else:
+            values[name] = out
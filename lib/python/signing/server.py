@@ -1,4 +1,6 @@
 import os
+import errno
+import fcntl
 import hashlib
 import hmac
 import shlex
@@ -6,18 +8,30 @@ import time
 import signal
 import re
 import tempfile
-# TODO: use util.command
-from subprocess import Popen, PIPE, STDOUT
+import sqlite3
+import json
+from collections import defaultdict, deque
 
 import gevent
+try:
+    # gevent >= 1.0 waits for children cooperatively
+    import gevent.subprocess as gevent_subprocess
+    from gevent.subprocess import Popen, PIPE, STDOUT
+except ImportError:
+    gevent_subprocess = None
+    # TODO: use util.command
+    from subprocess import Popen, PIPE, STDOUT
 from gevent import queue
-from gevent.event import Event
+from gevent.event import Event, AsyncResult
+from gevent.socket import wait_read
 from gevent import pywsgi
 from IPy import IP
 import webob
 
 from util import b64
-from util.file import safe_unlink, sha1sum, safe_copyfile
+from signing.multipart import parse_multipart, MultipartError
+from util.file import safe_unlink, sha1sum, safe_copyfile, get_config, \
+    get_config_int
 
 import logging
 log = logging.getLogger(__name__)
@@ -56,7 +70,158 @@ def unpack_token_data(token_data):
     )
 
 
-def run_signscript(cmd, inputfile, outputfile, filename, format_, passphrase=None, max_tries=5):
+def parse_range(range_header, size):
+    """Parses a HTTP Range header for a file of `size` bytes.
+
+    Returns a (start, end) tuple of the inclusive byte range requested, or
+    None if the header is missing or isn't a single byte range we understand,
+    in which case the whole file should be sent.
+
+    Raises ValueError if the range can't be satisfied."""
+    if not range_header:
+        return None
+    m = re.match(r"^bytes=(\d*)-(\d*)$", range_header.strip())
+    if not m or m.groups() == ('', ''):
+        return None
+    start, end = m.groups()
+    if not start:
+        # A suffix range; the last `end` bytes of the file
+        start = max(0, size - int(end))
+        end = size - 1
+    else:
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError("Unsatisfiable range: %s" % range_header)
+    return start, end
+
+
+class RangeFile(object):
+    """File-like object that reads at most `length` bytes of `fp` from its
+    current position.
+
+    fileno() is passed through, so servers can send it with sendfile(); they
+    must stop after Content-Length bytes, as PEP 3333 requires."""
+    def __init__(self, fp, length):
+        self.fp = fp
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fp.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.fp.fileno()
+
+    def close(self):
+        self.fp.close()
+
+
+def _iter_file(fp, blocksize):
+    try:
+        while True:
+            data = fp.read(blocksize)
+            if not data:
+                break
+            yield data
+            # Let other requests have a turn while slaves download large
+            # files
+            gevent.sleep(0)
+    finally:
+        fp.close()
+
+
+def send_file(environ, fp, length, blocksize=1024 ** 2):
+    """Returns a WSGI response body of `length` bytes of `fp`, starting at
+    its current position. fp is closed once it has been sent.
+
+    The server's wsgi.file_wrapper is used if it has one, which lets it send
+    the file with sendfile() rather than copying it through python."""
+    if length < os.fstat(fp.fileno()).st_size - fp.tell():
+        fp = RangeFile(fp, length)
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if file_wrapper:
+        return file_wrapper(fp, blocksize)
+    return _iter_file(fp, blocksize)
+
+
+# Signals to send to signing scripts that take too long, in order. SIGKILL is
+# repeated until the process is gone.
+KILL_SIGNALS = [signal.SIGINT, signal.SIGTERM, signal.SIGKILL]
+
+# Per-waiter events to set when a child process exits, when we don't have
+# gevent.subprocess to do this for us
+_sigchld_waiters = set()
+_sigchld_handler = None
+
+
+def _on_sigchld():
+    for e in list(_sigchld_waiters):
+        e.set()
+
+
+def wait_child(proc, timeout=None):
+    """Waits up to `timeout` seconds for `proc` to exit without blocking the
+    hub, and returns its exit code, or None if it's still running.
+
+    With gevent.subprocess this is handled by gevent's child watchers.
+    Otherwise we wake up whenever we get a SIGCHLD."""
+    if gevent_subprocess:
+        return proc.wait(timeout=timeout)
+
+    global _sigchld_handler
+    if not _sigchld_handler:
+        _sigchld_handler = gevent.signal(signal.SIGCHLD, _on_sigchld)
+
+    if timeout is not None:
+        deadline = time.time() + timeout
+    e = Event()
+    _sigchld_waiters.add(e)
+    try:
+        while True:
+            e.clear()
+            rc = proc.poll()
+            if rc is not None:
+                return rc
+            # Check at least once a second in case we miss a signal
+            if timeout is None:
+                e.wait(timeout=1)
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                e.wait(timeout=min(remaining, 1))
+    finally:
+        _sigchld_waiters.discard(e)
+
+
+def kill_signscript(proc):
+    """Kills off `proc` and its process group, escalating from SIGINT to
+    SIGTERM to SIGKILL if it doesn't exit within a second of each."""
+    siglist = KILL_SIGNALS[:]
+    while True:
+        if siglist:
+            sig = siglist.pop(0)
+        else:
+            sig = signal.SIGKILL
+        log.debug("%s: killing with %s", proc.pid, sig)
+        try:
+            # Kill off the process group first, and then the process
+            # itself for good measure
+            os.kill(-proc.pid, sig)
+            os.kill(proc.pid, sig)
+        except OSError:
+            # The process is gone now
+            pass
+        if wait_child(proc, 1) is not None:
+            return
+
+
+def run_signscript(cmd, inputfile, outputfile, filename, format_, passphrase=None, max_tries=5,
+                   max_time=120, retry_delay=5):
     """Run the signing script `cmd`, passing the inputfile, outputfile,
     original filename and format.
 
@@ -64,8 +229,8 @@ def run_signscript(cmd, inputfile, outputfile, filename, format_, passphrase=Non
 
     Returns 0 on success, non-zero otherwise.
 
-    The command currently is allowed 10 seconds to complete before being killed
-    and tried again.
+    The command is allowed `max_time` seconds to complete before being killed
+    and tried again, `retry_delay` seconds later, up to `max_tries` times.
     """
     if isinstance(cmd, basestring):
         cmd = shlex.split(cmd)
@@ -74,10 +239,8 @@ def run_signscript(cmd, inputfile, outputfile, filename, format_, passphrase=Non
 
     cmd.extend((format_, inputfile, outputfile, filename))
     output = open(outputfile + '.out', 'wb')
-    max_time = 120
     tries = 0
     while True:
-        start = time.time()
         # Make sure to call os.setsid() after we fork so the spawned process is
         # its own session leader. This means that it will get its own process
         # group, and signals sent to its process group will also be sent to its
@@ -90,39 +253,13 @@ def run_signscript(cmd, inputfile, outputfile, filename, format_, passphrase=Non
             proc.stdin.write(passphrase)
         proc.stdin.close()
         log.debug("%s: %s", proc.pid, cmd)
-        siglist = [signal.SIGINT, signal.SIGTERM]
-        timeout = False
-        while True:
-            if time.time() - start > max_time:
-                timeout = True
-                log.debug("%s: Exceeded timeout", proc.pid)
-                # Kill off the process
-                if siglist:
-                    sig = siglist.pop(0)
-                else:
-                    sig = signal.SIGKILL
-                try:
-                    # Kill off the process group first, and then the process
-                    # itself for good measure
-                    os.kill(-proc.pid, sig)
-                    os.kill(proc.pid, sig)
-                    gevent.sleep(1)
-                    os.kill(proc.pid, 0)
-                except OSError:
-                    # The process is gone now
-                    rc = -1
-                    break
 
-            rc = proc.poll()
-            if rc is not None:
-                # if we killed the child, we want to break before we poll, since polling may not give
-                # an error return code.
-                if timeout:
-                    rc = -1
-                break
-
-            # Check again in a bit
-            gevent.sleep(0.25)
+        rc = wait_child(proc, max_time)
+        if rc is None:
+            log.debug("%s: Exceeded timeout", proc.pid)
+            kill_signscript(proc)
+            # We killed the child, so don't trust its return code
+            rc = -1
 
         if rc == 0:
             log.debug("%s: Success!", proc.pid)
@@ -135,7 +272,218 @@ def run_signscript(cmd, inputfile, outputfile, filename, format_, passphrase=Non
             log.warning(
                 "run_signscript: Exceeded maximum number of retries; exiting")
             return 1
-        gevent.sleep(5)
+        gevent.sleep(retry_delay)
+
+
+def _hash_file(filename):
+    """Runs in a HashingService worker. Returns ('ok', digest), or ('error',
+    exception) so that errors make it back to the caller."""
+    try:
+        return ('ok', sha1sum(filename))
+    except Exception, e:
+        return ('error', e)
+
+
+class HashingService(object):
+    """
+    Hashes files in a pool of workers without blocking the hub
+
+    `pool` is a multiprocessing.Pool (or anything with the same apply_async
+    interface) to do the hashing in.
+
+    Results are handed back from the pool's result thread through a pipe, so
+    greenlets waiting on a hash are woken up as soon as it's ready.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self._next_id = 0
+        # Mapping of request id to the AsyncResult its caller is waiting on
+        self._waiting = {}
+        # (request id, result) tuples from the pool that haven't been handed
+        # to their callers yet
+        self._finished = deque()
+        self._rfd, self._wfd = os.pipe()
+        fcntl.fcntl(self._rfd, fcntl.F_SETFL,
+                    fcntl.fcntl(self._rfd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._reader = gevent.spawn(self._read_results)
+
+    def stop(self):
+        self._reader.kill()
+        os.close(self._rfd)
+        os.close(self._wfd)
+
+    def _done(self, request_id, result):
+        # Called from the pool's result thread
+        self._finished.append((request_id, result))
+        os.write(self._wfd, 'x')
+
+    def _read_results(self):
+        while True:
+            wait_read(self._rfd)
+            try:
+                os.read(self._rfd, 4096)
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+            while self._finished:
+                request_id, result = self._finished.popleft()
+                self._waiting.pop(request_id).set(result)
+
+    def sha1sum(self, filename):
+        """Returns the sha1 of `filename`, raising the same errors as
+        util.file.sha1sum. Only the calling greenlet waits for the result."""
+        self._next_id += 1
+        request_id = self._next_id
+        result = AsyncResult()
+        self._waiting[request_id] = result
+        self.pool.apply_async(_hash_file, args=(filename,),
+                              callback=lambda r: self._done(request_id, r))
+        status, value = result.get()
+        if status == 'error':
+            raise value
+        return value
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class UploadFile(object):
+    """
+    Destination for an uploaded file that is being streamed off the socket
+
+    Data is written to a temporary file in `dirname` and hashed as it
+    arrives. UploadTooLarge is raised as soon as more than `max_size` bytes
+    have been written, so oversized uploads are rejected without reading the
+    rest of the request.
+    """
+    def __init__(self, dirname, max_size=None):
+        self.max_size = max_size
+        self.size = 0
+        self._hsh = hashlib.new('sha1')
+        fd, self.name = tempfile.mkstemp(dir=dirname)
+        self.fp = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_size and self.size > self.max_size:
+            raise UploadTooLarge()
+        self._hsh.update(data)
+        self.fp.write(data)
+
+    def hexdigest(self):
+        return self._hsh.hexdigest()
+
+    def close(self):
+        self.fp.close()
+
+    def discard(self):
+        """Removes the temporary file, unless it has been renamed already"""
+        self.fp.close()
+        safe_unlink(self.name)
+
+
+class DigestIndex(object):
+    """
+    Persistent index of file digests, keyed by (hash, format)
+
+    `filename` is the path to the sqlite database to store the index in
+    `hashfunc` is the function used to hash files; defaults to
+        util.file.sha1sum
+
+    For every file written into signed_dir or unsigned_dir we record its size,
+    mtime, sha1 digest and original filename. Lookups are answered from the
+    index without reading the file again; the file is only re-hashed if its
+    size or mtime have changed since it was recorded. Unsigned files are
+    recorded with an empty format.
+
+    Files touched when they're downloaded have their new mtimes kept in
+    memory until flush() is called, so that downloads don't each have to
+    wait for a database commit. If they're lost, the files are just hashed
+    again on their next lookup.
+    """
+
+    def __init__(self, filename, hashfunc=None):
+        self.filename = filename
+        self.hashfunc = hashfunc
+        self.db = sqlite3.connect(filename)
+        # (filehash, format) => mtime of files touched since the last flush
+        self._touched = {}
+        self.db.execute("""CREATE TABLE IF NOT EXISTS digests (
+            filehash TEXT NOT NULL,
+            format TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            digest TEXT NOT NULL,
+            filename TEXT,
+            PRIMARY KEY (filehash, format))""")
+        self.db.commit()
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def flush(self):
+        """Writes out the mtimes of the files touched since the last flush,
+        in one transaction"""
+        if not self._touched:
+            return
+        self.db.executemany(
+            "UPDATE digests SET mtime = ? WHERE filehash = ? AND format = ?",
+            [(mtime, filehash, format_)
+             for (filehash, format_), mtime in self._touched.items()])
+        self.db.commit()
+        self._touched = {}
+
+    def record(self, filehash, format_, path, digest, filename=None):
+        """Remember that `path`, stored as (filehash, format_), has sha1
+        `digest`"""
+        self._touched.pop((filehash, format_), None)
+        st = os.stat(path)
+        self.db.execute(
+            "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)",
+            (filehash, format_, st.st_size, st.st_mtime, digest, filename))
+        self.db.commit()
+
+    def lookup(self, filehash, format_, path):
+        """Returns the sha1 digest of `path`, stored as (filehash, format_).
+
+        The recorded digest is returned if the file's size and mtime still
+        match; otherwise the file is hashed and the index updated.
+
+        Raises IOError if `path` doesn't exist."""
+        try:
+            st = os.stat(path)
+        except OSError, e:
+            raise IOError(e.errno, e.strerror, path)
+        row = self.db.execute(
+            "SELECT size, mtime, digest, filename FROM digests "
+            "WHERE filehash = ? AND format = ?",
+            (filehash, format_)).fetchone()
+        if row:
+            mtime = self._touched.get((filehash, format_), row[1])
+            if row[0] == st.st_size and mtime == st.st_mtime:
+                return str(row[2])
+
+        log.debug("%s has changed or isn't indexed; hashing", path)
+        digest = (self.hashfunc or sha1sum)(path)
+        self.record(filehash, format_, path, digest, row and row[3])
+        return digest
+
+    def touch(self, filehash, format_, path):
+        """Update the mtime of `path` without invalidating its recorded
+        digest. The digest should already have been validated with
+        lookup(). The index isn't written until the next flush()."""
+        os.utime(path, None)
+        self._touched[(filehash, format_)] = os.path.getmtime(path)
+
+    def forget(self, filehash, format_):
+        """Remove (filehash, format_) from the index"""
+        self._touched.pop((filehash, format_), None)
+        self.db.execute(
+            "DELETE FROM digests WHERE filehash = ? AND format = ?",
+            (filehash, format_))
+        self.db.commit()
 
 
 class Signer(object):
@@ -146,131 +494,193 @@ class Signer(object):
     `inputdir` and `outputdir` are where uploaded files and signed files will be stored
     `passphrases` is a dict of format => passphrase
     `concurrency` is how many workers to run
+    `format_concurrency` is a dict of format => maximum number of files of
+        that format to sign at once. Formats not listed can use all the
+        workers.
+
+    Files are queued per format. Idle workers take the file that has been
+    waiting longest among the formats that are under their concurrency limit,
+    so a backlog of slow formats doesn't hold up the others.
     """
     stopped = False
 
-    def __init__(self, app, signcmd, inputdir, outputdir, concurrency, passphrases):
+    def __init__(self, app, signcmd, inputdir, outputdir, concurrency, passphrases,
+                 format_concurrency=None):
         self.app = app
         self.signcmd = signcmd
         self.concurrency = concurrency
+        self.format_concurrency = format_concurrency or {}
         self.inputdir = inputdir
         self.outputdir = outputdir
 
         self.passphrases = passphrases
 
-        self.workers = []
-        self.queue = queue.Queue()
+        # Mapping of format to a deque of (time queued, item)
+        self.queues = defaultdict(deque)
+        # How many files of each format are being signed right now
+        self.active = defaultdict(int)
+        # Mapping of format to how many files have been taken off the queue,
+        # and the total and maximum time they spent waiting
+        self.waits = defaultdict(lambda: dict(count=0, total=0.0, max=0.0))
+        # Set when there may be work for idle workers to do
+        self._work = Event()
+
+        self.workers = [gevent.spawn(self._worker) for _ in range(concurrency)]
 
     def signfile(self, filehash, filename, format_):
         assert not self.stopped
         e = Event()
         item = (filehash, filename, format_, e)
         log.debug("Putting %s on the queue", item)
-        self.queue.put(item)
-        self._start_worker()
-        log.debug("%i workers active", len(self.workers))
+        self.queues[format_].append((time.time(), item))
+        self._work.set()
         return e
 
-    def _start_worker(self):
-        if len(self.workers) < self.concurrency:
-            t = gevent.spawn(self._worker)
-            t.link(self._worker_done)
-            self.workers.append(t)
+    def stop(self):
+        """Stop accepting new files. The workers exit once all the queued
+        files have been signed."""
+        self.stopped = True
+        self._work.set()
+
+    def queue_depth(self, format_=None):
+        """Returns how many files are waiting to be signed, either for
+        `format_` or in total"""
+        if format_:
+            return len(self.queues.get(format_, ()))
+        return sum(len(q) for q in self.queues.values())
+
+    def stats(self):
+        """Returns a dict of format => queue depth, active jobs, and how long
+        files have waited in the queue"""
+        retval = {}
+        for format_ in set(self.queues) | set(self.waits):
+            waits = self.waits[format_]
+            retval[format_] = dict(
+                queued=self.queue_depth(format_),
+                active=self.active[format_],
+                signed=waits['count'],
+                avg_wait=waits['total'] / waits['count'] if waits['count'] else 0.0,
+                max_wait=waits['max'],
+            )
+        return retval
 
-    def _worker_done(self, t):
-        log.debug("Done worker")
-        self.workers.remove(t)
-        # If there's still work to do, start another worker
-        if self.queue.qsize() and not self.stopped:
-            self._start_worker()
-        log.debug("%i workers left", len(self.workers))
+    def _next_item(self):
+        """Blocks until there's a file to sign whose format is under its
+        concurrency limit, and returns it. Returns None once we've been stopped
+        and the queue is empty."""
+        while True:
+            candidates = [(q[0][0], format_) for format_, q in self.queues.items()
+                          if q and self.active[format_] < self.format_concurrency.get(format_, self.concurrency)]
+            if candidates:
+                _, format_ = min(candidates)
+                queued, item = self.queues[format_].popleft()
+                self.active[format_] += 1
+                waited = time.time() - queued
+                waits = self.waits[format_]
+                waits['count'] += 1
+                waits['total'] += waited
+                waits['max'] = max(waits['max'], waited)
+                return item
+            if self.stopped and not self.queue_depth():
+                return None
+            self._work.clear()
+            self._work.wait()
 
     def _worker(self):
         # Main worker process
-        # We pop items off the queue and process them
-
-        # How many jobs to process before exiting
-        max_jobs = 10
-        jobs = 0
+        # We pop items off the queue and process them until we're stopped
         while True:
-            # Event to signal when we're done
-            e = None
+            item = self._next_item()
+            if item is None:
+                break
             try:
-                jobs += 1
-                # Fall on our sword if we're too old
-                if jobs >= max_jobs:
-                    break
-
-                try:
-                    item = self.queue.get(block=False)
-                    if not item:
-                        break
-                except queue.Empty:
-                    log.debug("no items, exiting")
-                    break
-
-                filehash, filename, format_, e = item
-                log.info("Signing %s (%s - %s)", filename, format_, filehash)
+                self._sign(item)
+            finally:
+                self.active[item[2]] -= 1
+                # Another file of this format may be able to go now
+                self._work.set()
+        log.debug("Worker exiting")
 
-                inputfile = os.path.join(self.inputdir, filehash)
-                outputfile = os.path.join(self.outputdir, format_, filehash)
-                logfile = outputfile + ".out"
+    def _sign(self, item):
+        filehash, filename, format_, e = item
+        inputfile = os.path.join(self.inputdir, filehash)
+        outputfile = os.path.join(self.outputdir, format_, filehash)
+        logfile = outputfile + ".out"
+        try:
+            log.info("Signing %s (%s - %s)", filename, format_, filehash)
 
-                if not os.path.exists(os.path.join(self.outputdir, format_)):
-                    os.makedirs(os.path.join(self.outputdir, format_))
+            if not os.path.exists(os.path.join(self.outputdir, format_)):
+                os.makedirs(os.path.join(self.outputdir, format_))
 
-                retval = run_signscript(self.signcmd, inputfile, outputfile,
-                                        filename, format_, self.passphrases.get(format_))
+            retval = run_signscript(self.signcmd, inputfile, outputfile,
+                                    filename, format_, self.passphrases.get(format_),
+                                    max_time=self.app.max_time[format_],
+                                    retry_delay=self.app.retry_delay[format_])
 
-                if retval != 0:
-                    if os.path.exists(logfile):
-                        logoutput = open(logfile).read()
-                    else:
-                        logoutput = None
-                    log.warning("Signing failed %s (%s - %s)",
-                                filename, format_, filehash)
-                    log.warning("Signing log: %s", logoutput)
-                    safe_unlink(outputfile)
-                    self.app.messages.put(
-                        ('errors', item, 'signing script returned non-zero'))
-                    continue
-
-                # Copy our signed result into unsigned and signed so if
-                # somebody wants to get this file signed again, they get the
-                # same results.
-                outputhash = sha1sum(outputfile)
-                log.debug("Copying result to %s", outputhash)
-                copied_input = os.path.join(self.inputdir, outputhash)
-                if not os.path.exists(copied_input):
-                    safe_copyfile(outputfile, copied_input)
-                copied_output = os.path.join(
-                    self.outputdir, format_, outputhash)
-                if not os.path.exists(copied_output):
-                    safe_copyfile(outputfile, copied_output)
-                self.app.messages.put(('done', item, outputhash))
-            except:
-                # Inconceivable! Something went wrong!
-                # Remove our output, it might be corrupted
-                safe_unlink(outputfile)
+            if retval != 0:
                 if os.path.exists(logfile):
                     logoutput = open(logfile).read()
                 else:
                     logoutput = None
-                log.exception(
-                    "Exception signing file %s; output: %s ", item, logoutput)
-                self.app.messages.put((
-                    'errors', item, 'worker hit an exception while signing'))
-            finally:
-                if e:
-                    e.set()
-        log.debug("Worker exiting")
+                log.warning("Signing failed %s (%s - %s)",
+                            filename, format_, filehash)
+                log.warning("Signing log: %s", logoutput)
+                safe_unlink(outputfile)
+                self.app.messages.put(
+                    ('errors', item, 'signing script returned non-zero'))
+                return
+
+            # Copy our signed result into unsigned and signed so if
+            # somebody wants to get this file signed again, they get the
+            # same results.
+            outputhash = self.app.sha1sum(outputfile)
+            digests = self.app.digests
+            digests.record(filehash, format_, outputfile, outputhash,
+                           filename)
+            log.debug("Copying result to %s", outputhash)
+            copied_input = os.path.join(self.inputdir, outputhash)
+            if not os.path.exists(copied_input):
+                safe_copyfile(outputfile, copied_input)
+                digests.record(outputhash, '', copied_input, outputhash,
+                               filename)
+            copied_output = os.path.join(
+                self.outputdir, format_, outputhash)
+            if not os.path.exists(copied_output):
+                safe_copyfile(outputfile, copied_output)
+                digests.record(outputhash, format_, copied_output,
+                               outputhash, filename)
+            self.app.messages.put(('done', item, outputhash))
+        except:
+            # Inconceivable! Something went wrong!
+            # Remove our output, it might be corrupted
+            safe_unlink(outputfile)
+            if os.path.exists(logfile):
+                logoutput = open(logfile).read()
+            else:
+                logoutput = None
+            log.exception(
+                "Exception signing file %s; output: %s ", item, logoutput)
+            self.app.messages.put((
+                'errors', item, 'worker hit an exception while signing'))
+        finally:
+            e.set()
 
 
 class SigningServer:
+    """
+    WSGI application for the signing server
+
+    `config` is a ConfigParser with the server's configuration
+    `passphrases` is a dict of format => passphrase
+    `hasher` is an optional HashingService to hash files with. If not set,
+        files are hashed synchronously.
+    """
     signer = None
+    digests = None
 
-    def __init__(self, config, passphrases):
+    def __init__(self, config, passphrases, hasher=None):
         self.passphrases = passphrases
+        self.hasher = hasher
         ##
         # Stats
         ##
@@ -297,6 +707,9 @@ class SigningServer:
     def stop(self):
         self._message_loop_thread.kill()
         self._cleanup_loop_thead.kill()
+        self.signer.stop()
+        if self.digests:
+            self.digests.close()
 
     def load_config(self, config):
         from ConfigParser import NoOptionError
@@ -327,6 +740,21 @@ class SigningServer:
                     'security', 'max_filesize_%s' % f)
             except NoOptionError:
                 self.max_filesize[f] = None
+        self.max_time = dict()
+        self.retry_delay = dict()
+        for f in self.formats:
+            try:
+                self.max_time[f] = config.getint(
+                    'signing', 'max_time_%s' % f)
+            except NoOptionError:
+                self.max_time[f] = get_config_int(
+                    config, 'signing', 'max_time', 120)
+            try:
+                self.retry_delay[f] = config.getint(
+                    'signing', 'retry_delay_%s' % f)
+            except NoOptionError:
+                self.retry_delay[f] = get_config_int(
+                    config, 'signing', 'retry_delay', 5)
         self.max_token_age = config.getint('security', 'max_token_age')
         self.max_file_age = config.getint('server', 'max_file_age')
         self.token_auths = []
@@ -334,18 +762,45 @@ class SigningServer:
             if option.startswith('new_token_auth'):
                 self.token_auths.append(value)
         self.cleanup_interval = config.getint('server', 'cleanup_interval')
+        self.wait_timeout = get_config_int(config, 'server', 'wait_timeout', 60)
 
         for d in self.signed_dir, self.unsigned_dir:
             if not os.path.exists(d):
                 log.info("Creating %s directory", d)
                 os.makedirs(d)
 
+        digest_index = get_config(config, 'paths', 'digest_index',
+                                  self.signed_dir.rstrip(os.sep) + '-digests.sqlite')
+        if not self.digests or self.digests.filename != digest_index:
+            if self.digests:
+                self.digests.close()
+            log.info("Using digest index %s", digest_index)
+            self.digests = DigestIndex(digest_index, self.sha1sum)
+
+        format_concurrency = {}
+        for f in self.formats:
+            try:
+                format_concurrency[f] = config.getint(
+                    'signing', 'concurrency_%s' % f)
+            except NoOptionError:
+                pass
+
+        if self.signer:
+            # Let the old signer finish what it's doing; new files go to the
+            # new one
+            self.signer.stop()
         self.signer = Signer(self,
                              config.get('signing', 'signscript'),
                              config.get('paths', 'unsigned_dir'),
                              config.get('paths', 'signed_dir'),
                              config.getint('signing', 'concurrency'),
-                             self.passphrases)
+                             self.passphrases,
+                             format_concurrency)
+
+    def sha1sum(self, filename):
+        if self.hasher:
+            return self.hasher.sha1sum(filename)
+        return sha1sum(filename)
 
     def verify_token(self, token, slave_ip):
         token_data, token_sig = token.split('!', 1)
@@ -398,6 +853,11 @@ class SigningServer:
     def cleanup(self):
         log.info("Stats: %i hits; %i misses; %i uploads",
                  self.hits, self.misses, self.uploads)
+        for format_, stats in sorted(self.signer.stats().items()):
+            log.info("Queue stats for %s: %i queued; %i active; %i signed; "
+                     "%.1fs average wait; %.1fs max wait", format_,
+                     stats['queued'], stats['active'], stats['signed'],
+                     stats['avg_wait'], stats['max_wait'])
         log.debug("Pending: %s", self.pending)
         # Find files in unsigned that have bad hashes and delete them
         log.debug("Cleaning up...")
@@ -408,6 +868,7 @@ class SigningServer:
             if os.path.getmtime(unsigned) < now - self.max_file_age:
                 log.info("Deleting %s (too old)", unsigned)
                 safe_unlink(unsigned)
+                self.digests.forget(f, '')
                 continue
 
         # Find files in signed that don't have corresponding files in unsigned
@@ -419,6 +880,10 @@ class SigningServer:
                 if not os.path.exists(unsigned):
                     log.info("Deleting %s with no unsigned file", signed)
                     safe_unlink(signed)
+                    self.digests.forget(f, format_)
+
+        # Write out the access times of files downloaded since last time
+        self.digests.flush()
 
     def submit_file(self, filehash, filename, format_):
         assert (filehash, format_) not in self.pending
@@ -483,21 +948,48 @@ class SigningServer:
         log.info("%(REMOTE_ADDR)s %(REQUEST_METHOD)s %(PATH_INFO)s" % environ)
         return method(environ, start_response)
 
+    def handle_wait(self, start_response, filehash, format_):
+        """
+        GET /wait/<format>/<hash>
+
+        Blocks until a pending signing job finishes, or wait_timeout seconds
+        pass. Responds with 200 if the signed file is ready, 202 with an
+        X-Pending header if it is still being signed, or 404 if signing failed
+        or we don't know about the file.
+        """
+        e = self.pending.get((filehash, format_))
+        if e:
+            log.debug("Waiting for pending job")
+            e.wait(timeout=self.wait_timeout)
+        if os.path.exists(self.get_path(filehash, format_)):
+            start_response("200 OK", [])
+        elif e and not e.is_set():
+            start_response("202 Accepted", [('X-Pending', 'True')])
+        else:
+            start_response("404 Not Found", [])
+        return ""
+
     def do_GET(self, environ, start_response):
         """
         GET /sign/<format>/<hash>
+        GET /wait/<format>/<hash>
+
+        Supports single byte ranges via the Range header, so that clients can
+        resume interrupted downloads.
         """
         try:
             _, magic, format_, filehash = environ['PATH_INFO'].split('/')
-            assert magic == 'sign'
+            assert magic in ('sign', 'wait')
             assert format_ in self.formats
         except:
             log.debug("bad request: %s", environ['PATH_INFO'])
             start_response("400 Bad Request", [])
-            yield ""
-            return
+            return ""
 
         filehash = os.path.basename(environ['PATH_INFO'])
+        if magic == 'wait':
+            return self.handle_wait(start_response, filehash, format_)
+
         try:
             pending = self.pending.get((filehash, format_))
             if pending:
@@ -511,21 +1003,36 @@ class SigningServer:
                 log.debug("Looking for %s (%s)", fn, filename)
             else:
                 log.debug("Looking for %s", fn)
-            checksum = sha1sum(fn)
+            checksum = self.digests.lookup(filehash, format_, fn)
+            size = os.path.getsize(fn)
             headers = [
                 ('X-SHA1-Digest', checksum),
-                ('Content-Length', os.path.getsize(fn)),
+                ('Accept-Ranges', 'bytes'),
             ]
+            try:
+                byte_range = parse_range(environ.get('HTTP_RANGE'), size)
+            except ValueError:
+                log.debug("%s: unsatisfiable range %s", fn,
+                          environ.get('HTTP_RANGE'))
+                headers.append(('Content-Range', 'bytes */%i' % size))
+                start_response("416 Requested Range Not Satisfiable", headers)
+                return ""
             fp = open(fn, 'rb')
-            os.utime(fn, None)
+            self.digests.touch(filehash, format_, fn)
             log.debug("%s is OK", fn)
-            start_response("200 OK", headers)
-            while True:
-                data = fp.read(1024 ** 2)
-                if not data:
-                    break
-                yield data
+            if byte_range:
+                start, end = byte_range
+                log.debug("Sending bytes %i-%i of %s", start, end, fn)
+                headers.append(('Content-Range', 'bytes %i-%i/%i' % (start, end, size)))
+                headers.append(('Content-Length', str(end - start + 1)))
+                fp.seek(start)
+                start_response("206 Partial Content", headers)
+            else:
+                headers.append(('Content-Length', str(size)))
+                start_response("200 OK", headers)
+                end = size - 1
             self.hits += 1
+            return send_file(environ, fp, end - fp.tell() + 1)
         except IOError:
             log.debug("%s is missing", fn)
             headers = []
@@ -541,11 +1048,12 @@ class SigningServer:
             elif os.path.exists(fn):
                 log.debug("GET for file we already have, but not for the right format")
                 # Validate the file
-                myhash = sha1sum(fn)
+                myhash = self.digests.lookup(filehash, '', fn)
                 if myhash != filehash:
                     log.warning("%s is corrupt; deleting (%s != %s)",
                                 fn, filehash, myhash)
                     safe_unlink(fn)
+                    self.digests.forget(filehash, '')
                 else:
                     filename = self.get_filename(filehash)
                     if filename:
@@ -558,9 +1066,9 @@ class SigningServer:
                 self.misses += 1
 
             start_response("404 Not Found", headers)
-            yield ""
+            return ""
 
-    def handle_upload(self, environ, start_response, values, rest, next_nonce):
+    def handle_upload(self, environ, start_response, values, upload, rest, next_nonce):
         format_ = rest[0]
         assert format_ in self.formats
         filehash = values['sha1']
@@ -571,12 +1079,13 @@ class SigningServer:
         headers = [('X-Nonce', next_nonce)]
         if os.path.exists(fn):
             # Validate the file
-            mydigest = sha1sum(fn)
+            mydigest = self.digests.lookup(filehash, '', fn)
 
             if mydigest != filehash:
                 log.warning("%s is corrupt; deleting (%s != %s)",
                             fn, mydigest, filehash)
                 safe_unlink(fn)
+                self.digests.forget(filehash, '')
 
             elif os.path.exists(os.path.join(self.signed_dir, filehash)):
                 # Everything looks ok
@@ -598,24 +1107,12 @@ class SigningServer:
             start_response("403 Unacceptable filename", headers)
             return ""
 
-        try:
-            fd, tmpname = tempfile.mkstemp(dir=self.unsigned_dir)
-            fp = os.fdopen(fd, 'wb')
-
-            h = hashlib.new('sha1')
-            s = 0
-            while True:
-                data = values['filedata'].file.read(1024 ** 2)
-                if not data:
-                    break
-                s += len(data)
-                h.update(data)
-                fp.write(data)
-            fp.close()
-        except:
-            log.exception("Error downloading data")
-            if os.path.exists(tmpname):
-                os.unlink(tmpname)
+        if upload is None:
+            start_response("400 Missing file", headers)
+            return ""
+        upload.close()
+        tmpname = upload.name
+        s = upload.size
 
         if s < self.min_filesize:
             if os.path.exists(tmpname):
@@ -628,7 +1125,7 @@ class SigningServer:
             start_response("400 File too large", headers)
             return ""
 
-        if h.hexdigest() != filehash:
+        if upload.hexdigest() != filehash:
             if os.path.exists(tmpname):
                 os.unlink(tmpname)
             log.warn("Hash mismatch. Bad upload?")
@@ -638,11 +1135,67 @@ class SigningServer:
         # Good to go!  Rename the temporary filename to the real filename
         self.save_filename(filehash, filename)
         os.rename(tmpname, fn)
+        self.digests.record(filehash, '', fn, filehash, filename)
         self.submit_file(filehash, filename, format_)
         start_response("202 Accepted", headers)
         self.uploads += 1
         return ""
 
+    def check_file(self, filehash, filename, format_):
+        """Returns the status of `filehash` being signed with `format_`:
+
+            'signed':   a signed copy is ready to be fetched
+            'pending':  the file is being signed
+            'upload':   we don't have the file; it needs to be uploaded
+            'invalid':  bad hash or filename; the file can't be signed
+
+        If we already have the unsigned file it is queued up for signing, so
+        the client doesn't have to upload it again."""
+        if not re.match("^[0-9a-f]{40}$", filehash):
+            return 'invalid'
+        if not any(exp.match(filename) for exp in self.allowed_filenames):
+            log.info("invalid filename: %s", filename)
+            return 'invalid'
+        if (filehash, format_) in self.pending:
+            return 'pending'
+        if os.path.exists(self.get_path(filehash, format_)):
+            return 'signed'
+
+        fn = os.path.join(self.unsigned_dir, filehash)
+        if os.path.exists(fn):
+            myhash = self.digests.lookup(filehash, '', fn)
+            if myhash != filehash:
+                log.warning("%s is corrupt; deleting (%s != %s)",
+                            fn, filehash, myhash)
+                safe_unlink(fn)
+                self.digests.forget(filehash, '')
+            else:
+                self.save_filename(filehash, filename)
+                self.submit_file(filehash, filename, format_)
+                return 'pending'
+        return 'upload'
+
+    def handle_batch(self, environ, start_response, values, rest):
+        """
+        POST /sign_batch/<format>
+
+        `manifest` is a json list of {"sha1": ..., "filename": ...} objects.
+        Responds with a json object mapping each sha1 to its status as
+        returned by check_file(). Only files with an 'upload' status need to
+        be uploaded to /sign/<format>.
+        """
+        format_ = rest[0]
+        assert format_ in self.formats
+        manifest = json.loads(values['manifest'])
+        log.info("Batch request to %s sign %i files from %s", format_,
+                 len(manifest), environ['REMOTE_ADDR'])
+        result = {}
+        for entry in manifest:
+            filehash = entry['sha1']
+            result[filehash] = self.check_file(filehash, entry['filename'], format_)
+        start_response("200 OK", [('Content-Type', 'application/json')])
+        return json.dumps(result)
+
     def handle_token(self, environ, start_response, values):
         token = self.get_token(
             values['slave_ip'],
@@ -651,20 +1204,69 @@ class SigningServer:
         start_response("200 OK", [])
         return token
 
+    def read_upload(self, environ, format_):
+        """Parses a multipart upload request, streaming the file straight into
+        unsigned_dir rather than buffering it first.
+
+        Returns (values, upload), where upload is an UploadFile or None if no
+        file was sent. Raises UploadTooLarge if the file is bigger than
+        max_filesize allows for `format_`."""
+        max_size = self.max_filesize[format_]
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        # Allow some room for the other form fields
+        if max_size and length > max_size + 64 * 1024:
+            raise UploadTooLarge()
+
+        uploads = []
+
+        def open_file(name, filename):
+            if name != 'filedata' or uploads:
+                raise MultipartError("Unexpected file %s" % name)
+            uploads.append(UploadFile(self.unsigned_dir, max_size))
+            return uploads[0]
+
+        try:
+            values = parse_multipart(environ['wsgi.input'],
+                                     environ['CONTENT_TYPE'], length, open_file)
+        except:
+            for upload in uploads:
+                upload.discard()
+            raise
+        if uploads:
+            return values, uploads[0]
+        return values, None
+
     def do_POST(self, environ, start_response):
-        req = webob.Request(environ)
-        values = req.POST
         headers = []
+        upload = None
 
         try:
             path_bits = environ['PATH_INFO'].split('/')
             magic = path_bits[1]
             rest = path_bits[2:]
-            if not magic in ('sign', 'token'):
+            if not magic in ('sign', 'sign_batch', 'token'):
                 log.exception("bad request: %s", environ['PATH_INFO'])
                 start_response("400 Bad Request", [])
                 return ""
 
+            if magic == 'sign' and environ.get('CONTENT_TYPE', '').startswith('multipart/form-data'):
+                format_ = rest[0]
+                assert format_ in self.formats
+                try:
+                    values, upload = self.read_upload(environ, format_)
+                except UploadTooLarge:
+                    log.info("Rejecting oversized %s upload from %s", format_,
+                             environ['REMOTE_ADDR'])
+                    start_response("400 File too large", [('X-Nonce', 'UNUSED')])
+                    return ""
+                except MultipartError, e:
+                    log.info("Bad upload from %s: %s", environ['REMOTE_ADDR'], e)
+                    start_response("400 Bad Request", [])
+                    return ""
+            else:
+                req = webob.Request(environ)
+                values = req.POST
+
             if magic == 'token':
                 remote_addr = environ['REMOTE_ADDR']
                 if not any(remote_addr in net for net in self.new_token_allowed_ips):
@@ -682,7 +1284,7 @@ class SigningServer:
                     return ""
 
                 return self.handle_token(environ, start_response, values)
-            elif magic == 'sign':
+            elif magic in ('sign', 'sign_batch'):
                 # Validate token
                 if 'token' not in values:
                     start_response("400 Missing token", [])
@@ -694,15 +1296,21 @@ class SigningServer:
                     start_response("400 Invalid token", [])
                     return ""
 
+                if magic == 'sign_batch':
+                    return self.handle_batch(environ, start_response, values, rest)
+
                 # nonces are unused, but still part of the protocol
                 next_nonce = 'UNUSED'
                 headers.append(('X-Nonce', 'UNUSED'))
 
-                return self.handle_upload(environ, start_response, values, rest, next_nonce)
+                return self.handle_upload(environ, start_response, values, upload, rest, next_nonce)
         except:
             log.exception("ISE")
             start_response("500 Internal Server Error", headers)
             return ""
+        finally:
+            if upload:
+                upload.discard()
 
 
 def create_server(app, listener, config):
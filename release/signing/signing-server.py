@@ -15,9 +15,9 @@ import tempfile
 import logging
 import logging.handlers
 
-from util.file import sha1sum as sync_sha1sum, safe_unlink
+from util.file import safe_unlink
 from util.file import load_config, get_config, get_config_int, get_config_bool
-from signing.server import SigningServer, create_server, run_signscript
+from signing.server import SigningServer, HashingService, create_server, run_signscript
 
 # External dependencies
 import daemon
@@ -37,19 +37,6 @@ def init_worker():
 _sha1sum_worker_pool = None
 
 
-def sha1sum(fn):
-    "Non-blocking sha1sum. Will calculate sha1sum of fn in a subprocess"
-    result = _sha1sum_worker_pool.apply_async(sync_sha1sum, args=(fn,))
-    # Most of the time we'll complete pretty fast, so don't need to sleep very
-    # long
-    sleep_time = 0.1
-    while not result.ready():
-        gevent.sleep(sleep_time)
-        # Increase the time we sleep next time, up to a maximum of 5 seconds
-        sleep_time = min(5, sleep_time * 2)
-    return result.get()
-
-
 def run(config_filename, passphrases):
     log.info("Running with pid %i", os.getpid())
 
@@ -59,6 +46,8 @@ def run(config_filename, passphrases):
     global _sha1sum_worker_pool
     if not _sha1sum_worker_pool:
         _sha1sum_worker_pool = multiprocessing.Pool(None, init_worker)
+    # All of the server's hashing is done in the worker pool
+    hasher = HashingService(_sha1sum_worker_pool)
     app = None
     listener = None
     server = None
@@ -69,7 +58,7 @@ def run(config_filename, passphrases):
         log.info("Loading configuration")
         config = load_config(config_filename)
         if not app:
-            app = SigningServer(config, passphrases)
+            app = SigningServer(config, passphrases, hasher)
         else:
             app.load_config(config)
 
@@ -10,7 +10,8 @@ import site
 # Modify our search path to find our modules
 site.addsitedir(os.path.join(os.path.dirname(__file__), "../../lib/python"))
 
-from signing.client import remote_signfile, buildValidatingOpener
+from signing.client import remote_signfile, remote_signfiles, buildValidatingOpener
+from signing.cache import SigningCache
 from util.archives import packtar, unpacktar
 from util.paths import findfiles
 
@@ -58,6 +59,10 @@ def main():
         tokenfile=None,
         noncefile=None,
         cachedir=None,
+        cache_max_size=None,
+        batch=False,
+        jobs=1,
+        max_host_connections=4,
     )
 
     parser.add_option(
@@ -86,7 +91,14 @@ def main():
                       help="command to re-sign nss libraries, if required")
     parser.add_option("--cachedir", dest="cachedir",
                       help="local cache directory")
-    # TODO: Concurrency?
+    parser.add_option("--cache-max-size", dest="cache_max_size", type="int",
+                      help="maximum size of the cache directory in MB; least recently used files are removed at the end of the run")
+    parser.add_option("--batch", dest="batch", action="store_true",
+                      help="ask the server about all files at once and only upload the ones it doesn't have")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int",
+                      help="number of files to sign at once")
+    parser.add_option("--max-host-connections", dest="max_host_connections", type="int",
+                      help="maximum number of connections to each signing server when signing files at once")
     # TODO: Different certs per server?
 
     options, args = parser.parse_args()
@@ -148,6 +160,9 @@ def main():
     if not formats:
         parser.error("no formats specified")
 
+    if options.jobs < 1:
+        parser.error("-j / --jobs must be at least 1")
+
     format_urls = defaultdict(list)
     for h in options.hosts:
         # The last two parts of a host is the actual hostname:port. Any parts
@@ -172,6 +187,13 @@ def main():
     buildValidatingOpener(options.cert)
     token = open(options.tokenfile, 'rb').read()
 
+    cache = None
+    if options.cachedir:
+        max_size = None
+        if options.cache_max_size:
+            max_size = options.cache_max_size * 1024 ** 2
+        cache = SigningCache(options.cachedir, max_size)
+
     for fmt in formats:
         urls = format_urls[fmt]
         random.shuffle(urls)
@@ -194,6 +216,7 @@ def main():
         else:
             files = findfiles(args, options.includes, options.excludes)
 
+        to_sign = []
         for f in files:
             log.debug("%s", f)
             log.debug("checking %s for signature...", f)
@@ -204,10 +227,19 @@ def main():
                 dest = os.path.join(options.output_dir, os.path.basename(f))
             else:
                 dest = None
+            to_sign.append((f, dest))
 
-            if not remote_signfile(options, urls, f, fmt, token, dest):
-                log.error("Failed to sign %s with %s", f, fmt)
+        if options.batch or options.jobs > 1:
+            if not remote_signfiles(options, urls, to_sign, fmt, token,
+                                    jobs=options.jobs, batch=options.batch,
+                                    max_host_connections=options.max_host_connections,
+                                    cache=cache):
                 sys.exit(1)
+        else:
+            for f, dest in to_sign:
+                if not remote_signfile(options, urls, f, fmt, token, dest, cache=cache):
+                    log.error("Failed to sign %s with %s", f, fmt)
+                    sys.exit(1)
 
         if fmt == "dmg":
             for fd in args:
@@ -215,6 +247,12 @@ def main():
                 unpacktar(fd + '.tar.gz', os.getcwd())
                 os.unlink(fd + '.tar.gz')
 
+    if cache:
+        log.info("Cache stats: %s", cache.report())
+        removed = cache.evict()
+        if removed:
+            log.info("Removed %i files from the cache", removed)
+
 
 if __name__ == '__main__':
     main()